@@ -0,0 +1,9 @@
+"""Load tests and micro-benchmarks for the guapio blueprints.
+
+Seed a synthetic database and measure the endpoints with::
+
+    $ python -m benchmarks run --users 1000 --moves 1000000 -o after.json
+    $ python -m benchmarks compare before.json after.json
+
+See ``python -m benchmarks --help`` for every option.
+"""
@@ -0,0 +1,140 @@
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import runner, seed
+from guapio import create_app
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    """Seed a scratch database, run the drivers and write the report."""
+    directory = tempfile.mkdtemp(prefix='guapio-bench-')
+    app = create_app({
+        'DATABASE': os.path.join(directory, 'bench.sqlite'),
+        'SECRET_KEY': 'benchmark',
+        'DEBUG': False,
+        'PASSWORD_HASH_METHOD': args.hash_method,
+    })
+
+    started = time.perf_counter()
+    scale = seed.seed(
+        app, users=args.users, moves=args.moves, posts=args.posts,
+        seed=args.seed
+    )
+    seeded = time.perf_counter() - started
+    print('Seeded {0} in {1:.1f}s'.format(scale, seeded), file=sys.stderr)
+
+    report = {
+        'meta': {
+            'revision': _git_revision(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'scale': scale,
+            'requests': args.requests,
+            'threads': args.threads,
+            'seed_seconds': round(seeded, 2),
+        },
+        'results': {},
+    }
+
+    if 'client' in args.drivers:
+        report['results']['test_client'] = runner.run_test_client(
+            app, scale, args.requests, args.seed
+        )
+
+    if 'threaded' in args.drivers:
+        report['results']['threaded'] = runner.run_threaded(
+            app, scale, args.requests, args.threads, args.seed
+        )
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+def compare(args):
+    """Print the change of every figure between two reports."""
+    with open(args.before) as f:
+        before = json.load(f)['results']
+
+    with open(args.after) as f:
+        after = json.load(f)['results']
+
+    print('{0:<12} {1:<18} {2:>8} {3:>12} {4:>12} {5:>8}'.format(
+        'driver', 'endpoint', 'figure', 'before', 'after', 'change'
+    ))
+
+    for driver in sorted(set(before) & set(after)):
+        for endpoint in sorted(set(before[driver]) & set(after[driver])):
+            old, new = before[driver][endpoint], after[driver][endpoint]
+
+            for figure in ('p50_ms', 'p95_ms', 'p99_ms', 'rps'):
+                if not old.get(figure) or new.get(figure) is None:
+                    continue
+
+                change = (new[figure] - old[figure]) / old[figure] * 100
+                print('{0:<12} {1:<18} {2:>8} {3:>12} {4:>12} {5:>+7.1f}%'
+                      .format(driver, endpoint, figure, old[figure],
+                              new[figure], change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks', description=__doc__
+    )
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    parser_run = commands.add_parser('run', help='seed and benchmark')
+    parser_run.add_argument('--users', type=int, default=1000)
+    parser_run.add_argument('--moves', type=int, default=100000,
+                            help='number of user_move rows to seed')
+    parser_run.add_argument('--posts', type=int, default=500)
+    parser_run.add_argument('--requests', type=int, default=200,
+                            help='requests per endpoint and driver')
+    parser_run.add_argument('--threads', type=int, default=8,
+                            help='concurrent clients of the threaded driver')
+    parser_run.add_argument('--drivers', nargs='+',
+                            choices=('client', 'threaded'),
+                            default=['client', 'threaded'])
+    parser_run.add_argument('--hash-method', default='pbkdf2:sha256:1000',
+                            help='password hash method of seeded users')
+    parser_run.add_argument('--seed', type=int, default=0)
+    parser_run.add_argument('--output', '-o',
+                            help='write the JSON report here')
+    parser_run.set_defaults(func=run)
+
+    parser_compare = commands.add_parser(
+        'compare', help='compare two JSON reports'
+    )
+    parser_compare.add_argument('before')
+    parser_compare.add_argument('after')
+    parser_compare.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
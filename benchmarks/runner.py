@@ -0,0 +1,191 @@
+"""Drive the app and collect latency figures per endpoint.
+
+Two drivers are available: the Flask test client, which measures the
+app alone in the calling thread, and a multi-threaded WSGI server hit
+by concurrent HTTP clients, which also measures contention between
+request threads.
+"""
+import http.client
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlencode
+
+from werkzeug.serving import make_server
+
+from benchmarks.seed import PASSWORD
+
+
+def _transfer_form(rng, users):
+    return {
+        'amount': '1',
+        'comment': 'benchmark',
+        'receiver_id': str(rng.randint(2, users)),
+        'currency_id': '1',
+    }
+
+
+def scenarios(scale):
+    """Return the benchmarked requests as ``(endpoint, method, path,
+    form)``, where ``form`` is called with a random generator to build
+    the POST body.
+    """
+    users = scale['users']
+
+    return (
+        ('blog.index', 'GET', '/', None),
+        ('user_move.index', 'GET', '/user_move/', None),
+        ('user_move.data', 'GET',
+         '/user_move/data?draw=1&start=0&length=10', None),
+        ('balance.load', 'GET', '/balance/1/load', None),
+        ('auth.login', 'POST', '/auth/login',
+         lambda rng: {'username': 'user0', 'password': PASSWORD}),
+        ('user_move.create', 'POST', '/user_move/create',
+         lambda rng: _transfer_form(rng, users)),
+    )
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted ``values``."""
+    if not values:
+        return None
+
+    index = max(int(round(fraction * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def summarize(latencies, errors, elapsed):
+    """Turn raw latencies in seconds into the reported figures."""
+    latencies = sorted(latencies)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+
+
+def run_test_client(app, scale, requests=200, seed=0):
+    """Measure every scenario sequentially with the Flask test client."""
+    rng = random.Random(seed)
+    client = app.test_client()
+    client.post(
+        '/auth/login', data={'username': 'user0', 'password': PASSWORD}
+    )
+    results = {}
+
+    for endpoint, method, path, form in scenarios(scale):
+        latencies = []
+        errors = 0
+        started = time.perf_counter()
+
+        for i in range(requests):
+            data = form(rng) if form else None
+            before = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            latencies.append(time.perf_counter() - before)
+
+            if response.status_code >= 400:
+                errors += 1
+
+        results[endpoint] = summarize(
+            latencies, errors, time.perf_counter() - started
+        )
+
+    return results
+
+
+def _login(host, port):
+    connection = http.client.HTTPConnection(host, port)
+    connection.request(
+        'POST', '/auth/login',
+        body=urlencode({'username': 'user0', 'password': PASSWORD}),
+        headers={'Content-Type': 'application/x-www-form-urlencoded'}
+    )
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    cookie = response.getheader('Set-Cookie')
+    return cookie.split(';', 1)[0] if cookie else ''
+
+
+def run_threaded(app, scale, requests=200, threads=8, seed=0):
+    """Measure every scenario with ``threads`` concurrent HTTP clients
+    against a threaded WSGI server.
+    """
+    # the access log would cost more than some of the requests
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    host, port = '127.0.0.1', server.server_port
+    serving = threading.Thread(target=server.serve_forever)
+    serving.daemon = True
+    serving.start()
+
+    try:
+        cookie = _login(host, port)
+        results = {}
+
+        for endpoint, method, path, form in scenarios(scale):
+            latencies = []
+            errors = [0]
+            lock = threading.Lock()
+            per_thread = max(requests // threads, 1)
+
+            def work(worker):
+                rng = random.Random(seed * 1000 + worker)
+                own = []
+                failed = 0
+
+                for i in range(per_thread):
+                    headers = {'Cookie': cookie}
+                    body = None
+
+                    if form is not None:
+                        body = urlencode(form(rng))
+                        headers['Content-Type'] = (
+                            'application/x-www-form-urlencoded'
+                        )
+
+                    before = time.perf_counter()
+                    connection = http.client.HTTPConnection(host, port)
+                    connection.request(method, path, body=body,
+                                       headers=headers)
+                    response = connection.getresponse()
+                    response.read()
+                    connection.close()
+                    own.append(time.perf_counter() - before)
+
+                    if response.status >= 400:
+                        failed += 1
+
+                with lock:
+                    latencies.extend(own)
+                    errors[0] += failed
+
+            workers = [
+                threading.Thread(target=work, args=(i,))
+                for i in range(threads)
+            ]
+            started = time.perf_counter()
+
+            for worker in workers:
+                worker.start()
+
+            for worker in workers:
+                worker.join()
+
+            results[endpoint] = summarize(
+                latencies, errors[0], time.perf_counter() - started
+            )
+
+        return results
+    finally:
+        server.shutdown()
+        server.server_close()
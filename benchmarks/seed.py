@@ -0,0 +1,134 @@
+"""Fill a database with synthetic users, currencies, balances, posts and
+transfers at a configurable scale."""
+import random
+import sqlite3
+from datetime import datetime, timedelta
+
+from werkzeug.security import generate_password_hash
+
+from guapio.db import init_db
+from guapio.money import parse_rate
+
+#: Password of every seeded user.
+PASSWORD = 'benchmark'
+
+#: Seeded currencies as (title, code, purchase_rate, sale_rate, scale).
+CURRENCIES = (
+    ('Dollar', 'dollar', '1', '1', 2),
+    ('Euro', 'euro', '1.08', '1.1', 2),
+    ('Pound', 'gbp', '1.25', '1.28', 2),
+    ('Yen', 'yen', '0.0066', '0.0068', 0),
+    ('Bitcoin', 'bitcoin', '60000', '61000', 8),
+)
+
+#: Rows written per executemany call.
+CHUNK_SIZE = 50000
+
+
+def _chunks(rows):
+    chunk = []
+
+    for row in rows:
+        chunk.append(row)
+
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def seed(app, users=1000, moves=100000, posts=500, seed=0):
+    """Recreate the app's database and fill it.
+
+    Transfers are spread over the last year and every user gets a large
+    balance in every currency, so benchmarked transfers never run out of
+    funds.
+
+    :return: a dict describing the scale of the data
+    """
+    with app.app_context():
+        init_db()
+
+    rng = random.Random(seed)
+    pwhash = generate_password_hash(
+        PASSWORD, app.config['PASSWORD_HASH_METHOD']
+    )
+    now = datetime.utcnow().replace(microsecond=0)
+    db = sqlite3.connect(app.config['DATABASE'])
+    db.execute('PRAGMA journal_mode = WAL')
+    db.execute('PRAGMA synchronous = OFF')
+
+    def timestamp(max_age_days=365):
+        age = timedelta(seconds=rng.randrange(max_age_days * 86400))
+        return (now - age).strftime('%Y-%m-%d %H:%M:%S')
+
+    with db:
+        db.executemany(
+            'INSERT INTO user (username, password) VALUES (?, ?)',
+            (('user{0}'.format(i), pwhash) for i in range(users))
+        )
+        db.executemany(
+            'INSERT INTO currency'
+            ' (title, code, purchase_rate, sale_rate, scale)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (
+                (title, code, parse_rate(purchase), parse_rate(sale), scale)
+                for title, code, purchase, sale, scale in CURRENCIES
+            )
+        )
+        db.executemany(
+            'INSERT INTO balance (balance, user_id, currency_id)'
+            ' VALUES (?, ?, ?)',
+            (
+                (10 ** (9 + currency[4]), user_id, currency_id)
+                for user_id in range(1, users + 1)
+                for currency_id, currency in enumerate(CURRENCIES, 1)
+            )
+        )
+        db.executemany(
+            'INSERT INTO post (title, body, author_id, created)'
+            ' VALUES (?, ?, ?, ?)',
+            (
+                (
+                    'Post {0}'.format(i), 'Body of post {0}. '.format(i) * 10,
+                    rng.randint(1, users), timestamp()
+                )
+                for i in range(posts)
+            )
+        )
+
+    def transfers():
+        for i in range(moves):
+            sender = rng.randint(1, users)
+            receiver = rng.randint(1, users - 1)
+
+            if receiver >= sender:
+                receiver += 1
+
+            currency_id = rng.randint(1, len(CURRENCIES))
+            unit = 10 ** CURRENCIES[currency_id - 1][4]
+
+            yield (
+                rng.randint(unit, 500 * unit), 'transfer {0}'.format(i),
+                currency_id, sender, receiver, timestamp()
+            )
+
+    for chunk in _chunks(transfers()):
+        with db:
+            db.executemany(
+                'INSERT INTO user_move (amount, comment, currency_id,'
+                ' sender_id, receiver_id, created) VALUES (?, ?, ?, ?, ?, ?)',
+                chunk
+            )
+
+    db.execute('ANALYZE')
+    db.close()
+
+    return {
+        'users': users,
+        'currencies': len(CURRENCIES),
+        'posts': posts,
+        'moves': moves,
+    }
@@ -25,17 +25,48 @@ def create_app(test_config=None):
     except OSError:
         pass
 
-    from guapio import db
+    from guapio import (
+        assets, db, fragments, hashing, idempotency, instrument, money,
+        queryplan, writer
+    )
+    assets.init_app(app)
     db.init_app(app)
+    fragments.init_app(app)
+    hashing.init_app(app)
+    idempotency.init_app(app)
+    instrument.init_app(app)
+    money.init_app(app)
+    queryplan.init_app(app)
+    writer.init_app(app)
 
     # apply the blueprints to the app
-    from guapio import auth, blog, currency, balance, user_move
+    from guapio import (
+        auth, blog, currency, balance, events, exchange, user_move,
+        valuation
+    )
 
     app.register_blueprint(auth.bp)
+    auth.init_app(app)
     app.register_blueprint(blog.bp)
     app.register_blueprint(currency.bp)
     app.register_blueprint(balance.bp)
     app.register_blueprint(user_move.bp)
+    app.register_blueprint(valuation.bp)
+    valuation.init_app(app)
+    app.register_blueprint(events.bp)
+    events.init_app(app)
+    app.register_blueprint(exchange.bp)
+    exchange.init_app(app)
+
+    from guapio import (
+        archive, batch, export, search, settlement, statement
+    )
+    archive.init_app(app)
+    batch.init_app(app)
+    export.init_app(app)
+    search.init_app(app)
+    settlement.init_app(app)
+    statement.init_app(app)
     # app.register_blueprint(routes.bp)
 
     # with app.test_request_context():
@@ -0,0 +1,282 @@
+"""Archival of old transfers.
+
+``user_move`` only has to hold the transfers that can still change or
+be settled. ``flask archive-moves`` moves the settled transfers created
+before the archive horizon into ``user_move_archive``, keeping their
+ids, and adds them to the totals per user, month and currency of
+``user_move_month``. Each batch is moved in one transaction, so a
+transfer is always in exactly one of the two tables and in the totals
+only once archived. The hot table stays a few months deep, small enough
+to stay in the page cache.
+
+Settled transfers can't be amended or reversed, so archived rows and
+their totals never change. Unsettled ones stay in ``user_move`` however
+old they are.
+
+Reads that may reach back before the cutoff of the archive go through
+this module: :func:`user_moves` only adds the archive to the query when
+the requested range starts before the cutoff, and :func:`monthly_totals`
+adds the stored totals to those of the transfers still in ``user_move``
+instead of reading the archive at all. The transfers listing merges the
+archive into its pages the same way, once they reach back past
+:func:`get_cutoff` (see :mod:`guapio.datatables`).
+"""
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from guapio.db import bump_generation, get_db
+from guapio.ledger import immediate
+
+#: Transfers moved to the archive per transaction.
+ARCHIVE_BATCH_SIZE = 5000
+
+
+def get_cutoff(db):
+    """Return the timestamp before which transfers may be archived, or
+    ``None`` if nothing was ever archived."""
+    return db.execute('SELECT MAX(cutoff) FROM archive_run').fetchone()[0]
+
+
+def needs_archive(db, start=None):
+    """Return whether transfers created at or after ``start`` may be in
+    the archive."""
+    cutoff = get_cutoff(db)
+    return cutoff is not None and (start is None or start < cutoff)
+
+
+def horizon_cutoff(db, days):
+    """Return the start of the month ``days`` days ago, as a timestamp.
+    Whole months are archived at a time."""
+    return db.execute(
+        "SELECT strftime('%Y-%m-01 00:00:00', 'now', ?)",
+        ('-{0} days'.format(int(days)),)
+    ).fetchone()[0]
+
+
+def user_moves(db, user_id, start=None, end=None):
+    """Return the transfers sent or received by a user, oldest first,
+    archived ones included when the range needs them.
+
+    :param start: only transfers created at or after this timestamp
+    :param end: only transfers created before this timestamp
+    """
+    bounds = (start or '', end or '9999-12-31 23:59:59')
+
+    if not needs_archive(db, start):
+        return db.execute(
+            'SELECT id, amount, comment, currency_id, sender_id,'
+            ' receiver_id, created'
+            ' FROM user_move'
+            ' WHERE sender_id = ? AND created >= ? AND created < ?'
+            ' UNION ALL'
+            ' SELECT id, amount, comment, currency_id, sender_id,'
+            ' receiver_id, created'
+            ' FROM user_move WHERE receiver_id = ? AND sender_id != ?'
+            ' AND created >= ? AND created < ?'
+            ' ORDER BY created, id',
+            (user_id,) + bounds + (user_id, user_id) + bounds
+        ).fetchall()
+
+    return db.execute(
+        'SELECT id, amount, comment, currency_id, sender_id,'
+        ' receiver_id, created'
+        ' FROM user_move WHERE sender_id = ? AND created >= ? AND created < ?'
+        ' UNION ALL'
+        ' SELECT id, amount, comment, currency_id, sender_id,'
+        ' receiver_id, created'
+        ' FROM user_move WHERE receiver_id = ? AND sender_id != ?'
+        ' AND created >= ? AND created < ?'
+        ' UNION ALL'
+        ' SELECT id, amount, comment, currency_id, sender_id,'
+        ' receiver_id, created'
+        ' FROM user_move_archive'
+        ' WHERE sender_id = ? AND created >= ? AND created < ?'
+        ' UNION ALL'
+        ' SELECT id, amount, comment, currency_id, sender_id,'
+        ' receiver_id, created'
+        ' FROM user_move_archive WHERE receiver_id = ? AND sender_id != ?'
+        ' AND created >= ? AND created < ?'
+        ' ORDER BY created, id',
+        ((user_id,) + bounds + (user_id, user_id) + bounds) * 2
+    ).fetchall()
+
+
+def _add(totals, key, sent, received):
+    total = totals.get(key)
+
+    if total is None:
+        total = totals[key] = [0, 0, 0]
+
+    total[0] += sent
+    total[1] += received
+    total[2] += 1
+
+
+def _next_month(month):
+    year, month = int(month[:4]), int(month[5:7])
+    year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return '{0:04d}-{1:02d}'.format(year, month)
+
+
+def monthly_totals(db, user_id, first=None, last=None):
+    """Return what a user sent and received per month and currency.
+
+    :param first: first month (``YYYY-MM``) to include
+    :param last: last month to include
+    :return: a list of dicts with ``month``, ``currency_id``, ``sent``,
+        ``received`` and ``moves``, in month and currency order; amounts
+        in minor units
+    """
+    totals = {}
+
+    for row in db.execute(
+        'SELECT month, currency_id, sent, received, moves'
+        ' FROM user_move_month'
+        ' WHERE user_id = ? AND month >= ? AND month <= ?',
+        (user_id, first or '', last or '9999-12')
+    ):
+        totals[row[0], row[1]] = [row[2], row[3], row[4]]
+
+    bounds = (
+        first + '-01' if first else '',
+        _next_month(last) + '-01' if last else '9999-12-31 23:59:59'
+    )
+
+    # the transfers not archived yet
+    for month, currency_id, sender_id, receiver_id, amount in db.execute(
+        "SELECT strftime('%Y-%m', created), currency_id, sender_id,"
+        ' receiver_id, amount'
+        ' FROM user_move WHERE sender_id = ? AND created >= ? AND created < ?'
+        ' UNION ALL'
+        " SELECT strftime('%Y-%m', created), currency_id, sender_id,"
+        ' receiver_id, amount'
+        ' FROM user_move WHERE receiver_id = ? AND sender_id != ?'
+        ' AND created >= ? AND created < ?',
+        (user_id,) + bounds + (user_id, user_id) + bounds
+    ):
+        if sender_id == user_id:
+            _add(totals, (month, currency_id), amount, 0)
+        else:
+            _add(totals, (month, currency_id), 0, amount)
+
+    return [
+        {
+            'month': month,
+            'currency_id': currency_id,
+            'sent': total[0],
+            'received': total[1],
+            'moves': total[2],
+        }
+        for (month, currency_id), total in sorted(totals.items())
+    ]
+
+
+def _rollups(rows):
+    """Sum ``(sender_id, receiver_id, currency_id, amount, month)`` rows
+    into ``user_move_month`` rows."""
+    totals = {}
+
+    for sender_id, receiver_id, currency_id, amount, month in rows:
+        _add(totals, (sender_id, month, currency_id), amount, 0)
+        _add(totals, (receiver_id, month, currency_id), 0, amount)
+
+    return [key + tuple(total) for key, total in totals.items()]
+
+
+def archive_moves(db, cutoff, batch_size=ARCHIVE_BATCH_SIZE):
+    """Move the settled transfers created before ``cutoff`` to the
+    archive, ``batch_size`` per transaction.
+
+    :return: ``(run_id, moves)``; ``run_id`` is ``None`` when there was
+        nothing to archive
+    """
+    run_id = None
+    archived = 0
+
+    while True:
+        with immediate(db):
+            rows = db.execute(
+                'SELECT id, sender_id, receiver_id, currency_id, amount,'
+                " strftime('%Y-%m', created)"
+                ' FROM user_move'
+                ' WHERE created < ? AND settlement_id IS NOT NULL LIMIT ?',
+                (cutoff, batch_size)
+            ).fetchall()
+
+            if not rows:
+                break
+
+            if run_id is None:
+                # recorded with the first batch, so readers look in the
+                # archive as soon as it has rows of this run
+                run_id = db.execute(
+                    'INSERT INTO archive_run (cutoff) VALUES (?)', (cutoff,)
+                ).lastrowid
+
+            ids = [(row[0],) for row in rows]
+            db.executemany(
+                'INSERT INTO user_move_archive'
+                ' (id, amount, comment, currency_id, sender_id, receiver_id,'
+                ' created, settlement_id)'
+                ' SELECT id, amount, comment, currency_id, sender_id,'
+                ' receiver_id, created, settlement_id'
+                ' FROM user_move WHERE id = ?',
+                ids
+            )
+            db.executemany(
+                'INSERT INTO user_move_month'
+                ' (user_id, month, currency_id, sent, received, moves)'
+                ' VALUES (?, ?, ?, ?, ?, ?)'
+                ' ON CONFLICT (user_id, month, currency_id) DO UPDATE SET'
+                ' sent = sent + excluded.sent,'
+                ' received = received + excluded.received,'
+                ' moves = moves + excluded.moves',
+                _rollups(tuple(row[1:]) for row in rows)
+            )
+            db.executemany('DELETE FROM user_move WHERE id = ?', ids)
+            db.execute(
+                'UPDATE archive_run SET moves = moves + ? WHERE id = ?',
+                (len(rows), run_id)
+            )
+            bump_generation(db, 'user_move')
+
+        archived += len(rows)
+
+    return run_id, archived
+
+
+@click.command('archive-moves')
+@click.option('--before', type=click.DateTime(formats=['%Y-%m-%d']),
+              help='Archive transfers created before this day (YYYY-MM-DD).'
+              ' Defaults to the start of the month ARCHIVE_HORIZON_DAYS'
+              ' ago.')
+@click.option('--batch-size', type=click.IntRange(1), show_default=True,
+              default=ARCHIVE_BATCH_SIZE,
+              help='Transfers moved per transaction.')
+@with_appcontext
+def archive_moves_command(before, batch_size):
+    """Move old settled transfers out of the user_move table."""
+    db = get_db()
+
+    if before is None:
+        cutoff = horizon_cutoff(
+            db, current_app.config['ARCHIVE_HORIZON_DAYS']
+        )
+    else:
+        cutoff = before.strftime('%Y-%m-%d %H:%M:%S')
+
+    run_id, moves = archive_moves(db, cutoff, batch_size)
+
+    if run_id is None:
+        click.echo('Nothing to archive before {0}.'.format(cutoff))
+    else:
+        click.echo('Archived {0} transfer(s) created before {1}.'.format(
+            moves, cutoff
+        ))
+
+
+def init_app(app):
+    """Register the archive command with the Flask app."""
+    app.config.setdefault('ARCHIVE_HORIZON_DAYS', 90)
+    app.cli.add_command(archive_moves_command)
@@ -0,0 +1,254 @@
+"""Bundled, fingerprinted and precompressed static assets.
+
+``flask build-assets`` concatenates the stylesheets and scripts of
+:data:`BUNDLES` into ``static/dist``, names every output after a hash of
+its content, and writes gzip (and, with the ``brotli`` package, brotli)
+copies next to it. ``manifest.json`` maps each bundle to its current
+file.
+
+Templates get a ``url_for`` that returns the fingerprinted URL of
+anything in the manifest, and ``asset_urls`` that falls back to the
+separate source files while no build exists. Files in ``static/dist``
+never change under the same name, so they're served with a year long,
+immutable cache lifetime and the precompressed copy the client accepts.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+import click
+from flask import current_app, request, send_from_directory, url_for
+from flask.cli import with_appcontext
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+#: Source files of each bundle, relative to the static folder, in load
+#: order.
+BUNDLES = {
+    'app.css': (
+        'vendor/bootstrap/css/bootstrap.min.css',
+        'vendor/metisMenu/metisMenu.min.css',
+        'vendor/sb-admin/css/sb-admin-2.min.css',
+        'vendor/font-awesome/css/font-awesome.min.css',
+    ),
+    'app.js': (
+        'vendor/jquery/jquery.min.js',
+        'vendor/bootstrap/js/bootstrap.min.js',
+        'vendor/metisMenu/metisMenu.min.js',
+        'vendor/datatables/js/jquery.dataTables.min.js',
+        'vendor/datatables-plugins/dataTables.bootstrap.min.js',
+        'vendor/datatables-responsive/dataTables.responsive.js',
+        'vendor/sb-admin/js/sb-admin-2.min.js',
+        'js/main.js',
+        'js/live.js',
+    ),
+    'chart.js': (
+        'vendor/flot/jquery.flot.js',
+        'vendor/flot/jquery.flot.time.js',
+        'vendor/flot/jquery.flot.resize.js',
+        'js/rates.js',
+    ),
+}
+
+#: Directory of the build, relative to the static folder.
+DIST = 'dist'
+
+#: Cache lifetime of fingerprinted files, in seconds.
+MAX_AGE = 365 * 24 * 60 * 60
+
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")]+)\1\s*\)''')
+
+#: Encodings written next to every output, as (extension, encoding).
+ENCODINGS = (('br', 'br'), ('gz', 'gzip'))
+
+
+def _fingerprint(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def _write(static_folder, name, data):
+    """Write ``data`` under a fingerprinted version of ``name`` with its
+    compressed copies, and return the path relative to the static
+    folder."""
+    base, ext = posixpath.splitext(posixpath.basename(name))
+    filename = posixpath.join(
+        DIST, '{0}.{1}{2}'.format(base, _fingerprint(data), ext)
+    )
+    path = os.path.join(static_folder, filename)
+
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    compressors = [('gz', lambda data: gzip.compress(data, 9, mtime=0))]
+
+    if brotli is not None:
+        compressors.append(('br', brotli.compress))
+
+    for ext, compress in compressors:
+        compressed = compress(data)
+
+        # fonts like woff2 are compressed already
+        if len(compressed) < len(data) * 0.9:
+            with open(path + '.' + ext, 'wb') as f:
+                f.write(compressed)
+
+    return filename
+
+
+def _rewrite_css(static_folder, source, text, written):
+    """Point the relative ``url()``s of a stylesheet, fonts and images,
+    at fingerprinted copies in the build directory."""
+    directory = posixpath.dirname(source)
+
+    def replace(match):
+        url = match.group(2)
+
+        if re.match(r'^([a-z]+:|/|#)', url):
+            return match.group(0)
+
+        path, suffix = re.match(r'([^?#]*)(.*)', url).groups()
+        target = posixpath.normpath(posixpath.join(directory, path))
+
+        if target not in written:
+            with open(os.path.join(static_folder, target), 'rb') as f:
+                written[target] = _write(static_folder, target, f.read())
+
+        # version queries are moot with fingerprints, but SVG fonts and
+        # the '?#iefix' hack need their fragment
+        return 'url({0}{1})'.format(
+            posixpath.relpath(written[target], DIST),
+            suffix if '#' in suffix else ''
+        )
+
+    return CSS_URL.sub(replace, text)
+
+
+def build(static_folder):
+    """Build every bundle and return the manifest."""
+    os.makedirs(os.path.join(static_folder, DIST), exist_ok=True)
+    manifest = {}
+    written = {}
+
+    for name, sources in sorted(BUNDLES.items()):
+        parts = []
+
+        for source in sources:
+            with open(os.path.join(static_folder, source), 'rb') as f:
+                data = f.read()
+
+            if name.endswith('.css'):
+                data = _rewrite_css(
+                    static_folder, source, data.decode('utf8'), written
+                ).encode('utf8')
+
+            parts.append(data.strip())
+
+        # a script without a final semicolon must not run into the next
+        separator = b'\n' if name.endswith('.css') else b';\n'
+        manifest[name] = _write(
+            static_folder, name, separator.join(parts) + b'\n'
+        )
+
+    with open(os.path.join(static_folder, DIST, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def get_manifest():
+    """Return the manifest of the last build, or an empty one."""
+    manifest = current_app.extensions.get('guapio.assets')
+
+    if manifest is None:
+        path = os.path.join(current_app.static_folder, DIST, 'manifest.json')
+
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+
+        current_app.extensions['guapio.assets'] = manifest
+
+    return manifest
+
+
+def asset_url_for(endpoint, **values):
+    """Like :func:`flask.url_for`, with fingerprinted URLs for built
+    static files."""
+    if endpoint == 'static':
+        filename = get_manifest().get(values.get('filename'))
+
+        if filename is not None:
+            values['filename'] = filename
+
+    return url_for(endpoint, **values)
+
+
+def asset_urls(name):
+    """Return the URLs to load bundle ``name``: the built bundle, or its
+    source files when there's no build."""
+    if name in get_manifest():
+        return [asset_url_for('static', filename=name)]
+
+    return [url_for('static', filename=source) for source in BUNDLES[name]]
+
+
+def dist_file(filename):
+    """Serve a built file, precompressed if the client accepts it, with a
+    far-future immutable cache lifetime."""
+    directory = os.path.join(current_app.static_folder, DIST)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    served, encoding = filename, None
+
+    for ext, name in ENCODINGS:
+        if (name in request.accept_encodings and
+                os.path.isfile(os.path.join(directory, filename + '.' + ext))):
+            served, encoding = filename + '.' + ext, name
+            break
+
+    response = send_from_directory(
+        directory, served, mimetype=mimetype, max_age=MAX_AGE
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+
+    if encoding is not None:
+        response.content_encoding = encoding
+
+    return response
+
+
+@click.command('build-assets')
+@with_appcontext
+def build_assets_command():
+    """Bundle, fingerprint and compress the static assets."""
+    manifest = build(current_app.static_folder)
+    current_app.extensions['guapio.assets'] = manifest
+
+    for name, filename in sorted(manifest.items()):
+        click.echo('{0} -> {1}'.format(name, filename))
+
+    if brotli is None:
+        click.echo('brotli is not installed, only gzip copies were written.')
+
+
+def init_app(app):
+    """Register the asset helpers, the build directory route and the
+    build command with the Flask app."""
+    app.add_url_rule(
+        app.static_url_path + '/' + DIST + '/<path:filename>',
+        'dist', dist_file
+    )
+    app.context_processor(
+        lambda: {'url_for': asset_url_for, 'asset_urls': asset_urls}
+    )
+    app.cli.add_command(build_assets_command)
@@ -1,11 +1,14 @@
 import functools
+import time
 
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, session, url_for
+    Blueprint, current_app, flash, g, redirect, render_template, request,
+    session, url_for
 )
-from werkzeug.security import check_password_hash, generate_password_hash
 
+from guapio.cache import LRUCache
 from guapio.db import get_db
+from guapio.hashing import get_hasher
 
 bp = Blueprint('auth', __name__, url_prefix='/auth')
 
@@ -22,18 +25,80 @@ def login_required(view):
     return wrapped_view
 
 
+def get_user_cache():
+    """Return the cache of logged in identities of the current app."""
+    cache = current_app.extensions.get('guapio.users')
+
+    if cache is None:
+        cache = current_app.extensions['guapio.users'] = LRUCache(
+            current_app.config['USER_CACHE_SIZE'],
+            ttl=current_app.config['USER_CACHE_TTL']
+        )
+
+    return cache
+
+
+def invalidate_user(user_id):
+    """Forget the cached identity of a user, so the next request reads
+    it from the database again. Call it when a user's details change."""
+    get_user_cache().pop(user_id)
+
+
+def _remember_identity(user):
+    # the session cookie is signed, so the identity it carries can be
+    # trusted until it's older than USER_IDENTITY_TTL
+    session['identity'] = {
+        'id': user['id'],
+        'username': user['username'],
+        'issued': int(time.time()),
+    }
+
+
 @bp.before_app_request
 def load_logged_in_user():
-    """If a user id is stored in the session, load the user object from
-    the database into ``g.user``."""
+    """If a user id is stored in the session, load the user's identity
+    into ``g.user``.
+
+    The identity is looked up in a small in-process cache first, then in
+    the identity carried by the signed session, and only then in the
+    database.
+    """
     user_id = session.get('user_id')
 
     if user_id is None:
         g.user = None
-    else:
-        g.user = get_db().execute(
-            'SELECT * FROM user WHERE id = ?', (user_id,)
-        ).fetchone()
+        return
+
+    cache = get_user_cache()
+    user = cache.get(user_id)
+
+    if user is None:
+        identity = session.get('identity')
+
+        if (
+            identity is not None
+            and identity.get('id') == user_id
+            and time.time() - identity.get('issued', 0)
+            < current_app.config['USER_IDENTITY_TTL']
+        ):
+            user = {'id': identity['id'], 'username': identity['username']}
+        else:
+            row = get_db().execute(
+                'SELECT id, username FROM user WHERE id = ?', (user_id,)
+            ).fetchone()
+
+            if row is None:
+                # the user is gone, end the session
+                session.clear()
+                g.user = None
+                return
+
+            user = {'id': row['id'], 'username': row['username']}
+            _remember_identity(user)
+
+        cache.set(user_id, user)
+
+    g.user = user
 
 
 @bp.route('/register', methods=('GET', 'POST'))
@@ -61,11 +126,12 @@ def register():
         if error is None:
             # the name is available, store it in the database and go to
             # the login page
-            db.execute(
+            cursor = db.execute(
                 'INSERT INTO user (username, password) VALUES (?, ?)',
-                (username, generate_password_hash(password))
+                (username, get_hasher().hash(password))
             )
             db.commit()
+            invalidate_user(cursor.lastrowid)
             return redirect(url_for('auth.login'))
 
         flash(error)
@@ -75,25 +141,39 @@ def register():
 
 @bp.route('/login', methods=('GET', 'POST'))
 def login():
-    """Log in a registered user by adding the user id to the session."""
+    """Log in a registered user by adding the user id to the session.
+
+    Upgrades the stored hash when it was made with an older hashing
+    method or work factor.
+    """
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         db = get_db()
         error = None
+        hasher = get_hasher()
         user = db.execute(
             'SELECT * FROM user WHERE username = ?', (username,)
         ).fetchone()
 
         if user is None:
             error = 'Incorrect username.'
-        elif not check_password_hash(user['password'], password):
+        elif not hasher.check(user['password'], password):
             error = 'Incorrect password.'
 
         if error is None:
+            if hasher.needs_rehash(user['password']):
+                db.execute(
+                    'UPDATE user SET password = ? WHERE id = ?',
+                    (hasher.hash(password), user['id'])
+                )
+                db.commit()
+                invalidate_user(user['id'])
+
             # store the user id in a new session and return to the index
             session.clear()
             session['user_id'] = user['id']
+            _remember_identity(user)
             return redirect(url_for('index'))
 
         flash(error)
@@ -104,5 +184,15 @@ def login():
 @bp.route('/logout')
 def logout():
     """Clear the current session, including the stored user id."""
+    if g.user is not None:
+        invalidate_user(g.user['id'])
+
     session.clear()
     return redirect(url_for('index'))
+
+
+def init_app(app):
+    """Set the identity cache defaults of the Flask app."""
+    app.config.setdefault('USER_CACHE_SIZE', 1024)
+    app.config.setdefault('USER_CACHE_TTL', 60)
+    app.config.setdefault('USER_IDENTITY_TTL', 15 * 60)
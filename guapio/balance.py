@@ -1,30 +1,69 @@
+from datetime import datetime
+
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, flash, g, jsonify, redirect, render_template, request, url_for
 )
 from werkzeug.exceptions import abort
 
+from guapio import datatables, idempotency, ledger, statement, writer
 from guapio.auth import login_required
+from guapio.conditional import conditional
+from guapio.currency import get_currency_snapshot
 from guapio.db import get_db
+from guapio.export import parse_date
+from guapio.money import Money, MoneyError
 
 bp = Blueprint('balance', __name__, url_prefix='/balance')
 
 
+balances_listing = datatables.Listing(
+    columns='b.id, balance, c.scale, c.title AS currency, username,'
+    ' b.created',
+    tables='balance b JOIN user u ON b.user_id = u.id'
+    ' JOIN currency c ON b.currency_id = c.id',
+    key=('b.created', 'b.id'),
+    search=(
+        'b.user_id IN'
+        ' (SELECT id FROM user WHERE username >= ? AND username < ?)',
+        'b.currency_id IN'
+        ' (SELECT id FROM currency WHERE title >= ? AND title < ?)',
+    ),
+    count_from='balance',
+    generation='balance'
+)
+
+
 @bp.route('/')
+@conditional()
 def index():
+    """Show the balances table. Its rows are filled page by page from
+    :func:`data`."""
+    return render_template('balance/index.html')
 
-    db = get_db()
-    balances = db.execute(
-        'SELECT b.id, balance, user_id, currency_id, b.created'
-        ' FROM balance b JOIN user u ON b.user_id = u.id JOIN currency c ON b.currency_id = c.id'
-        ' ORDER BY b.created DESC'
-    ).fetchall()
-    return render_template('balance/index.html', balances=balances)
+
+def _format_balance(balance):
+    return {
+        'id': balance['id'],
+        'balance': str(Money(balance['balance'], balance['scale'])),
+        'currency': balance['currency'],
+        'username': balance['username'],
+        'created': balance['created'].strftime('%B %d, %Y'),
+    }
+
+
+@bp.route('/data')
+@login_required
+def data():
+    """Serve one page of balances, most recent first, to DataTables."""
+    return jsonify(
+        balances_listing.page(get_db(), request.args, _format_balance)
+    )
 
 
 def get_balance(id, check_author=True):
 
     balance = get_db().execute(
-        'SELECT b.id, balance, user_id, currency_id, b.created'
+        'SELECT b.id, balance, scale, user_id, currency_id, b.created'
         ' FROM balance b JOIN currency c ON b.currency_id = c.id'
         ' WHERE b.id = ?',
         (id,)
@@ -39,92 +78,220 @@ def get_balance(id, check_author=True):
     return balance
 
 def get_current_balance_from_user_id(user_id=None, currency_id=None):
-
+    """Return the balance of the user in every currency, or only in
+    ``currency_id``. Currency details come from the cached currency
+    snapshot, so only the user's balance rows are read.
+    """
     if user_id is None:
         user_id = g.user['id']
 
     elif user_id != g.user['id']:
         abort(403)
 
+    snapshot = get_currency_snapshot()
+
     if currency_id is None:
-        balances = get_db().execute(
-            'SELECT '
-            ' c.id as currency_id,  title, code, purchase_rate, sale_rate,'
-            ' b.id as balance_id, balance, user_id'
-            ' FROM currency c'
-            ' LEFT JOIN balance b on c.id = b.currency_id'
-            ' AND b.user_id = ?',
+        currencies = snapshot.by_id.values()
+        rows = get_db().execute(
+            'SELECT id, balance, currency_id FROM balance WHERE user_id = ?',
             (user_id,)
         ).fetchall()
-
     else:
-        balances = get_db().execute(
-            'SELECT '
-            ' c.id as currency_id,  title, code, purchase_rate, sale_rate,'
-            ' b.id as balance_id, balance, user_id'
-            ' FROM currency c'
-            ' LEFT JOIN balance b on c.id = b.currency_id'
-            ' AND b.user_id = ?'
-            ' WHERE c.id = ?',
+        currency = snapshot.by_id.get(currency_id)
+        currencies = [currency] if currency is not None else []
+        rows = get_db().execute(
+            'SELECT id, balance, currency_id FROM balance'
+            ' WHERE user_id = ? AND currency_id = ?',
             (user_id, currency_id)
-        ).fetchone()
+        ).fetchall()
 
-    if balances is None:
-        abort(404, "balances for user id {0} doesn't exist.".format(user_id))
+    held = dict((row['currency_id'], row) for row in rows)
+    balances = []
+
+    for currency in currencies:
+        row = held.get(currency['id'])
+        balances.append({
+            'currency_id': currency['id'],
+            'title': currency['title'],
+            'code': currency['code'],
+            'purchase_rate': currency['purchase_rate'],
+            'sale_rate': currency['sale_rate'],
+            'scale': currency['scale'],
+            'balance_id': row['id'] if row is not None else None,
+            'balance': row['balance'] if row is not None else None,
+            'user_id': user_id,
+        })
+
+    if currency_id is not None:
+        if not balances:
+            abort(404, "balances for user id {0} doesn't exist.".format(
+                user_id))
+
+        return balances[0]
 
     return balances
 
 
+def _format_time(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+
+    return value
+
+
+@bp.route('/at')
+@login_required
+def at():
+    """Return the current user's balances at a time, ``at``
+    (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS), now by default."""
+    time = request.args.get('at')
+
+    try:
+        time = statement.parse_time(time) if time else None
+    except ValueError:
+        return jsonify({'error': 'at must be YYYY-MM-DD [HH:MM:SS].'}), 400
+
+    db = get_db()
+    balances = []
+
+    for currency in get_currency_snapshot().by_id.values():
+        balance = statement.balance_at(
+            db, g.user['id'], currency['id'], time or statement.END_OF_TIME
+        )
+
+        if balance:
+            balances.append({
+                'currency_id': currency['id'],
+                'currency': currency['code'],
+                'balance': str(Money(balance, currency['scale'])),
+            })
+
+    return jsonify({'at': time, 'balances': balances})
+
+
+@bp.route('/statement')
+@login_required
+def statement_view():
+    """Return the current user's statement per currency: the opening and
+    closing balances and every change in between. Takes ``start`` /
+    ``end`` days (YYYY-MM-DD, ``end`` included), this month by default,
+    and an optional ``currency_id``.
+    """
+    db = get_db()
+
+    try:
+        start = request.args.get('start')
+        start = parse_date(start) if start else db.execute(
+            "SELECT datetime('now', 'start of month')"
+        ).fetchone()[0]
+        end = request.args.get('end')
+        end = parse_date(end, end=True) if end else None
+    except ValueError:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD.'}), 400
+
+    currency_id = request.args.get('currency_id', type=int)
+    currencies = get_currency_snapshot().by_id
+
+    if currency_id is not None:
+        if currency_id not in currencies:
+            abort(404, "currency id {0} doesn't exist.".format(currency_id))
+
+        currencies = [currencies[currency_id]]
+    else:
+        currencies = currencies.values()
+
+    statements = []
+
+    for currency in currencies:
+        result = statement.statement(
+            db, g.user['id'], currency['id'], start, end
+        )
+
+        if currency_id is None and not (
+            result['entries'] or result['opening'] or result['closing']
+        ):
+            continue
+
+        scale = currency['scale']
+        statements.append({
+            'currency_id': currency['id'],
+            'currency': currency['code'],
+            'opening': str(Money(result['opening'], scale)),
+            'closing': str(Money(result['closing'], scale)),
+            'entries': [
+                {
+                    'id': entry['id'],
+                    'created': _format_time(entry['created']),
+                    'kind': entry['kind'],
+                    'move_id': entry['move_id'],
+                    'change': str(Money(entry['change'], scale)),
+                    'balance': str(Money(entry['balance'], scale)),
+                }
+                for entry in result['entries']
+            ],
+            'more': result['more'],
+        })
+
+    return jsonify({
+        'start': start,
+        'end': end,
+        'statements': statements,
+    })
+
+
 @bp.route('/create', methods=('GET', 'POST'))
 @login_required
 def create():
 
     if request.method == 'POST':
         balance = request.form['balance']
-        user_id = request.form['user_id']
         currency_id = request.form['currency_id']
         error = None
 
         if not balance:
             error = 'Balance is required.'
-        if not user_id:
-            error = 'User is required.'
-        if not currency_id:
+        elif not currency_id:
             error = 'Currency is required.'
 
-        if error is not None:
-            flash(error)
-        else:
-            db = get_db()
-            db.execute(
-                'INSERT INTO balance (balance, user_id, currency_id)'
-                ' VALUES (?, ?, ?)',
-                (balance, g.user['id'], currency_id)
-            )
-            db.commit()
-            return redirect(url_for('balance.index'))
+        if error is None:
+            try:
+                idempotency.write(
+                    ledger.deposit, g.user['id'], currency_id, balance
+                )
+            except ledger.LedgerError as e:
+                error = str(e)
+            else:
+                return redirect(url_for('balance.index'))
+
+        flash(error)
 
     return render_template('balance/create.html')
 
 @bp.route('/<int:currency_id>/load', methods=('GET', 'POST'))
 @login_required
 def load(currency_id):
-
+    """Add funds in a currency to the current user's balance."""
     balance = get_current_balance_from_user_id(g.user['id'], currency_id)
 
     if request.method == 'POST':
-        balance_id = request.form['id']
+        amount = request.form['amount']
         error = None
 
-        if error is not None:
-            flash(error)
+        if not amount:
+            error = 'Amount is required.'
 
-        if balance_id:
-            update(id=balance_id)
-        else:
-            create()
+        if error is None:
+            try:
+                idempotency.write(
+                    ledger.deposit, g.user['id'], currency_id,
+                    Money.parse(amount, balance['scale'])
+                )
+            except (ledger.LedgerError, MoneyError) as e:
+                error = str(e)
+            else:
+                return redirect(url_for('blog.index'))
 
-        return redirect(url_for('blog.index'))
+        flash(error)
 
     return render_template('balance/load.html', balance=balance)
 
@@ -142,26 +309,31 @@ def update(id):
         if not balance_value:
             error = 'Balance is required.'
 
-        if error is not None:
-            flash(error)
-        else:
-            db = get_db()
-            db.execute(
-                'UPDATE balance SET balance = ? WHERE id = ?',
-                (balance_value, id)
-            )
-            db.commit()
-            return redirect(url_for('balance.index'))
+        if error is None:
+            try:
+                writer.write(
+                    ledger.set_balance, id,
+                    Money.parse(balance_value, balance['scale'], 'Balance')
+                )
+            except (ledger.LedgerError, MoneyError) as e:
+                error = str(e)
+            else:
+                return redirect(url_for('balance.index'))
+
+        flash(error)
 
     return render_template('balance/update.html', balance=balance)
 
 
-@bp.route('/<int:id>/delete', methods=('balance',))
+@bp.route('/<int:id>/delete', methods=('POST',))
 @login_required
 def delete(id):
 
     get_balance(id)
-    db = get_db()
-    db.execute('DELETE FROM balance WHERE id = ?', (id,))
-    db.commit()
+
+    try:
+        writer.write(ledger.remove_balance, id)
+    except ledger.LedgerError as e:
+        flash(str(e))
+
     return redirect(url_for('balance.index'))
@@ -0,0 +1,123 @@
+"""Reading and submitting batches of transfers.
+
+A batch is applied by :func:`guapio.ledger.transfer_many` in a single
+transaction, so thousands of transfers cost one commit instead of one
+request and one fsync each.
+"""
+import csv
+import io
+import json
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from guapio import ledger
+from guapio.db import get_db
+
+#: Fields read from each transfer of a batch.
+FIELDS = ('sender_id', 'receiver_id', 'currency_id', 'amount', 'comment')
+
+
+class BatchError(ValueError):
+    """The batch couldn't be read."""
+
+
+def parse_batch(text, fmt):
+    """Read the transfers of a batch.
+
+    JSON batches are a list of transfer objects, or an object with a
+    ``transfers`` list and an optional ``atomic`` flag. CSV batches have
+    a header row naming the fields.
+
+    :param fmt: ``'json'`` or ``'csv'``
+    :return: ``(transfers, atomic)``, ``atomic`` being ``None`` when the
+        batch doesn't say
+    :raise BatchError: if the batch is malformed
+    """
+    atomic = None
+
+    if fmt == 'csv':
+        reader = csv.DictReader(io.StringIO(text))
+
+        if reader.fieldnames is None:
+            raise BatchError('The batch is empty.')
+
+        transfers = list(reader)
+    else:
+        try:
+            data = json.loads(text)
+        except ValueError:
+            raise BatchError('The batch is not valid JSON.')
+
+        if isinstance(data, dict):
+            atomic = data.get('atomic')
+            data = data.get('transfers')
+
+        if not isinstance(data, list) or not all(
+            isinstance(item, dict) for item in data
+        ):
+            raise BatchError('The batch must be a list of transfers.')
+
+        transfers = data
+
+    return [
+        dict((key, item.get(key)) for key in FIELDS if key in item)
+        for item in transfers
+    ], atomic
+
+
+def summarize(results):
+    """Return the response for a submitted batch."""
+    applied = sum(1 for result in results if result['status'] == 'ok')
+
+    return {
+        'applied': applied,
+        'rejected': len(results) - applied,
+        'results': results,
+    }
+
+
+@click.command('bulk-transfer')
+@click.argument('batch', type=click.File('r'))
+@click.option('--format', 'fmt', type=click.Choice(('csv', 'json')),
+              help='Batch format, guessed from the file name by default.')
+@click.option('--sender-id', type=int,
+              help='Send every transfer from this user.')
+@click.option('--atomic', is_flag=True,
+              help='Apply nothing if any transfer is rejected.')
+@with_appcontext
+def bulk_transfer_command(batch, fmt, sender_id, atomic):
+    """Apply the transfers in BATCH (CSV or JSON) in one transaction."""
+    if fmt is None:
+        fmt = 'csv' if batch.name.endswith('.csv') else 'json'
+
+    try:
+        transfers, batch_atomic = parse_batch(batch.read(), fmt)
+    except BatchError as e:
+        raise click.ClickException(str(e))
+
+    if len(transfers) > current_app.config['BULK_TRANSFER_LIMIT']:
+        raise click.ClickException('The batch is too large.')
+
+    if sender_id is not None:
+        for transfer in transfers:
+            transfer['sender_id'] = sender_id
+
+    summary = summarize(ledger.transfer_many(
+        get_db(), transfers, atomic or bool(batch_atomic)
+    ))
+
+    for number, result in enumerate(summary['results'], 1):
+        if result['status'] != 'ok':
+            click.echo('{0}: {1}'.format(number, result['error']), err=True)
+
+    click.echo('Applied {0} transfer(s), rejected {1}.'.format(
+        summary['applied'], summary['rejected']
+    ))
+
+
+def init_app(app):
+    """Register the bulk transfer command with the Flask app."""
+    app.config.setdefault('BULK_TRANSFER_LIMIT', 10000)
+    app.cli.add_command(bulk_transfer_command)
@@ -1,28 +1,128 @@
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, flash, g, jsonify, redirect, render_template, request, url_for
 )
 from werkzeug.exceptions import abort
 
+from guapio import datatables, idempotency, ledger, search, writer
 from guapio.auth import login_required
+from guapio.conditional import conditional
 from guapio.db import get_db
 from guapio.balance import get_current_balance_from_user_id
+from guapio.valuation import get_user_portfolio
 
 bp = Blueprint('blog', __name__)
 
+posts_listing = datatables.Listing(
+    columns='p.id, title, body, p.created, author_id, username',
+    tables='post p JOIN user u ON p.author_id = u.id',
+    key=('p.created', 'p.id'),
+    count_from='post',
+    generation='post'
+)
+
+
 @bp.route('/')
 @login_required
+@conditional('currency', lambda: ledger.balance_generation(g.user['id']))
 def index():
-    """Show all the posts, most recent first."""
-    db = get_db()
-    posts = db.execute(
-        'SELECT p.id, title, body, p.created, author_id, username'
-        ' FROM post p JOIN user u ON p.author_id = u.id'
-        ' ORDER BY p.created DESC'
-    ).fetchall()
-    balances = get_current_balance_from_user_id()
+    """Show the balances of the current user and what they are worth
+    in each currency. The posts table is filled page by page from
+    :func:`data`.
+
+    Balances and portfolio are loaded by the template, only when its
+    cached fragment is missing or out of date.
+    """
     return render_template(
         'blog/index.html',
-        posts=posts, balances=balances)
+        balance_generation=ledger.balance_generation(g.user['id']),
+        load_balances=get_current_balance_from_user_id,
+        load_portfolio=get_user_portfolio)
+
+
+def _format_post(post):
+    body = post['body']
+
+    return {
+        'id': post['id'],
+        'title': post['title'],
+        'username': post['username'],
+        'body': body if len(body) <= 100 else body[:97] + '...',
+        'created': post['created'].strftime('%B %d, %Y'),
+        'edit_url': url_for('blog.update', id=post['id'])
+        if post['author_id'] == g.user['id'] else None,
+    }
+
+
+@bp.route('/data')
+@login_required
+def data():
+    """Serve one page of posts, most recent first, to DataTables.
+    Searches go through the full-text index and are ranked instead, with
+    a snippet of the body around the matches.
+    """
+    db = get_db()
+    query = search.parse_query(request.args.get('search[value]', ''))
+
+    if query is None:
+        return jsonify(posts_listing.page(db, request.args, _format_post))
+
+    start = max(request.args.get('start', 0, type=int), 0)
+    length = request.args.get('length', 10, type=int)
+
+    if length <= 0 or length > datatables.MAX_PAGE_LENGTH:
+        length = datatables.MAX_PAGE_LENGTH
+
+    posts = search.search_posts(db, query, length, start)
+    total = db.execute('SELECT COUNT(*) FROM post').fetchone()[0]
+
+    return jsonify({
+        'draw': request.args.get('draw', 0, type=int),
+        'recordsTotal': total,
+        'recordsFiltered': search.count_posts(db, query),
+        'data': [
+            _format_post(dict(post, body=search.plain(post['snippet'])))
+            for post in posts
+        ],
+        'cursor': None,
+    })
+
+
+@bp.route('/search', endpoint='search')
+@login_required
+def search_view():
+    """Search the posts for ``q``, best matches first, ``page`` by page.
+    Snippets are HTML with the matches in ``<mark>``.
+    """
+    query = search.parse_query(request.args.get('q', ''))
+    page = max(request.args.get('page', 1, type=int), 1)
+
+    if query is None:
+        return jsonify({'error': 'q is required.'}), 400
+
+    db = get_db()
+    total = search.count_posts(db, query)
+    posts = search.search_posts(
+        db, query, search.PAGE_SIZE, (page - 1) * search.PAGE_SIZE
+    )
+
+    return jsonify({
+        'query': request.args['q'],
+        'page': page,
+        'pages': -(-total // search.PAGE_SIZE),
+        'total': total,
+        'results': [
+            {
+                'id': post['id'],
+                'title': post['title'],
+                'username': post['username'],
+                'snippet': search.highlight(post['snippet']),
+                'created': post['created'].strftime('%B %d, %Y'),
+                'edit_url': url_for('blog.update', id=post['id'])
+                if post['author_id'] == g.user['id'] else None,
+            }
+            for post in posts
+        ],
+    })
 
 
 def get_post(id, check_author=True):
@@ -68,13 +168,12 @@ def create():
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
+            idempotency.execute(
                 'INSERT INTO post (title, body, author_id)'
                 ' VALUES (?, ?, ?)',
-                (title, body, g.user['id'])
+                (title, body, g.user['id']),
+                ('post',)
             )
-            db.commit()
             return redirect(url_for('blog.index'))
 
     return render_template('blog/create.html')
@@ -97,12 +196,11 @@ def update(id):
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
+            writer.execute(
                 'UPDATE post SET title = ?, body = ? WHERE id = ?',
-                (title, body, id)
+                (title, body, id),
+                ('post',)
             )
-            db.commit()
             return redirect(url_for('blog.index'))
 
     return render_template('blog/update.html', post=post)
@@ -117,7 +215,5 @@ def delete(id):
     author of the post.
     """
     get_post(id)
-    db = get_db()
-    db.execute('DELETE FROM post WHERE id = ?', (id,))
-    db.commit()
+    writer.execute('DELETE FROM post WHERE id = ?', (id,), ('post',))
     return redirect(url_for('blog.index'))
@@ -0,0 +1,74 @@
+"""A small in-process cache shared by the threads of a worker.
+
+:class:`LRUCache` holds the session users of :mod:`guapio.auth` and
+the rendered fragments of :mod:`guapio.fragments`. Each process has
+its own, so whatever it holds must be safe to be a little stale or be
+keyed on something that changes when the data does.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A thread-safe mapping that keeps at most ``maxsize`` entries,
+    dropping the least recently used first. With a ``ttl``, entries also
+    expire that many seconds after they were set.
+
+    :param maxsize: the maximum number of entries
+    :param ttl: seconds an entry lives, or ``None`` to keep it until it
+        is pushed out
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """Return the value of ``key``, or ``default`` if it's missing or
+        expired."""
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+
+            if expires is not None and expires <= self._timer():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        """Store ``value`` under ``key`` as the most recently used. A
+        ``ttl`` overrides the cache's own for this entry."""
+        if ttl is None:
+            ttl = self.ttl
+
+        expires = self._timer() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove ``key`` and return its value, or ``default``."""
+        with self._lock:
+            expires, value = self._data.pop(key, (None, default))
+
+        return value
+
+    def clear(self):
+        """Remove every entry."""
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,95 @@
+"""Conditional GET for pages built from a few tables.
+
+Every write bumps the change counter of the tables it touched (see
+:func:`guapio.db.bump_generation`). A page's ETag is a hash of the
+counters it depends on, the logged in user and the code that renders
+it, so it can be computed with a primary key lookup per table and a
+client that already has the page gets ``304 Not Modified`` without the
+page's queries or template ever running.
+"""
+import functools
+import hashlib
+import os
+
+from flask import current_app, g, make_response, request, session
+
+from guapio.assets import get_manifest
+from guapio.db import get_db, get_generation
+
+
+def _code_version():
+    """Return a token that changes whenever the modules, templates or
+    built assets of the app change, so a deploy invalidates old ETags.
+    """
+    version = current_app.extensions.get('guapio.conditional')
+
+    if version is None:
+        digest = hashlib.sha1(repr(sorted(get_manifest().items())).encode())
+
+        for directory, dirnames, filenames in sorted(
+            os.walk(current_app.root_path)
+        ):
+            dirnames[:] = sorted(d for d in dirnames if d != 'static')
+
+            for filename in sorted(filenames):
+                if filename.endswith(('.py', '.html')):
+                    stat = os.stat(os.path.join(directory, filename))
+                    digest.update('{0}:{1}:{2};'.format(
+                        filename, stat.st_mtime_ns, stat.st_size
+                    ).encode())
+
+        version = current_app.extensions['guapio.conditional'] = (
+            digest.hexdigest()
+        )
+
+    return version
+
+
+def compute_etag(generations):
+    """Return the ETag of the current request for a page built from
+    ``generations``, change counter names or callables returning one.
+    """
+    db = get_db()
+    user_id = g.user['id'] if g.get('user') else None
+    parts = [_code_version(), request.full_path, str(user_id)]
+
+    for name in generations:
+        if callable(name):
+            name = name()
+
+        parts.append('{0}={1}'.format(name, get_generation(db, name)))
+
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
+def conditional(*generations):
+    """View decorator answering ``304 Not Modified`` when the client
+    already has the page as of the current change counters.
+
+    Pages always vary by user. Flashed messages are shown once, so the
+    page is rendered in full while any are pending.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapped_view(**kwargs):
+            if request.method not in ('GET', 'HEAD') or '_flashes' in session:
+                return view(**kwargs)
+
+            etag = compute_etag(generations)
+
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(view(**kwargs))
+
+                if response.status_code != 200:
+                    return response
+
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        return wrapped_view
+
+    return decorator
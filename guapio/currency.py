@@ -1,34 +1,94 @@
+from types import MappingProxyType
+
+from blinker import Namespace
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, current_app, flash, g, jsonify, redirect, render_template,
+    request, url_for
 )
 from werkzeug.exceptions import abort
 
+from guapio import timeseries, writer
 from guapio.auth import login_required
-from guapio.db import get_db
+from guapio.conditional import conditional
+from guapio.db import get_db, get_generation
+from guapio.export import parse_date
+from guapio.money import DEFAULT_SCALE, MAX_SCALE, MoneyError, parse_rate
 
 bp = Blueprint('currency', __name__, url_prefix='/currency')
 
+_signals = Namespace()
+
+#: Sent after the rates of a currency were changed, with ``currency_id``,
+#: ``purchase_rate`` and ``sale_rate`` as stored.
+rates_changed = _signals.signal('rates-changed')
+
+
+class CurrencySnapshot(object):
+    """The currency table as it was at one generation. A snapshot is
+    never changed after it's built, so every thread of the process can
+    share it.
+
+    :param generation: the ``currency`` generation the rows were read at
+    :param rows: the currency rows, most recent first
+    """
+
+    __slots__ = ('generation', 'currencies', 'by_id', 'by_code')
+
+    def __init__(self, generation, rows):
+        self.generation = generation
+        self.currencies = tuple(rows)
+        self.by_id = MappingProxyType(
+            dict((row['id'], row) for row in sorted(rows, key=_row_id))
+        )
+        # the most recent currency wins if a code is used twice
+        self.by_code = MappingProxyType(
+            dict((row['code'], row) for row in reversed(self.currencies))
+        )
+
+
+def _row_id(row):
+    return row['id']
+
+
+def get_currency_snapshot():
+    """Return the cached :class:`CurrencySnapshot`, reloading it first
+    if the ``currency`` generation in the database moved on because
+    this or another process changed a currency.
+    """
+    if 'currency_snapshot' not in g:
+        db = get_db()
+        # read the generation before the rows: a change in between makes
+        # the snapshot look older than it is and it gets reloaded again
+        generation = get_generation(db, 'currency')
+        snapshot = current_app.extensions.get('guapio.currency')
+
+        if snapshot is None or snapshot.generation != generation:
+            snapshot = CurrencySnapshot(generation, db.execute(
+                'SELECT c.id, title, code, created, purchase_rate, sale_rate,'
+                ' scale'
+                ' FROM currency c'
+                ' ORDER BY created DESC'
+            ).fetchall())
+            current_app.extensions['guapio.currency'] = snapshot
+
+        g.currency_snapshot = snapshot
+
+    return g.currency_snapshot
+
+
 def get_currencies():
-    db = get_db()
-    return db.execute(
-        'SELECT c.id, title, code, created, purchase_rate, sale_rate'
-        ' FROM currency c'
-        ' ORDER BY created DESC'
-    ).fetchall()
+    """Return every currency, most recent first."""
+    return get_currency_snapshot().currencies
 
 
 @bp.route('/')
+@conditional('currency')
 def index():
     return render_template('currency/index.html', currencies=get_currencies())
 
 
 def get_currency(id, check_author=True):
-    currency = get_db().execute(
-        'SELECT c.id,  title, code, created, purchase_rate, sale_rate'
-        ' FROM currency c'
-        ' WHERE c.id = ?',
-        (id,)
-    ).fetchone()
+    currency = get_currency_snapshot().by_id.get(id)
 
     if currency is None:
         abort(404, "currency id {0} doesn't exist.".format(id))
@@ -36,6 +96,62 @@ def get_currency(id, check_author=True):
     return currency
 
 
+#: Most points a rate series can be downsampled to.
+MAX_POINTS = 2000
+
+
+@bp.route('/<int:id>/history')
+def history(id):
+    """Chart the rate history of a currency, drawn from :func:`rates`."""
+    return render_template('currency/history.html', currency=get_currency(id))
+
+
+@bp.route('/<int:id>/rates')
+@conditional('currency')
+def rates(id):
+    """Serve the rate history of a currency for charts, downsampled to
+    ``points`` points (300 by default) with ``method`` (``lttb`` or
+    ``minmax``). Takes optional ``start`` / ``end`` days (YYYY-MM-DD).
+    """
+    currency = get_currency(id)
+    points = request.args.get('points', 300, type=int)
+    method = request.args.get('method', 'lttb')
+
+    if not 3 <= points <= MAX_POINTS:
+        return jsonify({
+            'error': 'points must be between 3 and {0}.'.format(MAX_POINTS)
+        }), 400
+
+    if method not in timeseries.METHODS:
+        return jsonify({'error': 'Unknown method {0}.'.format(method)}), 400
+
+    try:
+        start = request.args.get('start')
+        start = parse_date(start) if start else None
+        end = request.args.get('end')
+        end = parse_date(end, end=True) if end else None
+    except ValueError:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD.'}), 400
+
+    times, purchase, sale = timeseries.load_rates(get_db(), id, start, end)
+
+    return jsonify({
+        'currency': {
+            'id': currency['id'],
+            'code': currency['code'],
+            'title': currency['title'],
+        },
+        'method': method,
+        'total': len(times),
+        'series': {
+            'purchase_rate': timeseries.downsample(
+                times, purchase, points, method
+            ),
+            'sale_rate': timeseries.downsample(times, sale, points, method),
+        },
+    })
+
+
 @bp.route('/create', methods=('GET', 'POST'))
 @login_required
 def create():
@@ -54,17 +170,33 @@ def create():
             error = 'Purchase Rate is required.'
         elif not sale_rate:
             error = 'Sale Rate is required.'
+        else:
+            try:
+                purchase_rate = parse_rate(purchase_rate, 'Purchase Rate')
+                sale_rate = parse_rate(sale_rate, 'Sale Rate')
+            except MoneyError as e:
+                error = str(e)
+
+        scale = request.form.get('scale') or DEFAULT_SCALE
+
+        try:
+            scale = int(scale)
+        except ValueError:
+            scale = -1
+
+        if error is None and not 0 <= scale <= MAX_SCALE:
+            error = 'Decimals must be between 0 and {0}.'.format(MAX_SCALE)
 
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'INSERT INTO currency (title, code, purchase_rate, sale_rate)'
-                ' VALUES (?, ?, ?, ?)',
-                (title, code, purchase_rate, sale_rate)
+            writer.execute(
+                'INSERT INTO currency'
+                ' (title, code, purchase_rate, sale_rate, scale)'
+                ' VALUES (?, ?, ?, ?, ?)',
+                (title, code, purchase_rate, sale_rate, scale),
+                ('currency',)
             )
-            db.commit()
             return redirect(url_for('currency.index'))
 
     return render_template('currency/create.html')
@@ -90,27 +222,39 @@ def update(id):
             error = 'Purchase Rate is required.'
         elif not sale_rate:
             error = 'Sale Rate is required.'
-
+        else:
+            try:
+                purchase_rate = parse_rate(purchase_rate, 'Purchase Rate')
+                sale_rate = parse_rate(sale_rate, 'Sale Rate')
+            except MoneyError as e:
+                error = str(e)
 
         if error is not None:
             flash(error)
         else:
-            db = get_db()
-            db.execute(
-                'UPDATE currency SET title = ?, code = ?, purchase_rate, sale_rate = ? WHERE id = ?',
-                (title, code, purchase_rate, sale_rate, id)
+            writer.execute(
+                'UPDATE currency SET title = ?, code = ?, purchase_rate = ?, sale_rate = ?'
+                ' WHERE id = ?',
+                (title, code, purchase_rate, sale_rate, id),
+                ('currency',)
             )
-            db.commit()
+
+            if (purchase_rate, sale_rate) != (
+                currency['purchase_rate'], currency['sale_rate']
+            ):
+                rates_changed.send(
+                    currency_id=id, purchase_rate=purchase_rate,
+                    sale_rate=sale_rate
+                )
+
             return redirect(url_for('currency.index'))
 
-    return render_template('currency/update.html', currency=post)
+    return render_template('currency/update.html', currency=currency)
 
 
 @bp.route('/<int:id>/delete', methods=('POST',))
 @login_required
 def delete(id):
     get_currency(id)
-    db = get_db()
-    db.execute('DELETE FROM currency WHERE id = ?', (id,))
-    db.commit()
+    writer.execute('DELETE FROM currency WHERE id = ?', (id,), ('currency',))
     return redirect(url_for('currency.index'))
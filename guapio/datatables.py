@@ -0,0 +1,251 @@
+"""Server-side processing for the DataTables listings.
+
+The listings only ever read one page of rows. Pages are read with
+keyset (seek) pagination on ``(created, id)``: every response carries a
+``cursor`` with the key of its last row, the client sends it back as
+``after`` when it asks for the following page, and the query becomes a
+range seek on the ``created`` index instead of an ``OFFSET`` scan. A
+request without a cursor, such as jumping straight to page 40, falls
+back to ``OFFSET``.
+
+The total a listing reports is counted once per change of its table:
+it's cached per process with the table's generation counter (see
+:func:`guapio.db.bump_generation`) and counted again only once the
+counter moved on. The search box matches the start of a few indexed
+columns, looked up through their indexes, so a search reads the
+matching rows only and never scans the table for a substring.
+
+A listing can have a second one over its archived rows, which are all
+older than a cutoff. The archive is only read for the pages that reach
+back past the cutoff, and its rows are merged into them by key.
+"""
+from flask import current_app
+
+from guapio.db import get_generation
+
+#: Upper bound for the ``length`` a client may ask for.
+MAX_PAGE_LENGTH = 100
+
+
+def encode_cursor(created, id):
+    """Return the cursor string pointing after the row with this key."""
+    return '{0}|{1}'.format(created, id)
+
+
+def decode_cursor(value):
+    """Split a cursor string back into ``(created, id)``. Returns
+    ``None`` if the value isn't a valid cursor.
+    """
+    if not value:
+        return None
+
+    created, sep, id = value.rpartition('|')
+
+    if not sep or not created or not id.isdigit():
+        return None
+
+    return created, int(id)
+
+
+def prefix_bounds(value):
+    """Return the ``(low, high)`` range of the strings starting with
+    ``value``, to match a prefix with an index range instead of
+    ``LIKE``."""
+    return value, value + '\U0010ffff'
+
+
+def _row_key(row):
+    return row['created'], row['id']
+
+
+class Listing(object):
+    """A table that can be paged for DataTables.
+
+    :param columns: the column list of the ``SELECT``
+    :param tables: the ``FROM`` clause, joins included
+    :param key: the ``(created, id)`` columns to order and seek by
+    :param search: conditions matched against the search box, each
+        with two ``?`` for the bounds of :func:`prefix_bounds`; they
+        should be answered from an index
+    :param count_from: ``FROM`` clause used to count every row, defaults
+        to ``tables``
+    :param generation: the change counter the count is cached with; the
+        rows are counted on every request without one
+    :param archive: a listing of the same columns, under the same names,
+        over the archived rows
+    :param cutoff: called with the connection, returns the timestamp
+        every archived row is older than, or ``None`` if nothing is
+        archived
+    """
+
+    def __init__(self, columns, tables, key, search=(), count_from=None,
+                 generation=None, archive=None, cutoff=None):
+        self.columns = columns
+        self.tables = tables
+        self.key = key
+        self.search = search
+        self.count_from = count_from or tables
+        self.generation = generation
+        self.archive = archive
+        self.cutoff = cutoff
+
+    def _seek(self, descending):
+        return '({0}, {1}) {2} (?, ?)'.format(
+            self.key[0], self.key[1], '<' if descending else '>'
+        )
+
+    def _select(self, where, descending, offset=False):
+        sql = 'SELECT {0} FROM {1}'.format(self.columns, self.tables)
+
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+
+        sql += ' ORDER BY {0} {2}, {1} {2} LIMIT ?'.format(
+            self.key[0], self.key[1], 'DESC' if descending else 'ASC'
+        )
+
+        if offset:
+            sql += ' OFFSET ?'
+
+        return sql
+
+    def _count(self):
+        return 'SELECT COUNT(*) FROM {0}'.format(self.count_from)
+
+    def _match(self):
+        return '(' + ' OR '.join(self.search) + ')'
+
+    def _filtered_count(self):
+        return 'SELECT COUNT(*) FROM {0} WHERE {1}'.format(
+            self.tables, self._match()
+        )
+
+    def total(self, db):
+        """Return the number of rows, counted again only when the
+        generation counter moved on."""
+        if self.generation is None:
+            return db.execute(self._count()).fetchone()[0]
+
+        # read the counter before counting: a change in between makes the
+        # total look older than it is and it's counted again
+        generation = get_generation(db, self.generation)
+        totals = current_app.extensions.setdefault('guapio.totals', {})
+        cached = totals.get(self.count_from)
+
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+
+        total = db.execute(self._count()).fetchone()[0]
+        totals[self.count_from] = (generation, total)
+        return total
+
+    def statements(self):
+        """Return the SQL run to serve pages without a search term, in
+        both directions, for :mod:`guapio.queryplan`. A search sorts its
+        matches, so its plans are left out.
+        """
+        statements = [self._count()]
+
+        for descending in (True, False):
+            statements.append(self._select([], descending))
+            statements.append(self._select([], descending, offset=True))
+            statements.append(
+                self._select([self._seek(descending)], descending)
+            )
+
+        return statements
+
+    def _rows(self, db, where, params, descending, limit, offset=0):
+        params = params + [limit]
+
+        if offset:
+            params.append(offset)
+
+        return db.execute(
+            self._select(where, descending, bool(offset)), params
+        ).fetchall()
+
+    def _filtered(self, db, params):
+        return db.execute(self._filtered_count(), params).fetchone()[0]
+
+    def page(self, db, args, format_row):
+        """Answer a DataTables server-side processing request.
+
+        :param db: the database connection
+        :param args: the request arguments
+        :param format_row: called with each row, returns the JSON
+            object for it
+        :return: the response object expected by DataTables, plus the
+            ``cursor`` of the next page
+        """
+        draw = args.get('draw', 0, type=int)
+        start = max(args.get('start', 0, type=int), 0)
+        length = args.get('length', 10, type=int)
+
+        if length <= 0 or length > MAX_PAGE_LENGTH:
+            length = MAX_PAGE_LENGTH
+
+        descending = args.get('order[0][dir]', 'desc') != 'asc'
+        search = args.get('search[value]', '').strip()
+        after = decode_cursor(args.get('after'))
+
+        where = []
+        params = []
+
+        if search and self.search:
+            where.append(self._match())
+            params.extend(prefix_bounds(search) * len(self.search))
+
+        filter_params = list(params)
+
+        if after is not None:
+            where.append(self._seek(descending))
+            params.extend(after)
+
+        offset = start if after is None else 0
+        cutoff = self.cutoff(db) if self.archive is not None else None
+
+        if cutoff is None:
+            listings = (self,)
+            rows = self._rows(db, where, params, descending, length, offset)
+        else:
+            listings = (self, self.archive)
+            rows = self._rows(db, where, params, descending, offset + length)
+
+            # going back in time, archived rows only come after the first
+            # row older than the cutoff
+            if (
+                not descending or len(rows) < offset + length
+                or str(rows[-1]['created']) < cutoff
+            ):
+                rows = sorted(
+                    rows + self.archive._rows(
+                        db, where, params, descending, offset + length
+                    ),
+                    key=_row_key, reverse=descending
+                )
+
+            rows = rows[offset:offset + length]
+
+        total = sum(listing.total(db) for listing in listings)
+
+        if filter_params:
+            filtered = sum(
+                listing._filtered(db, filter_params) for listing in listings
+            )
+        else:
+            filtered = total
+
+        cursor = None
+
+        if len(rows) == length:
+            last = rows[-1]
+            cursor = encode_cursor(last['created'], last['id'])
+
+        return {
+            'draw': draw,
+            'recordsTotal': total,
+            'recordsFiltered': filtered,
+            'data': [format_row(row) for row in rows],
+            'cursor': cursor,
+        }
@@ -1,33 +1,197 @@
+import os
 import sqlite3
+import threading
 
 import click
 from flask import current_app, g
 from flask.cli import with_appcontext
 
 
+#: PRAGMAs applied to every pooled connection, as (pragma, config key).
+PRAGMA_SETTINGS = (
+    ('journal_mode', 'SQLITE_JOURNAL_MODE'),
+    ('synchronous', 'SQLITE_SYNCHRONOUS'),
+    ('mmap_size', 'SQLITE_MMAP_SIZE'),
+    ('cache_size', 'SQLITE_CACHE_SIZE'),
+    ('busy_timeout', 'SQLITE_BUSY_TIMEOUT'),
+)
+
+
+class ConnectionPool(object):
+    """Keep warm SQLite connections between requests.
+
+    Each connection is handed to exactly one thread at a time, so the
+    pool can be shared by all request threads of a worker process.
+    Connections inherited across a ``fork`` are never reused; the pool
+    notices the new process id and starts over.
+
+    :param database: path of the SQLite database file
+    :param pragmas: sequence of ``(name, value)`` PRAGMAs to apply to
+        every new connection
+    :param size: maximum number of idle connections kept around
+    """
+
+    def __init__(self, database, pragmas=(), size=8):
+        self.database = database
+        self.pragmas = tuple(pragmas)
+        self.size = size
+        self._idle = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._stats = dict.fromkeys(
+            ('created', 'reused', 'released', 'discarded', 'in_use'), 0
+        )
+
+    def connect(self):
+        """Open a new connection with the pool's PRAGMAs applied."""
+        db = sqlite3.connect(
+            self.database,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False
+        )
+        db.row_factory = sqlite3.Row
+
+        for name, value in self.pragmas:
+            db.execute('PRAGMA {0} = {1}'.format(name, value))
+
+        return db
+
+    def _check_pid(self):
+        # must be called with the lock held
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = []
+            self._stats['in_use'] = 0
+
+    def acquire(self):
+        """Take an idle connection from the pool, or open a new one."""
+        with self._lock:
+            self._check_pid()
+            db = self._idle.pop() if self._idle else None
+            self._stats['reused' if db is not None else 'created'] += 1
+            self._stats['in_use'] += 1
+
+        if db is None:
+            db = self.connect()
+
+        return db
+
+    def release(self, db):
+        """Give a connection back to the pool. Any transaction left open
+        by the request is rolled back first.
+        """
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            keep = False
+        else:
+            keep = True
+
+        with self._lock:
+            if self._pid != os.getpid():
+                return
+
+            self._stats['in_use'] = max(self._stats['in_use'] - 1, 0)
+
+            if keep and len(self._idle) < self.size:
+                self._idle.append(db)
+                self._stats['released'] += 1
+                return
+
+            self._stats['discarded'] += 1
+
+        db.close()
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for db in idle:
+            db.close()
+
+    def stats(self):
+        """Return a snapshot of the pool counters."""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+            stats['size'] = self.size
+
+        return stats
+
+
+def get_pool(app=None):
+    """Return the connection pool of the app, creating it on first use."""
+    if app is None:
+        app = current_app._get_current_object()
+
+    pool = app.extensions.get('guapio.db')
+
+    if pool is None:
+        pool = app.extensions['guapio.db'] = ConnectionPool(
+            app.config['DATABASE'],
+            pragmas=[
+                (name, app.config[key]) for name, key in PRAGMA_SETTINGS
+                if app.config.get(key) is not None
+            ],
+            size=app.config['DATABASE_POOL_SIZE']
+        )
+
+    return pool
+
+
+def get_pool_stats():
+    """Return the counters of the current app's connection pool."""
+    return get_pool().stats()
+
+
 def get_db():
     """Connect to the application's configured database. The connection
-    is unique for each request and will be reused if this is called
-    again.
+    is taken from the pool, is unique for each request and will be
+    reused if this is called again.
     """
     if 'db' not in g:
-        g.db = sqlite3.connect(
-            current_app.config['DATABASE'],
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
-        g.db.row_factory = sqlite3.Row
+        g.db = get_pool().acquire()
+
+        if 'profile' in g:
+            # the request is sampled by guapio.instrument
+            g.db = g.profile.wrap(g.db)
 
     return g.db
 
 
 def close_db(e=None):
-    """If this request connected to the database, close the
-    connection.
+    """If this request connected to the database, give the connection
+    back to the pool.
     """
     db = g.pop('db', None)
 
     if db is not None:
-        db.close()
+        get_pool().release(getattr(db, 'connection', db))
+
+
+def get_generation(db, name):
+    """Return the change counter of ``name``, usually a table. It only
+    ever goes up, so any process can tell that its cached copy of the
+    data is stale by comparing counters.
+    """
+    row = db.execute(
+        'SELECT value FROM generation WHERE name = ?', (name,)
+    ).fetchone()
+
+    return row[0] if row is not None else 0
+
+
+def bump_generation(db, *names):
+    """Increase the change counters of ``names``. Call it in the same
+    transaction as the change it records.
+    """
+    db.executemany(
+        'INSERT INTO generation (name, value) VALUES (?, 1)'
+        ' ON CONFLICT (name) DO UPDATE SET value = value + 1',
+        [(name,) for name in names]
+    )
 
 
 def init_db():
@@ -52,5 +216,12 @@ def init_app(app):
     """Register database functions with the Flask app. This is called by
     the application factory.
     """
+    app.config.setdefault('DATABASE_POOL_SIZE', 8)
+    app.config.setdefault('SQLITE_JOURNAL_MODE', 'WAL')
+    app.config.setdefault('SQLITE_SYNCHRONOUS', 'NORMAL')
+    app.config.setdefault('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)
+    app.config.setdefault('SQLITE_CACHE_SIZE', -16000)
+    app.config.setdefault('SQLITE_BUSY_TIMEOUT', 5000)
+
     app.teardown_appcontext(close_db)
     app.cli.add_command(init_db_command)
@@ -0,0 +1,286 @@
+"""Live updates of the dashboard over Server-Sent Events.
+
+``/events`` streams to the logged in user:
+
+* ``balance``: ``{"currency_id", "change", "generation"}`` when one of
+  their balances changed, ``change`` in minor units.
+* ``rate``: ``{"currency_id", "purchase_rate", "sale_rate"}`` when a
+  currency's rates changed, as stored.
+* ``snapshot``: ``{"balances", "rates", "generation"}``, every balance
+  and rate, when the stream starts and whenever events may have been
+  missed.
+
+``generation`` is the counter of the user's balances (see
+:func:`guapio.ledger.balance_generation`) once the change was made, or
+when the snapshot was read. A change can be committed after the stream
+subscribed but before its snapshot was read, so its ``balance`` event
+is already in the snapshot: the stream drops the events of a generation
+the snapshot covers, and each change is counted once.
+
+Amounts are sent as strings of digits: minor units can go past what a
+JavaScript number holds exactly.
+
+Events come from the ledger's and the currencies' signals through an
+in-process :class:`Broker`. Each stream has a bounded queue; a client
+too slow to keep up loses events and gets a snapshot instead. Writes
+made by another process don't reach the broker, so a stream that has
+been quiet for ``EVENTS_HEARTBEAT`` seconds checks the change counters
+and sends a snapshot if they moved.
+
+Each open stream holds a server thread, so streams end after
+``EVENTS_STREAM_TIMEOUT`` seconds and the browser reconnects.
+"""
+import json
+import queue
+import threading
+import time
+
+from flask import Blueprint, current_app, g, has_app_context
+
+from guapio import ledger
+from guapio.auth import login_required
+from guapio.currency import rates_changed
+from guapio.db import get_generation, get_pool
+
+bp = Blueprint('events', __name__)
+
+
+class Subscription(object):
+    """The queue of events of one stream.
+
+    :param topics: the topics it receives
+    :param size: number of events kept; newer ones are dropped while
+        it's full
+    """
+
+    __slots__ = ('topics', 'queue', 'overflowed')
+
+    def __init__(self, topics, size):
+        self.topics = tuple(topics)
+        self.queue = queue.Queue(size)
+        self.overflowed = False
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """Return the next ``(name, data)`` event, or ``None`` if none
+        came within ``timeout`` seconds."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def reset(self):
+        """Drop the queued events, a snapshot replaces them."""
+        self.overflowed = False
+
+        while True:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                return
+
+
+class Broker(object):
+    """Pass events to the subscriptions of their topic, without ever
+    blocking the publisher.
+
+    :param queue_size: size of the queue of each subscription
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self._topics = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics):
+        subscription = Subscription(topics, self.queue_size)
+
+        with self._lock:
+            for topic in subscription.topics:
+                self._topics.setdefault(topic, set()).add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscriptions = self._topics.get(topic)
+
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+
+                    if not subscriptions:
+                        del self._topics[topic]
+
+    def publish(self, topic, name, data):
+        with self._lock:
+            subscriptions = list(self._topics.get(topic, ()))
+
+        for subscription in subscriptions:
+            subscription.put((name, data))
+
+
+def get_broker():
+    """Return the event broker of the current app."""
+    broker = current_app.extensions.get('guapio.events')
+
+    if broker is None:
+        broker = current_app.extensions['guapio.events'] = Broker(
+            current_app.config['EVENTS_QUEUE_SIZE']
+        )
+
+    return broker
+
+
+@ledger.balances_changed.connect
+def _publish_balances(sender, changes, generations):
+    if not has_app_context():
+        return
+
+    broker = get_broker()
+
+    for (user_id, currency_id), change in changes.items():
+        broker.publish(ledger.balance_generation(user_id), 'balance', {
+            'currency_id': currency_id,
+            'change': str(change),
+            'generation': generations[user_id],
+        })
+
+
+@rates_changed.connect
+def _publish_rates(sender, currency_id, purchase_rate, sale_rate):
+    if has_app_context():
+        get_broker().publish('currency', 'rate', {
+            'currency_id': currency_id,
+            'purchase_rate': purchase_rate,
+            'sale_rate': sale_rate,
+        })
+
+
+def format_event(name, data):
+    """Return an event in the ``text/event-stream`` format."""
+    return 'event: {0}\ndata: {1}\n\n'.format(
+        name, json.dumps(data, separators=(',', ':'))
+    )
+
+
+def _generations(db, user_id):
+    return (
+        get_generation(db, 'currency'),
+        get_generation(db, ledger.balance_generation(user_id)),
+    )
+
+
+def _snapshot(db, user_id):
+    # one read transaction, so the balances are those of the counter
+    db.execute('BEGIN')
+
+    try:
+        generation = get_generation(db, ledger.balance_generation(user_id))
+        balances = db.execute(
+            'SELECT currency_id, balance FROM balance WHERE user_id = ?',
+            (user_id,)
+        ).fetchall()
+        rates = db.execute(
+            'SELECT id, purchase_rate, sale_rate FROM currency'
+        ).fetchall()
+    finally:
+        db.rollback()
+
+    return {
+        'balances': dict((row[0], str(row[1])) for row in balances),
+        'rates': dict((row[0], [row[1], row[2]]) for row in rates),
+        'generation': generation,
+    }
+
+
+def stream(pool, subscription, user_id, heartbeat, timeout):
+    """Yield the events of one stream until ``timeout`` seconds passed.
+
+    Connections are taken from ``pool`` only for the moment a snapshot
+    or a check needs one, never for the life of the stream.
+    """
+    def read(query):
+        db = pool.acquire()
+
+        try:
+            return query(db, user_id)
+        finally:
+            pool.release(db)
+
+    deadline = time.monotonic() + timeout
+    seen = read(_generations)
+    # the page may be older than the first event: start from a snapshot
+    snapshot = read(_snapshot)
+    yield 'retry: 3000\n' + format_event('snapshot', snapshot)
+
+    while time.monotonic() < deadline:
+        event = subscription.get(heartbeat)
+
+        if event is None:
+            current = read(_generations)
+
+            if current == seen:
+                yield ': keepalive\n\n'
+                continue
+        elif not subscription.overflowed:
+            name, data = event
+
+            # the snapshot holds the change already
+            if (name == 'balance'
+                    and data['generation'] <= snapshot['generation']):
+                continue
+
+            yield format_event(name, data)
+            continue
+
+        subscription.reset()
+        seen = read(_generations)
+        snapshot = read(_snapshot)
+        yield format_event('snapshot', snapshot)
+
+
+@bp.route('/events')
+@login_required
+def events():
+    """Stream the current user's balance changes and rate changes."""
+    config = current_app.config
+    user_id = g.user['id']
+    broker = get_broker()
+    pool = get_pool()
+
+    def generate():
+        # subscribed only once the stream is read, so a response that is
+        # never iterated leaves nothing behind
+        subscription = broker.subscribe(
+            ('currency', ledger.balance_generation(user_id))
+        )
+
+        try:
+            for chunk in stream(
+                pool, subscription, user_id,
+                config['EVENTS_HEARTBEAT'], config['EVENTS_STREAM_TIMEOUT']
+            ):
+                yield chunk
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = current_app.response_class(
+        generate(), mimetype='text/event-stream'
+    )
+    response.cache_control.no_cache = True
+    # keep proxies like nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def init_app(app):
+    """Set the defaults of the event streams."""
+    app.config.setdefault('EVENTS_QUEUE_SIZE', 100)
+    app.config.setdefault('EVENTS_HEARTBEAT', 15)
+    app.config.setdefault('EVENTS_STREAM_TIMEOUT', 300)
@@ -0,0 +1,227 @@
+"""Exchanges between the currencies a user holds.
+
+Rates are prices in the common base currency, so every pair is a cross
+rate through it: a holding is sold at its currency's ``purchase_rate``
+and the proceeds buy the other currency at its ``sale_rate``.
+
+Exchanges are made by :func:`guapio.ledger.exchange`, exactly, at the
+rates read in its transaction. Quotes are for showing prices: a batch
+of them is priced in one NumPy pass against the conversion matrix of
+:mod:`guapio.valuation`, cached per currency generation, so a page of
+pricing widgets is one request and no query. The few prices that floats
+can't tell from a minor unit boundary are priced again exactly, so a
+quote is what the exchange would give at the same rates.
+"""
+import numpy as np
+from flask import (
+    Blueprint, current_app, flash, g, jsonify, redirect, render_template,
+    request, url_for
+)
+
+from guapio import idempotency, ledger
+from guapio.auth import login_required
+from guapio.currency import get_currencies, get_currency_snapshot
+from guapio.money import Money, convert
+from guapio.valuation import conversion_matrix
+
+bp = Blueprint('exchange', __name__, url_prefix='/exchange')
+
+
+class QuoteError(ValueError):
+    """A quote request is invalid. The message is meant to be shown to
+    the user."""
+
+
+def _parse_quote(snapshot, item):
+    try:
+        from_currency_id = int(item['from_currency_id'])
+        to_currency_id = int(item['to_currency_id'])
+    except KeyError as e:
+        raise QuoteError('{0} is required.'.format(e.args[0]))
+    except (TypeError, ValueError):
+        raise QuoteError('Currencies must be integers.')
+
+    for currency_id in (from_currency_id, to_currency_id):
+        if currency_id not in snapshot.by_id:
+            raise QuoteError("Currency {0} doesn't exist.".format(currency_id))
+
+    if from_currency_id == to_currency_id:
+        raise QuoteError("Can't exchange a currency for itself.")
+
+    source = snapshot.by_id[from_currency_id]
+
+    if item.get('amount') in (None, ''):
+        raise QuoteError('amount is required.')
+
+    amount = Money.parse(item['amount'], source['scale'])
+
+    if not amount > 0:
+        raise QuoteError('Amount must be greater than zero.')
+
+    return from_currency_id, to_currency_id, amount
+
+
+def quote_many(snapshot, items):
+    """Price a batch of exchanges at the rates of ``snapshot``.
+
+    :param items: mappings with ``from_currency_id``, ``to_currency_id``
+        and ``amount``
+    :return: one result per item, in order: ``{'status': 'ok',
+        'amount', 'proceeds', 'rate'}``, amounts as decimal strings, or
+        ``{'status': 'error', 'error': message}``
+    """
+    results = [None] * len(items)
+    indexes = []
+    parsed = []
+
+    for index, item in enumerate(items):
+        try:
+            if not isinstance(item, dict):
+                raise QuoteError('Each quote must be an object.')
+
+            parsed.append(_parse_quote(snapshot, item))
+        except ValueError as e:
+            results[index] = {'status': 'error', 'error': str(e)}
+        else:
+            indexes.append(index)
+
+    if not parsed:
+        return results
+
+    ids, matrix = conversion_matrix(snapshot)
+    scales = np.array(
+        [snapshot.by_id[i]['scale'] for i in ids.tolist()], dtype=np.int64
+    )
+    sources, targets, quoted = zip(*parsed)
+    minors = [amount.minor for amount in quoted]
+    sources = np.array(sources, dtype=np.int64)
+    targets = np.array(targets, dtype=np.int64)
+    amounts = np.array(minors, dtype=np.float64)
+    i = np.searchsorted(ids, sources)
+    j = np.searchsorted(ids, targets)
+    rates = matrix[i, j]
+
+    with np.errstate(invalid='ignore'):
+        values = amounts / 10.0 ** scales[i] * rates * 10.0 ** scales[j]
+        proceeds = np.floor(values)
+        # a few ulps either side of a whole minor unit, or amounts a
+        # float doesn't hold exactly
+        tolerance = np.maximum(values, 1) * 1e-12
+        inexact = (
+            (values - proceeds < tolerance)
+            | (values - proceeds > 1 - tolerance)
+            | (amounts > 2 ** 53)
+        )
+
+    proceeds = proceeds.tolist()
+
+    for k in np.flatnonzero(inexact & ~np.isnan(values)).tolist():
+        source = snapshot.by_id[int(sources[k])]
+        target = snapshot.by_id[int(targets[k])]
+        proceeds[k] = convert(
+            minors[k], source['scale'], target['scale'],
+            source['purchase_rate'], target['sale_rate']
+        )
+
+    for k, index in enumerate(indexes):
+        if np.isnan(values[k]):
+            results[index] = {
+                'status': 'error',
+                'error': "{0} can't be bought.".format(
+                    snapshot.by_id[int(targets[k])]['code']
+                ),
+            }
+            continue
+
+        results[index] = {
+            'status': 'ok',
+            'amount': str(quoted[k]),
+            'proceeds': str(Money(int(proceeds[k]), int(scales[j[k]]))),
+            'rate': float(rates[k]),
+        }
+
+    return results
+
+
+@bp.route('/quote', methods=('POST',))
+@login_required
+def quote():
+    """Price a batch of exchanges. Takes a JSON list, or ``{"quotes":
+    [...]}``, of ``{"from_currency_id", "to_currency_id", "amount"}`` and
+    returns the result of each, in order.
+    """
+    items = request.get_json(silent=True)
+
+    if isinstance(items, dict):
+        items = items.get('quotes')
+
+    if not isinstance(items, list):
+        return jsonify({'error': 'Expected a list of quotes.'}), 400
+
+    if len(items) > current_app.config['EXCHANGE_QUOTE_LIMIT']:
+        return jsonify({'error': 'The batch is too large.'}), 413
+
+    return jsonify({'quotes': quote_many(get_currency_snapshot(), items)})
+
+
+@bp.route('/create', methods=('GET', 'POST'))
+@login_required
+def create():
+    """Exchange one of the current user's currencies for another. The
+    form is quoted first, and the exchange made once the user confirms
+    the quote; it's refused if the rates moved and would give less.
+    """
+    if request.method == 'POST':
+        amount = request.form['amount']
+        from_currency_id = request.form.get('from_currency_id')
+        to_currency_id = request.form.get('to_currency_id')
+        min_proceeds = request.form.get('min_proceeds')
+        error = None
+
+        if not amount:
+            error = 'Amount is required.'
+        elif not from_currency_id or not to_currency_id:
+            error = 'Currencies are required.'
+
+        if error is None and not min_proceeds:
+            snapshot = get_currency_snapshot()
+            result = quote_many(snapshot, [{
+                'from_currency_id': from_currency_id,
+                'to_currency_id': to_currency_id,
+                'amount': amount,
+            }])[0]
+
+            if result['status'] != 'ok':
+                error = result['error']
+            else:
+                target = snapshot.by_id[int(to_currency_id)]
+
+                if not Money.parse(result['proceeds'], target['scale']):
+                    error = 'Amount is too small to exchange.'
+                else:
+                    return render_template(
+                        'exchange/create.html', quote=result,
+                        source=snapshot.by_id[int(from_currency_id)],
+                        target=target
+                    )
+        elif error is None:
+            try:
+                idempotency.write(
+                    ledger.exchange, g.user['id'], from_currency_id,
+                    to_currency_id, amount, min_proceeds
+                )
+            except ledger.LedgerError as e:
+                error = str(e)
+            else:
+                return redirect(url_for('index'))
+
+        flash(error)
+
+    return render_template(
+        'exchange/create.html', currencies=get_currencies()
+    )
+
+
+def init_app(app):
+    """Set the defaults of the exchange quotes."""
+    app.config.setdefault('EXCHANGE_QUOTE_LIMIT', 1000)
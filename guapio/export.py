@@ -0,0 +1,240 @@
+"""Streaming export of the transfer history.
+
+Rows are read from the cursor in ``fetchmany`` batches and written out
+batch by batch, so memory stays flat however long the history is and a
+download starts with the first batch instead of after the last one.
+Amounts are written as exact decimal strings in their currency's scale.
+Archived transfers (see :mod:`guapio.archive`) are only read when the
+range starts before the archive's cutoff.
+"""
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+
+from guapio.archive import needs_archive
+from guapio.db import get_db
+from guapio.money import format_minor
+
+#: Columns of an exported transfer, in order.
+COLUMNS = (
+    'id', 'created', 'amount', 'currency', 'sender_id', 'sender',
+    'receiver_id', 'receiver', 'comment'
+)
+
+#: Rows fetched from SQLite per batch.
+BATCH_SIZE = 1000
+
+#: Output formats: name -> (mimetype, file extension).
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'jsonl': ('application/x-ndjson', 'jsonl'),
+}
+
+
+def parse_date(value, end=False):
+    """Turn a ``YYYY-MM-DD`` string into the timestamp bound used in the
+    query. ``end`` dates are inclusive, so the bound is the next day.
+
+    :raise ValueError: if the date isn't valid
+    """
+    day = datetime.strptime(value, '%Y-%m-%d')
+
+    if end:
+        day += timedelta(days=1)
+
+    return day.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def iter_user_moves(db, start=None, end=None, user_id=None):
+    """Yield lists of transfer rows, oldest first, one list per batch,
+    with the amount formatted.
+
+    :param start: only transfers created at or after this timestamp
+    :param end: only transfers created before this timestamp
+    :param user_id: only transfers sent or received by this user
+    """
+    bounds = (start or '', end or '9999-12-31 23:59:59')
+    archived = needs_archive(db, start)
+
+    if user_id is None and archived:
+        cursor = db.execute(
+            'SELECT m.id, m.created, amount, c.code AS currency,'
+            ' m.sender_id, u.username AS sender,'
+            ' m.receiver_id, r.username AS receiver, comment, c.scale'
+            ' FROM user_move m JOIN user u ON m.sender_id = u.id'
+            ' JOIN user r ON m.receiver_id = r.id'
+            ' JOIN currency c ON m.currency_id = c.id'
+            ' WHERE m.created >= ? AND m.created < ?'
+            ' UNION ALL'
+            ' SELECT m.id, m.created, amount, c.code AS currency,'
+            ' m.sender_id, u.username AS sender,'
+            ' m.receiver_id, r.username AS receiver, comment, c.scale'
+            ' FROM user_move_archive m JOIN user u ON m.sender_id = u.id'
+            ' JOIN user r ON m.receiver_id = r.id'
+            ' JOIN currency c ON m.currency_id = c.id'
+            ' WHERE m.created >= ? AND m.created < ?'
+            ' ORDER BY 2, 1',
+            bounds * 2
+        )
+    elif user_id is None:
+        cursor = db.execute(
+            'SELECT m.id, m.created, amount, c.code AS currency,'
+            ' m.sender_id, u.username AS sender,'
+            ' m.receiver_id, r.username AS receiver, comment, c.scale'
+            ' FROM user_move m JOIN user u ON m.sender_id = u.id'
+            ' JOIN user r ON m.receiver_id = r.id'
+            ' JOIN currency c ON m.currency_id = c.id'
+            ' WHERE m.created >= ? AND m.created < ?'
+            ' ORDER BY m.created, m.id',
+            bounds
+        )
+    elif archived:
+        # one index range per side and table, merged in order by SQLite
+        cursor = db.execute(
+            'SELECT m.id, m.created, amount, c.code AS currency,'
+            ' m.sender_id, u.username AS sender,'
+            ' m.receiver_id, r.username AS receiver, comment, c.scale'
+            ' FROM user_move m JOIN user u ON m.sender_id = u.id'
+            ' JOIN user r ON m.receiver_id = r.id'
+            ' JOIN currency c ON m.currency_id = c.id'
+            ' WHERE m.sender_id = ? AND m.created >= ? AND m.created < ?'
+            ' UNION ALL'
+            ' SELECT m.id, m.created, amount, c.code AS currency,'
+            ' m.sender_id, u.username AS sender,'
+            ' m.receiver_id, r.username AS receiver, comment, c.scale'
+            ' FROM user_move m JOIN user u ON m.sender_id = u.id'
+            ' JOIN user r ON m.receiver_id = r.id'
+            ' JOIN currency c ON m.currency_id = c.id'
+            ' WHERE m.receiver_id = ? AND m.sender_id != ?'
+            ' AND m.created >= ? AND m.created < ?'
+            ' UNION ALL'
+            ' SELECT m.id, m.created, amount, c.code AS currency,'
+            ' m.sender_id, u.username AS sender,'
+            ' m.receiver_id, r.username AS receiver, comment, c.scale'
+            ' FROM user_move_archive m JOIN user u ON m.sender_id = u.id'
+            ' JOIN user r ON m.receiver_id = r.id'
+            ' JOIN currency c ON m.currency_id = c.id'
+            ' WHERE m.sender_id = ? AND m.created >= ? AND m.created < ?'
+            ' UNION ALL'
+            ' SELECT m.id, m.created, amount, c.code AS currency,'
+            ' m.sender_id, u.username AS sender,'
+            ' m.receiver_id, r.username AS receiver, comment, c.scale'
+            ' FROM user_move_archive m JOIN user u ON m.sender_id = u.id'
+            ' JOIN user r ON m.receiver_id = r.id'
+            ' JOIN currency c ON m.currency_id = c.id'
+            ' WHERE m.receiver_id = ? AND m.sender_id != ?'
+            ' AND m.created >= ? AND m.created < ?'
+            ' ORDER BY 2, 1',
+            ((user_id,) + bounds + (user_id, user_id) + bounds) * 2
+        )
+    else:
+        # one index range per side, merged in order by SQLite
+        cursor = db.execute(
+            'SELECT m.id, m.created, amount, c.code AS currency,'
+            ' m.sender_id, u.username AS sender,'
+            ' m.receiver_id, r.username AS receiver, comment, c.scale'
+            ' FROM user_move m JOIN user u ON m.sender_id = u.id'
+            ' JOIN user r ON m.receiver_id = r.id'
+            ' JOIN currency c ON m.currency_id = c.id'
+            ' WHERE m.sender_id = ? AND m.created >= ? AND m.created < ?'
+            ' UNION ALL'
+            ' SELECT m.id, m.created, amount, c.code AS currency,'
+            ' m.sender_id, u.username AS sender,'
+            ' m.receiver_id, r.username AS receiver, comment, c.scale'
+            ' FROM user_move m JOIN user u ON m.sender_id = u.id'
+            ' JOIN user r ON m.receiver_id = r.id'
+            ' JOIN currency c ON m.currency_id = c.id'
+            ' WHERE m.receiver_id = ? AND m.sender_id != ?'
+            ' AND m.created >= ? AND m.created < ?'
+            ' ORDER BY 2, 1',
+            (user_id,) + bounds + (user_id, user_id) + bounds
+        )
+
+    try:
+        while True:
+            rows = cursor.fetchmany(BATCH_SIZE)
+
+            if not rows:
+                break
+
+            # the scale is selected last, only to format the amount
+            yield [
+                (row[0], row[1], format_minor(row[2], row[-1])) +
+                tuple(row[3:-1])
+                for row in rows
+            ]
+    finally:
+        cursor.close()
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+
+    return value
+
+
+def iter_csv(batches):
+    """Yield CSV text, the header first and then one chunk per batch."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+
+    for rows in batches:
+        writer.writerows([_value(v) for v in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def iter_jsonl(batches):
+    """Yield JSON Lines text, one chunk per batch."""
+    for rows in batches:
+        yield ''.join(
+            json.dumps(dict(zip(COLUMNS, map(_value, row)))) + '\n'
+            for row in rows
+        )
+
+
+def generate(fmt, db, start=None, end=None, user_id=None):
+    """Return an iterator over the export text in ``fmt``."""
+    batches = iter_user_moves(db, start, end, user_id)
+
+    if fmt == 'csv':
+        return iter_csv(batches)
+
+    return iter_jsonl(batches)
+
+
+@click.command('export-moves')
+@click.option('--format', 'fmt', type=click.Choice(sorted(FORMATS)),
+              default='csv', help='Output format.')
+@click.option('--start', help='First day to export, YYYY-MM-DD.')
+@click.option('--end', help='Last day to export, YYYY-MM-DD.')
+@click.option('--user-id', type=int,
+              help='Only transfers sent or received by this user.')
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Write here instead of stdout.')
+@with_appcontext
+def export_moves_command(fmt, start, end, user_id, output):
+    """Export the transfer history as CSV or JSON Lines."""
+    try:
+        start = parse_date(start) if start else None
+        end = parse_date(end, end=True) if end else None
+    except ValueError:
+        raise click.BadParameter('dates must be YYYY-MM-DD.')
+
+    for chunk in generate(fmt, get_db(), start, end, user_id):
+        output.write(chunk)
+
+
+def init_app(app):
+    """Register the export command with the Flask app."""
+    app.cli.add_command(export_moves_command)
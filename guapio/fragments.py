@@ -0,0 +1,189 @@
+"""Caching of rendered template fragments.
+
+The ``{% cache %}`` tag stores the HTML of its body::
+
+    {% cache 'currencies', 3600, 'currency' %}
+        ...
+    {% endcache %}
+
+The first argument is the key, the optional second one a lifetime in
+seconds, and any more are names of change counters (see
+:func:`guapio.db.bump_generation`). The counters are part of the key,
+so a write to one of those tables makes the next render miss and
+rebuild the fragment; no explicit invalidation is needed.
+
+``FRAGMENT_CACHE`` picks the backend: ``'memory'``, a bounded LRU per
+process, ``'file'``, one file per fragment in ``FRAGMENT_CACHE_DIR``
+(point it at ``/dev/shm`` to share fragments between the workers of a
+host), or ``None`` to always render.
+"""
+import hashlib
+import os
+import random
+import tempfile
+import time
+
+from flask import current_app
+from jinja2 import nodes
+from jinja2.ext import Extension
+from markupsafe import Markup
+
+from guapio.cache import LRUCache
+from guapio.db import get_db, get_generation
+
+
+class MemoryBackend(object):
+    """Keep fragments in a bounded in-process LRU cache."""
+
+    def __init__(self, maxsize=1024):
+        self._cache = LRUCache(maxsize)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value, ttl=None):
+        self._cache.set(key, value, ttl)
+
+    def clear(self):
+        self._cache.clear()
+
+
+class FileBackend(object):
+    """Keep fragments as files in ``directory``, so every process that
+    points at it shares them.
+
+    :param maxsize: number of files kept; the oldest are removed when
+        a write finds more
+    """
+
+    #: Chance that a write checks the number of files.
+    PRUNE_RATE = 1 / 64
+
+    def __init__(self, directory, maxsize=1024):
+        self.directory = directory
+        self.maxsize = maxsize
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(
+            self.directory, hashlib.sha1(key.encode('utf8')).hexdigest()
+        )
+
+    def get(self, key):
+        try:
+            with open(self._path(key), encoding='utf8') as f:
+                expires, value = f.read().split('\n', 1)
+        except (OSError, ValueError):
+            return None
+
+        if expires and float(expires) <= time.time():
+            return None
+
+        return value
+
+    def set(self, key, value, ttl=None):
+        expires = repr(time.time() + ttl) if ttl is not None else ''
+        fd, path = tempfile.mkstemp(dir=self.directory, prefix='.')
+
+        # readers never see a partly written fragment
+        with os.fdopen(fd, 'w', encoding='utf8') as f:
+            f.write(expires + '\n' + value)
+
+        os.replace(path, self._path(key))
+
+        if random.random() < self.PRUNE_RATE:
+            self.prune()
+
+    def prune(self):
+        """Remove the oldest fragments past ``maxsize``."""
+        entries = []
+
+        for entry in os.scandir(self.directory):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except OSError:
+                pass
+
+        entries.sort()
+
+        for mtime, path in entries[:max(len(entries) - self.maxsize, 0)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            os.remove(entry.path)
+
+
+def get_backend():
+    """Return the fragment cache of the current app, or ``None`` if
+    fragments aren't cached."""
+    extensions = current_app.extensions
+
+    if 'guapio.fragments' not in extensions:
+        config = current_app.config
+        kind = config['FRAGMENT_CACHE']
+
+        if kind == 'memory':
+            backend = MemoryBackend(config['FRAGMENT_CACHE_SIZE'])
+        elif kind == 'file':
+            backend = FileBackend(
+                config['FRAGMENT_CACHE_DIR'], config['FRAGMENT_CACHE_SIZE']
+            )
+        else:
+            backend = None
+
+        extensions['guapio.fragments'] = backend
+
+    return extensions['guapio.fragments']
+
+
+class FragmentCacheExtension(Extension):
+    """Add the ``{% cache key[, ttl[, counter, ...]] %}`` tag."""
+
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+
+        while parser.stream.skip_if('comma'):
+            args.append(parser.parse_expression())
+
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+
+        return nodes.CallBlock(
+            self.call_method('_render', [nodes.List(args)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _render(self, args, caller):
+        backend = get_backend()
+
+        if backend is None:
+            return caller()
+
+        key, ttl = args[0], args[1] if len(args) > 1 else None
+        db = get_db()
+        key = '|'.join([str(key)] + [
+            '{0}={1}'.format(name, get_generation(db, name))
+            for name in args[2:]
+        ])
+        value = backend.get(key)
+
+        if value is None:
+            value = caller()
+            backend.set(key, str(value), ttl)
+
+        return Markup(value)
+
+
+def init_app(app):
+    """Add the ``{% cache %}`` tag to the templates of the Flask app."""
+    app.config.setdefault('FRAGMENT_CACHE', 'memory')
+    app.config.setdefault('FRAGMENT_CACHE_SIZE', 1024)
+    app.config.setdefault(
+        'FRAGMENT_CACHE_DIR', os.path.join(app.instance_path, 'fragments')
+    )
+    app.jinja_env.add_extension(FragmentCacheExtension)
@@ -0,0 +1,118 @@
+"""Password hashing in a bounded pool of worker processes.
+
+Password hashes are slow on purpose. Running them in the request thread
+lets a burst of logins hold the GIL and starve every other request of
+the worker, so they run in a small process pool instead. The number of
+hashes running or waiting is capped; past the cap requests get a fast
+``503 Service Unavailable`` instead of piling up.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+class HashingService(object):
+    """Hash and check passwords in worker processes.
+
+    :param method: the werkzeug hashing method and work factor, such as
+        ``'scrypt:32768:8:1'`` or ``'pbkdf2:sha256:600000'``
+    :param workers: size of the process pool; ``0`` hashes in the
+        calling thread
+    :param queue_depth: hashes allowed to wait for a free worker
+    :param timeout: seconds to wait for a hash before giving up
+    """
+
+    def __init__(self, method, workers=2, queue_depth=32, timeout=10):
+        self.method = method
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+        self._prefix = None
+
+    def _get_executor(self):
+        with self._lock:
+            # a pool inherited across a fork has no live workers
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(self.workers)
+                self._pid = os.getpid()
+
+            return self._executor
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+
+        if not self._slots.acquire(blocking=False):
+            raise ServiceUnavailable(
+                'Too many logins at once, try again shortly.', retry_after=1
+            )
+
+        try:
+            future = self._get_executor().submit(func, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        # the slot is held until the worker is done, even if the request
+        # stops waiting for it
+        future.add_done_callback(lambda f: self._slots.release())
+
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise ServiceUnavailable(
+                'Timed out checking the password, try again shortly.',
+                retry_after=1
+            )
+
+    def hash(self, password):
+        """Return the hash of a password."""
+        return self._run(generate_password_hash, password, self.method)
+
+    def check(self, pwhash, password):
+        """Check a password against a stored hash."""
+        return self._run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Tell whether a stored hash was made with other parameters than
+        the configured method and should be replaced.
+        """
+        if self._prefix is None:
+            # werkzeug fills in default parameters ('scrypt' is stored as
+            # 'scrypt:32768:8:1'), so compare with a real hash
+            self._prefix = generate_password_hash(
+                '', self.method
+            ).split('$', 1)[0]
+
+        return pwhash.split('$', 1)[0] != self._prefix
+
+
+def get_hasher():
+    """Return the hashing service of the current app."""
+    hasher = current_app.extensions.get('guapio.hashing')
+
+    if hasher is None:
+        config = current_app.config
+        hasher = current_app.extensions['guapio.hashing'] = HashingService(
+            config['PASSWORD_HASH_METHOD'],
+            workers=config['PASSWORD_HASH_WORKERS'],
+            queue_depth=config['PASSWORD_HASH_QUEUE_DEPTH'],
+            timeout=config['PASSWORD_HASH_TIMEOUT']
+        )
+
+    return hasher
+
+
+def init_app(app):
+    """Set the hashing defaults of the Flask app."""
+    app.config.setdefault('PASSWORD_HASH_METHOD', 'scrypt:32768:8:1')
+    app.config.setdefault('PASSWORD_HASH_WORKERS', 2)
+    app.config.setdefault('PASSWORD_HASH_QUEUE_DEPTH', 32)
+    app.config.setdefault('PASSWORD_HASH_TIMEOUT', 10)
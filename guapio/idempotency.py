@@ -0,0 +1,160 @@
+"""Idempotency keys for the write endpoints.
+
+A client that may send a write twice, a double click or a retry after a
+timeout, sends a key with it: the ``Idempotency-Key`` header, or the
+``idempotency_key`` field every create form carries. The first request
+with a key runs the write and records what it returned, in the same
+transaction. A repeat gets the recorded result back without writing
+anything, so the view answers it as it answered the first. A repeat sent
+while the first is still queued in :mod:`guapio.writer` runs after it
+and finds the record there.
+
+A write that fails records nothing and can be retried with its key. Keys
+belong to a user and are kept ``IDEMPOTENCY_TTL`` seconds, at most the
+``IDEMPOTENCY_MAX_KEYS`` latest ones; every keyed write drops what's
+past either bound. A key sent again with another request is answered
+with ``422 Unprocessable Entity``.
+"""
+import hashlib
+import json
+import uuid
+
+from flask import current_app, g, request
+from werkzeug.exceptions import UnprocessableEntity, abort
+
+from guapio import writer
+from guapio.db import get_db
+
+#: Header a client sends its key in.
+HEADER = 'Idempotency-Key'
+
+#: Form field the create forms send their key in.
+FIELD = 'idempotency_key'
+
+#: Longest key accepted.
+MAX_KEY_LENGTH = 255
+
+# a recorded result can be None
+_MISSING = object()
+
+
+class KeyReused(UnprocessableEntity):
+    description = 'The idempotency key was already used for another request.'
+
+
+def new_key():
+    """Return a fresh key, for a form to send."""
+    return uuid.uuid4().hex
+
+
+def get_key():
+    """Return the idempotency key of the current request, or ``None``."""
+    key = request.headers.get(HEADER) or request.form.get(FIELD)
+
+    if not key:
+        return None
+
+    if len(key) > MAX_KEY_LENGTH:
+        abort(400, 'The idempotency key is too long.')
+
+    return key
+
+
+def fingerprint():
+    """Return a hash of what the current request asks for: its path and
+    its data, the key left out."""
+    digest = hashlib.sha256(request.path.encode('utf8'))
+
+    for name, value in sorted(request.form.items(multi=True)):
+        if name != FIELD:
+            digest.update(b'\0' + name.encode('utf8'))
+            digest.update(b'\0' + value.encode('utf8'))
+
+    digest.update(b'\0' + request.get_data())
+    return digest.hexdigest()
+
+
+def _recorded(db, user_id, key, request_hash, ttl):
+    row = db.execute(
+        'SELECT fingerprint, result FROM idempotency_key'
+        " WHERE user_id = ? AND key = ? AND created >= datetime('now', ?)",
+        (user_id, key, '-{0} seconds'.format(int(ttl)))
+    ).fetchone()
+
+    if row is None:
+        return _MISSING
+
+    if row[0] != request_hash:
+        raise KeyReused()
+
+    return json.loads(row[1])
+
+
+def _once(db, user_id, key, request_hash, ttl, max_keys, function, args,
+          kwargs):
+    """The operation run by :func:`write`."""
+    db.execute(
+        "DELETE FROM idempotency_key WHERE created < datetime('now', ?)",
+        ('-{0} seconds'.format(int(ttl)),)
+    )
+    result = _recorded(db, user_id, key, request_hash, ttl)
+
+    if result is not _MISSING:
+        return result
+
+    result = function(db, *args, **kwargs)
+    key_id = db.execute(
+        'INSERT INTO idempotency_key (user_id, key, fingerprint, result)'
+        ' VALUES (?, ?, ?, ?)',
+        (user_id, key, request_hash, json.dumps(result))
+    ).lastrowid
+
+    if key_id > max_keys:
+        db.execute(
+            'DELETE FROM idempotency_key WHERE id <= ?', (key_id - max_keys,)
+        )
+
+    return result
+
+
+def write(function, *args, **kwargs):
+    """Run a write operation like :func:`guapio.writer.write`, but only
+    once per idempotency key of the current user. Its result must
+    convert to JSON.
+
+    :raise KeyReused: if the key came with another request before
+    """
+    key = get_key()
+
+    if key is None:
+        return writer.write(function, *args, **kwargs)
+
+    config = current_app.config
+    user_id = g.user['id']
+    request_hash = fingerprint()
+    # most repeats are answered here, without waiting for the writer
+    result = _recorded(
+        get_db(), user_id, key, request_hash, config['IDEMPOTENCY_TTL']
+    )
+
+    if result is not _MISSING:
+        return result
+
+    return writer.write(
+        _once, user_id, key, request_hash, config['IDEMPOTENCY_TTL'],
+        config['IDEMPOTENCY_MAX_KEYS'], function, args, kwargs
+    )
+
+
+def execute(sql, parameters=(), generations=()):
+    """Run one write statement like :func:`guapio.writer.execute`, but
+    only once per idempotency key."""
+    return write(writer.statement, sql, parameters, generations)
+
+
+def init_app(app):
+    """Set the defaults of the idempotency keys and give the templates
+    ``idempotency_key()`` for their forms."""
+    app.config.setdefault('IDEMPOTENCY_TTL', 24 * 60 * 60)
+    app.config.setdefault('IDEMPOTENCY_MAX_KEYS', 100000)
+    app.add_template_global(new_key, 'idempotency_key')
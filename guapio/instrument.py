@@ -0,0 +1,408 @@
+"""Opt-in timing of requests, SQL statements and templates.
+
+With ``INSTRUMENT`` set, every request is timed into a per-endpoint
+histogram served at ``/metrics`` in the Prometheus text format, and
+requests slower than ``INSTRUMENT_SLOW_REQUEST`` seconds are logged.
+
+A sample of ``INSTRUMENT_SAMPLE_RATE`` of the requests is also
+profiled: their connection is wrapped to time every statement and count
+the rows it returns, templates are timed, and the response carries a
+``Server-Timing`` header. Metrics are kept per process; with several
+workers every worker must be scraped.
+"""
+import bisect
+import random
+import threading
+import time
+
+from flask import (
+    Response, before_render_template, current_app, g, request,
+    template_rendered
+)
+
+from guapio.db import get_pool_stats
+
+#: Upper bounds, in seconds, of the histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#: Statements kept per profiled request for the slow request log.
+MAX_STATEMENTS = 200
+
+
+class InstrumentedCursor(object):
+    """Wrap a cursor to add the time spent fetching rows, and the number
+    of rows fetched, to its statement."""
+
+    def __init__(self, cursor, statement):
+        self._cursor = cursor
+        self._statement = statement
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
+
+    def _fetch(self, method, *args):
+        start = time.perf_counter()
+        result = method(*args)
+        self._statement[1] += time.perf_counter() - start
+        return result
+
+    def fetchone(self):
+        row = self._fetch(self._cursor.fetchone)
+
+        if row is not None:
+            self._statement[2] += 1
+
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._fetch(self._cursor.fetchmany, *args)
+        self._statement[2] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._fetch(self._cursor.fetchall)
+        self._statement[2] += len(rows)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+
+            if row is None:
+                return
+
+            yield row
+
+
+class InstrumentedConnection(object):
+    """Wrap a connection to record every statement it runs in a
+    :class:`Profile`. Everything else is passed through."""
+
+    def __init__(self, connection, profile):
+        self.connection = connection
+        self._profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def _run(self, method, sql, *args):
+        statement = self._profile.statement(sql)
+        start = time.perf_counter()
+
+        try:
+            cursor = method(sql, *args)
+        finally:
+            statement[1] += time.perf_counter() - start
+
+        return InstrumentedCursor(cursor, statement)
+
+    def execute(self, sql, *args):
+        return self._run(self.connection.execute, sql, *args)
+
+    def executemany(self, sql, *args):
+        return self._run(self.connection.executemany, sql, *args)
+
+    def executescript(self, sql):
+        return self._run(self.connection.executescript, sql)
+
+
+class Profile(object):
+    """The statements and templates of one profiled request. Statements
+    are ``[sql, seconds, rows]`` lists, updated as rows are fetched."""
+
+    def __init__(self):
+        self.statements = []
+        self.queries = 0
+        self.templates = []
+        self._rendering = []
+
+    def statement(self, sql):
+        self.queries += 1
+        statement = [sql, 0.0, 0]
+
+        if len(self.statements) < MAX_STATEMENTS:
+            self.statements.append(statement)
+
+        return statement
+
+    def wrap(self, connection):
+        return InstrumentedConnection(connection, self)
+
+    @property
+    def sql_time(self):
+        return sum(statement[1] for statement in self.statements)
+
+    @property
+    def rows(self):
+        return sum(statement[2] for statement in self.statements)
+
+    @property
+    def template_time(self):
+        return sum(seconds for name, seconds in self.templates)
+
+
+class Histogram(object):
+    """A cumulative histogram of durations, one series per label value.
+
+    :param name: metric name
+    :param label: name of the label telling series apart
+    :param buckets: sorted upper bounds of the buckets, in seconds
+    """
+
+    def __init__(self, name, label, help, buckets=BUCKETS):
+        self.name = name
+        self.label = label
+        self.help = help
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, seconds):
+        index = bisect.bisect_left(self.buckets, seconds)
+
+        with self._lock:
+            series = self._series.get(value)
+
+            if series is None:
+                series = self._series[value] = [
+                    [0] * (len(self.buckets) + 1), 0.0
+                ]
+
+            series[0][index] += 1
+            series[1] += seconds
+
+    def render(self):
+        """Return the histogram in the Prometheus text format."""
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.help),
+            '# TYPE {0} histogram'.format(self.name),
+        ]
+
+        with self._lock:
+            series = sorted(
+                (value, list(counts), total)
+                for value, (counts, total) in self._series.items()
+            )
+
+        for value, counts, total in series:
+            label = '{0}="{1}"'.format(self.label, _escape(value))
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append('{0}_bucket{{{1},le="{2}"}} {3}'.format(
+                    self.name, label, bound, cumulative
+                ))
+
+            lines.append('{0}_sum{{{1}}} {2}'.format(self.name, label, total))
+            lines.append('{0}_count{{{1}}} {2}'.format(
+                self.name, label, cumulative
+            ))
+
+        return lines
+
+
+class Counter(object):
+    """A counter, one series per label value."""
+
+    def __init__(self, name, label, help):
+        self.name = name
+        self.label = label
+        self.help = help
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value, amount=1):
+        with self._lock:
+            self._series[value] = self._series.get(value, 0) + amount
+
+    def render(self):
+        """Return the counter in the Prometheus text format."""
+        lines = [
+            '# HELP {0} {1}'.format(self.name, self.help),
+            '# TYPE {0} counter'.format(self.name),
+        ]
+
+        with self._lock:
+            series = sorted(self._series.items())
+
+        for value, total in series:
+            lines.append('{0}{{{1}="{2}"}} {3}'.format(
+                self.name, self.label, _escape(value), total
+            ))
+
+        return lines
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+class Metrics(object):
+    """The metrics of one app."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.requests = Histogram(
+            'guapio_request_duration_seconds', 'endpoint',
+            'Time spent handling requests.', buckets
+        )
+        self.sql = Histogram(
+            'guapio_sql_duration_seconds', 'endpoint',
+            'Time spent in SQL per profiled request.', buckets
+        )
+        self.templates = Histogram(
+            'guapio_template_duration_seconds', 'template',
+            'Time spent rendering templates.', buckets
+        )
+        self.queries = Counter(
+            'guapio_sql_queries_total', 'endpoint',
+            'Statements run by profiled requests.'
+        )
+        self.rows = Counter(
+            'guapio_sql_rows_total', 'endpoint',
+            'Rows fetched by profiled requests.'
+        )
+        self.slow = Counter(
+            'guapio_slow_requests_total', 'endpoint',
+            'Requests slower than INSTRUMENT_SLOW_REQUEST.'
+        )
+
+    def render(self):
+        """Return every metric, and the connection pool counters, in the
+        Prometheus text format."""
+        lines = []
+
+        for metric in (self.requests, self.sql, self.templates,
+                       self.queries, self.rows, self.slow):
+            lines.extend(metric.render())
+
+        for name, value in sorted(get_pool_stats().items()):
+            metric = 'guapio_db_pool_{0}'.format(name)
+            lines.append('# TYPE {0} gauge'.format(metric))
+            lines.append('{0} {1}'.format(metric, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def get_metrics():
+    """Return the metrics of the current app."""
+    return current_app.extensions['guapio.instrument']
+
+
+def _endpoint():
+    return request.endpoint or 'none'
+
+
+def start_request():
+    g.request_started = time.perf_counter()
+
+    if random.random() < current_app.config['INSTRUMENT_SAMPLE_RATE']:
+        g.profile = Profile()
+
+
+def _template_started(sender, template, context, **extra):
+    profile = g.get('profile')
+
+    if profile is not None:
+        profile._rendering.append(time.perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    profile = g.get('profile')
+
+    if profile is not None and profile._rendering:
+        seconds = time.perf_counter() - profile._rendering.pop()
+        profile.templates.append((template.name, seconds))
+
+
+def finish_request(response):
+    started = g.get('request_started')
+
+    if started is None:
+        return response
+
+    seconds = time.perf_counter() - started
+    endpoint = _endpoint()
+    metrics = get_metrics()
+    metrics.requests.observe(endpoint, seconds)
+    profile = g.get('profile')
+
+    if profile is not None:
+        sql_time = profile.sql_time
+        metrics.sql.observe(endpoint, sql_time)
+        metrics.queries.inc(endpoint, profile.queries)
+        metrics.rows.inc(endpoint, profile.rows)
+
+        for name, template_time in profile.templates:
+            metrics.templates.observe(name, template_time)
+
+        response.headers.add('Server-Timing', ', '.join((
+            'sql;dur={0:.2f};desc="{1} queries"'.format(
+                sql_time * 1000, profile.queries
+            ),
+            'tpl;dur={0:.2f}'.format(profile.template_time * 1000),
+            'app;dur={0:.2f}'.format(seconds * 1000),
+        )))
+
+    if seconds >= current_app.config['INSTRUMENT_SLOW_REQUEST']:
+        metrics.slow.inc(endpoint)
+        _log_slow_request(endpoint, seconds, profile)
+
+    return response
+
+
+def _log_slow_request(endpoint, seconds, profile):
+    message = 'Slow request {0} {1} ({2}) took {3:.0f}ms'.format(
+        request.method, request.path, endpoint, seconds * 1000
+    )
+
+    if profile is not None:
+        message += ', {0} queries in {1:.0f}ms, templates {2:.0f}ms'.format(
+            profile.queries, profile.sql_time * 1000,
+            profile.template_time * 1000
+        )
+        slowest = sorted(profile.statements, key=lambda s: -s[1])[:5]
+
+        for sql, statement_time, rows in slowest:
+            message += '\n  {0:.1f}ms {1} rows: {2}'.format(
+                statement_time * 1000, rows, ' '.join(sql.split())
+            )
+
+    current_app.logger.warning(message)
+
+
+def metrics():
+    """Serve the metrics in the Prometheus text format."""
+    return Response(
+        get_metrics().render(),
+        mimetype='text/plain; version=0.0.4'
+    )
+
+
+def init_app(app):
+    """Set the instrumentation defaults and, if ``INSTRUMENT`` is on,
+    hook the timers and the ``/metrics`` endpoint into the Flask app.
+    """
+    app.config.setdefault('INSTRUMENT', False)
+    app.config.setdefault('INSTRUMENT_SAMPLE_RATE', 0.05)
+    app.config.setdefault('INSTRUMENT_SLOW_REQUEST', 1.0)
+    app.config.setdefault('INSTRUMENT_BUCKETS', BUCKETS)
+
+    if not app.config['INSTRUMENT']:
+        return
+
+    app.extensions['guapio.instrument'] = Metrics(
+        app.config['INSTRUMENT_BUCKETS']
+    )
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_rendered, app)
+    app.add_url_rule('/metrics', 'metrics', metrics)
@@ -0,0 +1,676 @@
+"""Money movements between users.
+
+Every function here changes the ``balance`` table together with the
+``user_move`` log inside a single ``BEGIN IMMEDIATE`` transaction, so
+``balance`` is always the projection of everything that was applied
+and never has to be recomputed from the history. Each change of a
+balance is also appended to the ``balance_change`` journal, which the
+statements of :mod:`guapio.statement` are built from.
+
+Amounts are integers of the currency's minor unit (see
+:mod:`guapio.money`); values from forms and batches are parsed with the
+scale of their currency once it has been looked up.
+
+Once a transaction is committed, :data:`balances_changed` is sent with
+what it changed.
+"""
+from contextlib import contextmanager
+
+from blinker import Namespace
+
+from guapio.db import bump_generation, get_generation
+from guapio.writer import after_commit, in_batch
+from guapio.money import DEFAULT_SCALE, MoneyError, convert, to_minor
+
+#: Largest number of ids bound to one ``IN (...)`` lookup.
+IN_CHUNK_SIZE = 500
+
+_signals = Namespace()
+
+#: Sent after a transaction that changed balances is committed, with
+#: ``changes``, a dict of ``(user_id, currency_id)`` to the change in
+#: minor units, and ``generations``, a dict of ``user_id`` to the
+#: counter of their balances (see :func:`balance_generation`) the
+#: transaction left.
+balances_changed = _signals.signal('balances-changed')
+
+
+class LedgerError(Exception):
+    """A ledger operation was rejected. The message is meant to be shown
+    to the user."""
+
+
+class InsufficientFunds(LedgerError):
+    """The sender doesn't hold enough of the currency."""
+
+
+class AlreadySettled(LedgerError):
+    """The transfer was netted into a settlement and can't change."""
+
+
+class RateChanged(LedgerError):
+    """The rates moved and an exchange would give less than quoted."""
+
+
+def balance_generation(user_id):
+    """Return the name of the change counter of one user's balances."""
+    return 'balance:{0}'.format(user_id)
+
+
+def _touch(db, changes, moves=False):
+    # record the change for pages cached on the generation counters, and
+    # return the new counters of the users
+    users = set(int(u) for u, c in changes)
+    names = ['balance'] + [balance_generation(u) for u in users]
+
+    if moves:
+        names.append('user_move')
+
+    bump_generation(db, *names)
+    return dict(
+        (u, get_generation(db, balance_generation(u))) for u in users
+    )
+
+
+def _notify(changes, generations):
+    # only once committed, so listeners never see a change rolled back
+    changes = dict(
+        ((int(u), int(c)), change) for (u, c), change in changes.items()
+        if change
+    )
+
+    if changes:
+        after_commit(lambda: balances_changed.send(
+            changes=changes, generations=generations
+        ))
+
+
+def _transfer_changes(sender_id, receiver_id, currency_id, amount):
+    return {
+        (sender_id, currency_id): -amount, (receiver_id, currency_id): amount
+    }
+
+
+def _journal(db, entries):
+    # (user_id, currency_id, change, kind, move_id) rows
+    db.executemany(
+        'INSERT INTO balance_change'
+        ' (user_id, currency_id, change, kind, move_id)'
+        ' VALUES (?, ?, ?, ?, ?)',
+        entries
+    )
+
+
+def _move_entries(kind, move_id, sender_id, receiver_id, currency_id,
+                  amount):
+    return [
+        (sender_id, currency_id, -amount, kind, move_id),
+        (receiver_id, currency_id, amount, kind, move_id),
+    ]
+
+
+@contextmanager
+def immediate(db):
+    """Run the block inside a ``BEGIN IMMEDIATE`` transaction.
+
+    The write lock is taken up front, so concurrent writers queue on
+    ``busy_timeout`` instead of failing half way through. The
+    transaction is committed when the block finishes and rolled back if
+    it raises.
+
+    The connection must not have a transaction open already: committing
+    it would commit the caller's unfinished work along with the block.
+
+    Inside a group commit batch (see :mod:`guapio.writer`) the batch
+    holds the lock already, and commits or rolls back the block with the
+    rest of the batch.
+    """
+    if in_batch():
+        yield db
+        return
+
+    if db.in_transaction:
+        raise RuntimeError('A transaction is already open.')
+
+    db.execute('BEGIN IMMEDIATE')
+
+    try:
+        yield db
+    except BaseException:
+        db.rollback()
+        raise
+    else:
+        db.commit()
+
+
+def parse_amount(value, scale=DEFAULT_SCALE):
+    """Convert a form value to a positive count of minor units of a
+    currency with ``scale`` decimals.
+
+    :raise LedgerError: if the value isn't a positive number with at
+        most ``scale`` decimals
+    """
+    try:
+        amount = to_minor(value, scale)
+    except MoneyError as e:
+        raise LedgerError(str(e))
+
+    if not amount > 0:
+        raise LedgerError('Amount must be greater than zero.')
+
+    return amount
+
+
+def _check_currency(db, currency_id):
+    """Return the scale of a currency."""
+    row = db.execute(
+        'SELECT scale FROM currency WHERE id = ?', (currency_id,)
+    ).fetchone()
+
+    if row is None:
+        raise LedgerError("Currency {0} doesn't exist.".format(currency_id))
+
+    return row[0]
+
+
+def _check_user(db, user_id):
+    if db.execute(
+        'SELECT 1 FROM user WHERE id = ?', (user_id,)
+    ).fetchone() is None:
+        raise LedgerError("User {0} doesn't exist.".format(user_id))
+
+
+def _credit(db, user_id, currency_id, amount):
+    db.execute(
+        'INSERT INTO balance (balance, user_id, currency_id) VALUES (?, ?, ?)'
+        ' ON CONFLICT (user_id, currency_id)'
+        ' DO UPDATE SET balance = balance + excluded.balance',
+        (amount, user_id, currency_id)
+    )
+
+
+def _debit(db, user_id, currency_id, amount):
+    cursor = db.execute(
+        'UPDATE balance SET balance = balance - ?'
+        ' WHERE user_id = ? AND currency_id = ? AND balance >= ?',
+        (amount, user_id, currency_id, amount)
+    )
+
+    if cursor.rowcount == 0:
+        raise InsufficientFunds('Insufficient funds.')
+
+
+def transfer(db, sender_id, receiver_id, currency_id, amount, comment=None):
+    """Move ``amount`` of a currency from one user to another.
+
+    Debits the sender, credits the receiver and appends the
+    ``user_move`` row in one transaction.
+
+    :return: the id of the new ``user_move`` row
+    :raise InsufficientFunds: if the sender's balance is too low
+    :raise LedgerError: if the transfer is invalid
+    """
+    if str(sender_id) == str(receiver_id):
+        raise LedgerError("Sender and receiver can't be the same user.")
+
+    with immediate(db):
+        amount = parse_amount(amount, _check_currency(db, currency_id))
+        _check_user(db, receiver_id)
+        _debit(db, sender_id, currency_id, amount)
+        _credit(db, receiver_id, currency_id, amount)
+        cursor = db.execute(
+            'INSERT INTO user_move'
+            ' (amount, comment, sender_id, receiver_id, currency_id)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            (amount, comment, sender_id, receiver_id, currency_id)
+        )
+        _journal(db, _move_entries(
+            'transfer', cursor.lastrowid, sender_id, receiver_id,
+            currency_id, amount
+        ))
+        changes = _transfer_changes(
+            sender_id, receiver_id, currency_id, amount
+        )
+        generations = _touch(db, changes, moves=True)
+
+    _notify(changes, generations)
+    return cursor.lastrowid
+
+
+def _parse_id(item, key):
+    try:
+        return int(item[key])
+    except KeyError:
+        raise LedgerError('{0} is required.'.format(key))
+    except (TypeError, ValueError):
+        raise LedgerError('{0} must be an integer.'.format(key))
+
+
+def _parse_transfer(item):
+    sender_id = _parse_id(item, 'sender_id')
+    receiver_id = _parse_id(item, 'receiver_id')
+    currency_id = _parse_id(item, 'currency_id')
+
+    if item.get('amount') in (None, ''):
+        raise LedgerError('amount is required.')
+
+    if sender_id == receiver_id:
+        raise LedgerError("Sender and receiver can't be the same user.")
+
+    # the amount is parsed once the scale of the currency is known
+    return (
+        sender_id, receiver_id, currency_id, item['amount'],
+        item.get('comment')
+    )
+
+
+def _chunks(values):
+    values = sorted(values)
+
+    for start in range(0, len(values), IN_CHUNK_SIZE):
+        yield values[start:start + IN_CHUNK_SIZE]
+
+
+def _currency_scales(db, ids):
+    scales = {}
+
+    for chunk in _chunks(ids):
+        scales.update(db.execute(
+            'SELECT id, scale FROM currency WHERE id IN ({0})'.format(
+                ', '.join('?' * len(chunk))
+            ),
+            chunk
+        ).fetchall())
+
+    return scales
+
+
+def _existing_ids(db, table, ids):
+    found = set()
+
+    for chunk in _chunks(ids):
+        found.update(row[0] for row in db.execute(
+            'SELECT id FROM {0} WHERE id IN ({1})'.format(
+                table, ', '.join('?' * len(chunk))
+            ),
+            chunk
+        ))
+
+    return found
+
+
+def _load_balances(db, user_ids):
+    balances = {}
+
+    for chunk in _chunks(user_ids):
+        for row in db.execute(
+            'SELECT user_id, currency_id, balance FROM balance'
+            ' WHERE user_id IN ({0})'.format(', '.join('?' * len(chunk))),
+            chunk
+        ):
+            balances[row[0], row[1]] = row[2]
+
+    return balances
+
+
+def transfer_many(db, transfers, atomic=False):
+    """Apply a batch of transfers in one transaction.
+
+    Each transfer is a mapping with ``sender_id``, ``receiver_id``,
+    ``currency_id``, ``amount`` and an optional ``comment``. Currencies,
+    users and sender balances are looked up once for the whole batch,
+    then the transfers are checked in order against the balances left
+    by the ones before them. Accepted transfers are written with one
+    ``executemany`` into ``user_move`` and one into ``balance``, with
+    the balance changes netted per user and currency.
+
+    :param atomic: reject the whole batch if any transfer is rejected
+    :return: one result per transfer, in order: ``{'status': 'ok',
+        'id': move_id}`` or ``{'status': 'error', 'error': message}``
+    """
+    results = [None] * len(transfers)
+    parsed = []
+
+    for index, item in enumerate(transfers):
+        try:
+            parsed.append((index, _parse_transfer(item)))
+        except LedgerError as e:
+            results[index] = {'status': 'error', 'error': str(e)}
+
+    senders = set(t[0] for _, t in parsed)
+    receivers = set(t[1] for _, t in parsed)
+    currency_ids = set(t[2] for _, t in parsed)
+
+    with immediate(db):
+        scales = _currency_scales(db, currency_ids)
+        users = _existing_ids(db, 'user', senders | receivers)
+        balances = _load_balances(db, senders)
+        deltas = {}
+        accepted = []
+
+        for index, (sender, receiver, currency, value, comment) in parsed:
+            try:
+                if currency not in scales:
+                    raise LedgerError(
+                        "Currency {0} doesn't exist.".format(currency)
+                    )
+
+                amount = parse_amount(value, scales[currency])
+
+                if sender not in users:
+                    raise LedgerError("User {0} doesn't exist.".format(sender))
+
+                if receiver not in users:
+                    raise LedgerError(
+                        "User {0} doesn't exist.".format(receiver)
+                    )
+
+                if balances.get((sender, currency), 0) < amount:
+                    raise InsufficientFunds('Insufficient funds.')
+            except LedgerError as e:
+                results[index] = {'status': 'error', 'error': str(e)}
+                continue
+
+            for key, change in (
+                ((sender, currency), -amount), ((receiver, currency), amount)
+            ):
+                balances[key] = balances.get(key, 0) + change
+                deltas[key] = deltas.get(key, 0) + change
+
+            accepted.append(
+                (index, (amount, comment, sender, receiver, currency))
+            )
+
+        if not accepted or atomic and len(accepted) != len(transfers):
+            for index, row in accepted:
+                results[index] = {
+                    'status': 'error',
+                    'error': 'Another transfer in the batch was rejected.'
+                }
+
+            return results
+
+        db.executemany(
+            'INSERT INTO user_move'
+            ' (amount, comment, sender_id, receiver_id, currency_id)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            [row for index, row in accepted]
+        )
+        db.executemany(
+            'INSERT INTO balance (balance, user_id, currency_id)'
+            ' VALUES (?, ?, ?)'
+            ' ON CONFLICT (user_id, currency_id)'
+            ' DO UPDATE SET balance = balance + excluded.balance',
+            [
+                (delta, user_id, currency_id)
+                for (user_id, currency_id), delta in deltas.items() if delta
+            ]
+        )
+        generations = _touch(db, deltas, moves=True)
+        # the transaction holds the write lock, so the new ids are the
+        # last len(accepted) values of the sequence
+        last_id = db.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'user_move'"
+        ).fetchone()[0]
+        first_id = last_id - len(accepted) + 1
+        entries = []
+
+        for offset, (index, row) in enumerate(accepted):
+            amount, comment, sender, receiver, currency = row
+            entries.extend(_move_entries(
+                'transfer', first_id + offset, sender, receiver, currency,
+                amount
+            ))
+
+        _journal(db, entries)
+
+    _notify(deltas, generations)
+
+    for offset, (index, row) in enumerate(accepted):
+        results[index] = {'status': 'ok', 'id': first_id + offset}
+
+    return results
+
+
+def deposit(db, user_id, currency_id, amount):
+    """Add ``amount`` of a currency to a user's balance."""
+    with immediate(db):
+        amount = parse_amount(amount, _check_currency(db, currency_id))
+        _credit(db, user_id, currency_id, amount)
+        _journal(db, [(user_id, currency_id, amount, 'deposit', None)])
+        changes = {(user_id, currency_id): amount}
+        generations = _touch(db, changes)
+
+    _notify(changes, generations)
+
+
+def set_balance(db, balance_id, value):
+    """Overwrite the value of a balance row."""
+    with immediate(db):
+        row = db.execute(
+            'SELECT user_id, currency_id, balance, scale'
+            ' FROM balance b JOIN currency c ON b.currency_id = c.id'
+            ' WHERE b.id = ?',
+            (balance_id,)
+        ).fetchone()
+
+        if row is None:
+            raise LedgerError(
+                "balance id {0} doesn't exist.".format(balance_id)
+            )
+
+        try:
+            value = to_minor(value, row['scale'], 'Balance')
+        except MoneyError as e:
+            raise LedgerError(str(e))
+
+        if value < 0:
+            raise LedgerError("Balance can't be negative.")
+
+        db.execute(
+            'UPDATE balance SET balance = ? WHERE id = ?', (value, balance_id)
+        )
+        changes = {
+            (row['user_id'], row['currency_id']): value - row['balance']
+        }
+
+        if value != row['balance']:
+            _journal(db, [(
+                row['user_id'], row['currency_id'], value - row['balance'],
+                'adjustment', None
+            )])
+
+        generations = _touch(db, changes)
+
+    _notify(changes, generations)
+
+
+def exchange(db, user_id, from_currency_id, to_currency_id, amount,
+             min_proceeds=None):
+    """Convert ``amount`` of one of a user's currencies into another, at
+    the rates read in the same transaction (see
+    :func:`guapio.money.convert`). Every rate is a price in the base
+    currency, so any pair converts through it.
+
+    :param min_proceeds: the least the user accepts to get of the
+        target currency, a form value like ``amount``, usually what they
+        were quoted
+    :return: ``(exchange_id, proceeds)``
+    :raise InsufficientFunds: if the user doesn't hold ``amount``
+    :raise RateChanged: if the proceeds are below ``min_proceeds``
+    """
+    try:
+        from_currency_id = int(from_currency_id)
+        to_currency_id = int(to_currency_id)
+    except (TypeError, ValueError):
+        raise LedgerError('Currency must be an integer.')
+
+    if from_currency_id == to_currency_id:
+        raise LedgerError("Can't exchange a currency for itself.")
+
+    with immediate(db):
+        currencies = dict(
+            (row['id'], row) for row in db.execute(
+                'SELECT id, code, scale, purchase_rate, sale_rate'
+                ' FROM currency WHERE id IN (?, ?)',
+                (from_currency_id, to_currency_id)
+            )
+        )
+
+        for currency_id in (from_currency_id, to_currency_id):
+            if currency_id not in currencies:
+                raise LedgerError(
+                    "Currency {0} doesn't exist.".format(currency_id)
+                )
+
+        source = currencies[from_currency_id]
+        target = currencies[to_currency_id]
+        amount = parse_amount(amount, source['scale'])
+
+        if min_proceeds is not None:
+            min_proceeds = parse_amount(min_proceeds, target['scale'])
+
+        if not target['sale_rate'] > 0:
+            raise LedgerError("{0} can't be bought.".format(target['code']))
+
+        proceeds = convert(
+            amount, source['scale'], target['scale'],
+            source['purchase_rate'], target['sale_rate']
+        )
+
+        if not proceeds > 0:
+            raise LedgerError('Amount is too small to exchange.')
+
+        if min_proceeds is not None and proceeds < min_proceeds:
+            raise RateChanged('The rates changed, please check the quote.')
+
+        _debit(db, user_id, source['id'], amount)
+        _credit(db, user_id, target['id'], proceeds)
+        exchange_id = db.execute(
+            'INSERT INTO exchange'
+            ' (user_id, from_currency_id, to_currency_id, amount, proceeds,'
+            ' purchase_rate, sale_rate)'
+            ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (
+                user_id, source['id'], target['id'], amount, proceeds,
+                source['purchase_rate'], target['sale_rate']
+            )
+        ).lastrowid
+        _journal(db, [
+            (user_id, source['id'], -amount, 'exchange', None),
+            (user_id, target['id'], proceeds, 'exchange', None),
+        ])
+        changes = {
+            (user_id, source['id']): -amount, (user_id, target['id']): proceeds
+        }
+        generations = _touch(db, changes)
+
+    _notify(changes, generations)
+    return exchange_id, proceeds
+
+
+def remove_balance(db, balance_id):
+    """Delete a balance row, whatever it holds."""
+    with immediate(db):
+        row = db.execute(
+            'SELECT user_id, currency_id, balance FROM balance WHERE id = ?',
+            (balance_id,)
+        ).fetchone()
+
+        if row is None:
+            raise LedgerError(
+                "balance id {0} doesn't exist.".format(balance_id)
+            )
+
+        db.execute('DELETE FROM balance WHERE id = ?', (balance_id,))
+
+        if row['balance']:
+            _journal(db, [(
+                row['user_id'], row['currency_id'], -row['balance'],
+                'adjustment', None
+            )])
+
+        changes = {(row['user_id'], row['currency_id']): -row['balance']}
+        generations = _touch(db, changes)
+
+    _notify(changes, generations)
+
+
+def _get_move(db, move_id):
+    move = db.execute(
+        'SELECT amount, sender_id, receiver_id, currency_id, scale,'
+        ' settlement_id'
+        ' FROM user_move m JOIN currency c ON m.currency_id = c.id'
+        ' WHERE m.id = ?',
+        (move_id,)
+    ).fetchone()
+
+    if move is None:
+        # only settled transfers are ever archived
+        archived = db.execute(
+            'SELECT 1 FROM user_move_archive WHERE id = ?', (move_id,)
+        ).fetchone()
+
+        if archived is None:
+            raise LedgerError(
+                "user_move id {0} doesn't exist.".format(move_id)
+            )
+
+    if move is None or move['settlement_id'] is not None:
+        raise AlreadySettled(
+            'Transfer {0} is settled and can no longer change.'.format(move_id)
+        )
+
+    return move
+
+
+def amend(db, move_id, amount):
+    """Change the amount of a transfer, moving only the difference."""
+    with immediate(db):
+        move = _get_move(db, move_id)
+        amount = parse_amount(amount, move['scale'])
+        delta = amount - move['amount']
+
+        if delta > 0:
+            _debit(db, move['sender_id'], move['currency_id'], delta)
+            _credit(db, move['receiver_id'], move['currency_id'], delta)
+        elif delta < 0:
+            _debit(db, move['receiver_id'], move['currency_id'], -delta)
+            _credit(db, move['sender_id'], move['currency_id'], -delta)
+
+        db.execute(
+            'UPDATE user_move SET amount = ? WHERE id = ?', (amount, move_id)
+        )
+
+        if delta:
+            _journal(db, _move_entries(
+                'amend', move_id, move['sender_id'], move['receiver_id'],
+                move['currency_id'], delta
+            ))
+
+        changes = _transfer_changes(
+            move['sender_id'], move['receiver_id'], move['currency_id'], delta
+        )
+        generations = _touch(db, changes, moves=True)
+
+    _notify(changes, generations)
+
+
+def reverse(db, move_id):
+    """Undo a transfer and remove it from the log."""
+    with immediate(db):
+        move = _get_move(db, move_id)
+        _debit(db, move['receiver_id'], move['currency_id'], move['amount'])
+        _credit(db, move['sender_id'], move['currency_id'], move['amount'])
+        db.execute('DELETE FROM user_move WHERE id = ?', (move_id,))
+        _journal(db, _move_entries(
+            'reverse', move_id, move['receiver_id'], move['sender_id'],
+            move['currency_id'], move['amount']
+        ))
+        changes = _transfer_changes(
+            move['receiver_id'], move['sender_id'], move['currency_id'],
+            move['amount']
+        )
+        generations = _touch(db, changes, moves=True)
+
+    _notify(changes, generations)
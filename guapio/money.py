@@ -0,0 +1,439 @@
+"""Exact amounts of money.
+
+Amounts are stored as integers of the currency's minor unit: with a
+``scale`` of 2, ``12.50`` is stored as ``1250``. Sums and comparisons
+are then exact, and cheaper for SQLite than floats. Exchange rates are
+stored the same way with a fixed scale of :data:`RATE_SCALE`.
+
+Values coming from forms or batches are parsed as decimals, never as
+floats, and rejected if they have more decimals than the currency has.
+The views carry amounts as :class:`Money`, which keeps the minor units
+together with the scale they are counted in.
+"""
+import os
+import sqlite3
+from decimal import ROUND_HALF_EVEN, Decimal, InvalidOperation
+from fractions import Fraction
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+#: Decimals of a currency's minor unit unless it says otherwise.
+DEFAULT_SCALE = 2
+
+#: Largest scale a currency can have.
+MAX_SCALE = 8
+
+#: Decimals kept of exchange rates.
+RATE_SCALE = 8
+
+#: Rows converted per batch by ``flask migrate-money``.
+MIGRATE_BATCH_SIZE = 10000
+
+
+class MoneyError(ValueError):
+    """A value isn't a valid amount. The message is meant to be shown
+    to the user."""
+
+
+def to_minor(value, scale=DEFAULT_SCALE, name='Amount'):
+    """Convert an amount in whole units of a currency, a decimal string
+    or a number, to an integer count of its minor units: with a
+    ``scale`` of 2, ``'12.5'`` and ``12.5`` give ``1250`` and ``12``
+    gives ``1200``. Numbers are read like their decimal string.
+
+    :param name: what the value is, for error messages
+    :raise MoneyError: if the value isn't a number or has more than
+        ``scale`` decimals
+    """
+    if isinstance(value, Money):
+        if value.scale != scale:
+            raise MoneyError('{0} has the wrong currency scale.'.format(name))
+
+        return value.minor
+
+    if isinstance(value, bool):
+        raise MoneyError('{0} must be a number.'.format(name))
+
+    try:
+        # floats go through their shortest repr, so 0.1 is 0.1 exactly
+        number = Decimal(str(value).strip())
+    except (InvalidOperation, TypeError):
+        raise MoneyError('{0} must be a number.'.format(name))
+
+    if not number.is_finite():
+        raise MoneyError('{0} must be a number.'.format(name))
+
+    minor = number.scaleb(scale)
+
+    if minor != minor.to_integral_value():
+        raise MoneyError('{0} can have at most {1} decimals.'.format(
+            name, scale
+        ))
+
+    return int(minor)
+
+
+def format_minor(minor, scale=DEFAULT_SCALE):
+    """Return an integer count of minor units as a decimal string."""
+    if not scale:
+        return str(minor)
+
+    sign = '-' if minor < 0 else ''
+    units, cents = divmod(abs(minor), 10 ** scale)
+    return '{0}{1}.{2:0{3}d}'.format(sign, units, cents, scale)
+
+
+def parse_rate(value, name='Rate'):
+    """Convert an exchange rate to its stored integer form.
+
+    :raise MoneyError: if the rate isn't a number greater than zero
+    """
+    rate = to_minor(value, RATE_SCALE, name)
+
+    if not rate > 0:
+        raise MoneyError('{0} must be greater than zero.'.format(name))
+
+    return rate
+
+
+def format_rate(minor):
+    """Return a stored exchange rate as a decimal string, without
+    trailing zeros."""
+    text = format_minor(minor, RATE_SCALE)
+    return text.rstrip('0').rstrip('.') if '.' in text else text
+
+
+def convert(minor, from_scale, to_scale, purchase_rate, sale_rate):
+    """Convert an amount of one currency to another, exactly: sold at
+    the ``purchase_rate`` of the first and bought at the ``sale_rate`` of
+    the second, both stored rates. Rounded down to the minor unit, so a
+    conversion never makes money out of nothing.
+    """
+    return (
+        minor * purchase_rate * 10 ** to_scale //
+        (sale_rate * 10 ** from_scale)
+    )
+
+
+def round_to_minor(value, scale=DEFAULT_SCALE):
+    """Round a float to the nearest count of minor units, half to even.
+    Only for converting data stored as floats."""
+    return int(
+        Decimal(repr(value)).scaleb(scale)
+        .quantize(Decimal(1), rounding=ROUND_HALF_EVEN)
+    )
+
+
+class Money(object):
+    """An amount as an integer count of minor units and the scale of its
+    currency. Amounts of different scales can't be mixed.
+    """
+
+    __slots__ = ('minor', 'scale')
+
+    def __init__(self, minor=0, scale=DEFAULT_SCALE):
+        self.minor = minor
+        self.scale = scale
+
+    @classmethod
+    def parse(cls, value, scale=DEFAULT_SCALE, name='Amount'):
+        """Parse a form or batch value, see :func:`to_minor`."""
+        return cls(to_minor(value, scale, name), scale)
+
+    def _other(self, other):
+        if isinstance(other, Money):
+            if other.scale != self.scale:
+                raise ValueError("Can't mix amounts of different scales.")
+
+            return other.minor
+
+        if isinstance(other, int) and not isinstance(other, bool):
+            # whole units, like to_minor reads them
+            return other * 10 ** self.scale
+
+        return NotImplemented
+
+    def __add__(self, other):
+        minor = self._other(other)
+
+        if minor is NotImplemented:
+            return minor
+
+        return Money(self.minor + minor, self.scale)
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        minor = self._other(other)
+
+        if minor is NotImplemented:
+            return minor
+
+        return Money(self.minor - minor, self.scale)
+
+    def __neg__(self):
+        return Money(-self.minor, self.scale)
+
+    def __abs__(self):
+        return Money(abs(self.minor), self.scale)
+
+    def __eq__(self, other):
+        if isinstance(other, Money) and other.scale != self.scale:
+            return False
+
+        minor = self._other(other)
+        return minor if minor is NotImplemented else self.minor == minor
+
+    def __lt__(self, other):
+        minor = self._other(other)
+        return minor if minor is NotImplemented else self.minor < minor
+
+    def __le__(self, other):
+        minor = self._other(other)
+        return minor if minor is NotImplemented else self.minor <= minor
+
+    def __gt__(self, other):
+        minor = self._other(other)
+        return minor if minor is NotImplemented else self.minor > minor
+
+    def __ge__(self, other):
+        minor = self._other(other)
+        return minor if minor is NotImplemented else self.minor >= minor
+
+    def __hash__(self):
+        # equal to the hash of the int it is equal to
+        return hash(Fraction(self.minor, 10 ** self.scale))
+
+    def __bool__(self):
+        return self.minor != 0
+
+    def __float__(self):
+        return self.minor / 10 ** self.scale
+
+    def __str__(self):
+        return format_minor(self.minor, self.scale)
+
+    def __repr__(self):
+        return 'Money({0!r}, {1!r})'.format(self.minor, self.scale)
+
+
+def money_filter(minor, scale=DEFAULT_SCALE):
+    """Template filter showing a stored amount, ``None`` being zero."""
+    if isinstance(minor, Money):
+        return str(minor)
+
+    return format_minor(minor or 0, scale)
+
+
+#: Columns stored as floats before, as (table, column, scale or None
+#: for the currency's scale).
+FLOAT_COLUMNS = {
+    ('currency', 'purchase_rate'): RATE_SCALE,
+    ('currency', 'sale_rate'): RATE_SCALE,
+    ('currency_rate', 'purchase_rate'): RATE_SCALE,
+    ('currency_rate', 'sale_rate'): RATE_SCALE,
+    ('balance', 'balance'): None,
+    ('user_move', 'amount'): None,
+}
+
+#: Tables copied from a query of the old database rather than as they
+#: are. The old schema let a user hold several balances of a currency,
+#: the new one a single one, so they are added up.
+MERGED_TABLES = {
+    'balance': (
+        'SELECT MIN(id) AS id, SUM(balance) AS balance, currency_id,'
+        ' user_id, MIN(created) AS created FROM old.balance'
+        ' GROUP BY user_id, currency_id'
+    ),
+}
+
+
+def _columns(db, schema, table):
+    return [
+        row[1] for row in
+        db.execute('PRAGMA {0}.table_info({1})'.format(schema, table))
+    ]
+
+
+def _copy_table(db, table, scale, batch_size):
+    """Copy a table of the old database into the new one, converting its
+    float columns, and return the number of rows copied."""
+    new_columns = _columns(db, 'main', table)
+    columns = [c for c in _columns(db, 'old', table) if c in new_columns]
+    convert = [
+        index for index, column in enumerate(columns)
+        if (table, column) in FLOAT_COLUMNS
+    ]
+    names = ', '.join(columns)
+    source = 'old.{0}'.format(table)
+
+    if table in MERGED_TABLES:
+        source = '({0})'.format(MERGED_TABLES[table])
+
+    if not convert:
+        return db.execute(
+            'INSERT INTO main.{0} ({1}) SELECT {1} FROM {2}'.format(
+                table, names, source
+            )
+        ).rowcount
+
+    scales = dict(
+        (index, FLOAT_COLUMNS[table, columns[index]] or scale)
+        for index in convert
+    )
+    insert = 'INSERT INTO main.{0} ({1}) VALUES ({2})'.format(
+        table, names, ', '.join('?' * len(columns))
+    )
+    cursor = db.execute(
+        'SELECT {0} FROM {1} ORDER BY {2}'.format(
+            names, source, 'id' if table in MERGED_TABLES else 'rowid'
+        )
+    )
+    copied = 0
+
+    while True:
+        rows = cursor.fetchmany(batch_size)
+
+        if not rows:
+            break
+
+        batch = []
+
+        for row in rows:
+            row = list(row)
+
+            for index, column_scale in scales.items():
+                if row[index] is not None:
+                    row[index] = round_to_minor(row[index], column_scale)
+
+            batch.append(row)
+
+        db.executemany(insert, batch)
+        copied += len(batch)
+
+    return copied
+
+
+def migrate(database, schema, scale=DEFAULT_SCALE,
+            batch_size=MIGRATE_BATCH_SIZE, echo=lambda message: None):
+    """Rebuild a database stored with float amounts into the integer
+    schema, and keep the old file next to it as ``<database>.float``.
+
+    The new database is built beside the old one from ``schema`` and
+    filled table by table in batches of ``batch_size`` rows, in one
+    transaction, then moved into place. Run it with the app stopped.
+
+    Balances of the same user and currency are merged into one (see
+    :data:`MERGED_TABLES`), and each balance gets an ``opening`` entry in
+    the ``balance_change`` journal, so the journal adds up to it.
+
+    :param scale: scale of every existing currency
+    :return: ``False`` if the database was migrated already
+    """
+    old = sqlite3.connect(database)
+
+    try:
+        types = dict(
+            (row[1], row[2].upper())
+            for row in old.execute('PRAGMA table_info(balance)')
+        )
+
+        if types.get('balance') == 'INTEGER':
+            return False
+
+        # fold the write-ahead log in, so the file holds everything
+        old.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    finally:
+        old.close()
+
+    path = database + '.migrating'
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    db = sqlite3.connect(path, isolation_level=None)
+
+    try:
+        db.executescript(schema)
+        db.execute('ATTACH DATABASE ? AS old', (database,))
+        old_tables = set(row[0] for row in db.execute(
+            "SELECT name FROM old.sqlite_master WHERE type = 'table'"
+        ))
+        # virtual tables, and the shadow tables they keep their data in,
+        # are filled by the triggers of the tables they index
+        plain_tables = set(
+            row[1] for row in db.execute('PRAGMA main.table_list')
+            if row[2] == 'table'
+        )
+        db.execute('BEGIN')
+
+        for (table,) in db.execute(
+            "SELECT name FROM main.sqlite_master WHERE type = 'table'"
+            " AND name != 'sqlite_sequence' ORDER BY rowid"
+        ).fetchall():
+            if table not in old_tables or table not in plain_tables:
+                continue
+
+            if table == 'currency_rate':
+                # copying currencies started a history of their own
+                db.execute('DELETE FROM currency_rate')
+
+            echo('{0}: {1} rows'.format(
+                table, _copy_table(db, table, scale, batch_size)
+            ))
+
+        if 'currency' in old_tables:
+            db.execute('UPDATE currency SET scale = ?', (scale,))
+
+        if 'balance' in old_tables and 'balance_change' not in old_tables:
+            echo('balance_change: {0} rows'.format(db.execute(
+                'INSERT INTO balance_change'
+                ' (user_id, currency_id, change, kind, created)'
+                " SELECT user_id, currency_id, balance, 'opening', created"
+                ' FROM balance WHERE balance != 0 ORDER BY id'
+            ).rowcount))
+
+        db.execute('COMMIT')
+        db.execute('DETACH DATABASE old')
+    except BaseException:
+        db.close()
+        os.remove(path)
+        raise
+
+    db.close()
+    os.replace(database, database + '.float')
+    os.replace(path, database)
+    return True
+
+
+@click.command('migrate-money')
+@click.option('--scale', type=click.IntRange(0, MAX_SCALE),
+              default=DEFAULT_SCALE, show_default=True,
+              help='Decimals of the existing currencies.')
+@click.option('--batch-size', type=int, default=MIGRATE_BATCH_SIZE,
+              show_default=True, help='Rows converted at a time.')
+@with_appcontext
+def migrate_money_command(scale, batch_size):
+    """Convert a database with float amounts to integer minor units.
+    Stop the app first."""
+    with current_app.open_resource('schema.sql') as f:
+        schema = f.read().decode('utf8')
+
+    database = current_app.config['DATABASE']
+
+    if migrate(database, schema, scale, batch_size, click.echo):
+        click.echo('Migrated, the old database is {0}.float.'.format(
+            database
+        ))
+    else:
+        click.echo('The database already stores integer amounts.')
+
+
+def init_app(app):
+    """Register the money filters and migration command with the Flask
+    app."""
+    app.add_template_filter(money_filter, 'money')
+    app.add_template_filter(format_rate, 'rate')
+    app.cli.add_command(migrate_money_command)
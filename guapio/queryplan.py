@@ -0,0 +1,182 @@
+"""Query plan regression check.
+
+Collects every SQL statement the blueprints run, prepares each one with
+``EXPLAIN QUERY PLAN`` against an empty database built from
+``schema.sql`` and reports the ones that fall back to a full table scan
+or to a temporary B-tree sort. Run it with ``flask check-query-plans``;
+it exits with an error status when a statement fails the check.
+
+Batch jobs that read a whole table on purpose mark the statement with
+a ``/* full scan */`` comment and are skipped. Virtual tables, like the
+full-text index, pass when their module uses a constraint.
+"""
+import ast
+import importlib
+import inspect
+import sqlite3
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from guapio.datatables import Listing
+
+#: Modules whose SQL statements are checked.
+MODULES = (
+    'guapio.archive',
+    'guapio.auth',
+    'guapio.balance',
+    'guapio.blog',
+    'guapio.currency',
+    'guapio.events',
+    'guapio.exchange',
+    'guapio.export',
+    'guapio.idempotency',
+    'guapio.ledger',
+    'guapio.search',
+    'guapio.settlement',
+    'guapio.statement',
+    'guapio.user_move',
+    'guapio.valuation',
+)
+
+#: Marker for statements that are meant to read a whole table.
+FULL_SCAN_MARKER = '/* full scan */'
+
+
+def collect_statements(module):
+    """Return ``(location, sql)`` for the statements of a module: the
+    literal strings passed to ``execute`` / ``executemany``, and the
+    queries of its :class:`~guapio.datatables.Listing` objects.
+    """
+    statements = []
+    tree = ast.parse(inspect.getsource(module))
+
+    for node in ast.walk(tree):
+        if (
+            isinstance(node, ast.Call)
+            and isinstance(node.func, ast.Attribute)
+            and node.func.attr in ('execute', 'executemany')
+            and node.args
+            and isinstance(node.args[0], ast.Constant)
+            and isinstance(node.args[0].value, str)
+        ):
+            statements.append((
+                '{0}:{1}'.format(module.__name__, node.lineno),
+                node.args[0].value
+            ))
+
+    for name, value in sorted(vars(module).items()):
+        if isinstance(value, Listing):
+            for sql in value.statements():
+                statements.append(
+                    ('{0}.{1}'.format(module.__name__, name), sql)
+                )
+
+    return statements
+
+
+def explain(db, sql):
+    """Return the detail lines of the query plan of a statement. Every
+    parameter is bound to ``NULL``."""
+    return [
+        row[3] for row in
+        db.execute('EXPLAIN QUERY PLAN ' + sql, (None,) * sql.count('?'))
+    ]
+
+
+def check_plan(plan, allow_scan=()):
+    """Return the problems found in a query plan.
+
+    :param plan: the detail lines returned by :func:`explain`
+    :param allow_scan: tables (or aliases) that may be read in full
+    """
+    problems = []
+
+    for detail in plan:
+        if detail.startswith('USE TEMP B-TREE'):
+            problems.append(detail)
+        elif detail == 'SCAN CONSTANT ROW':
+            # a SELECT without FROM reads no table
+            continue
+        elif detail.startswith('SCAN ') and ' USING ' not in detail:
+            table = detail.split()[1]
+
+            # a virtual table module reports the constraints it uses as
+            # 'INDEX <number>:<string>', and nothing after ':' when none
+            index = detail.partition(' VIRTUAL TABLE INDEX ')[2]
+
+            if index.partition(':')[2]:
+                continue
+
+            if table not in allow_scan:
+                problems.append(detail)
+
+    return problems
+
+
+def check_query_plans(schema, modules=MODULES, allow_scan=()):
+    """Check the statements of ``modules`` against ``schema``.
+
+    :return: a list of ``(location, sql, problems)`` for the statements
+        that failed
+    """
+    db = sqlite3.connect(':memory:')
+    db.executescript(schema)
+    failures = []
+
+    try:
+        for name in modules:
+            module = importlib.import_module(name)
+
+            for location, sql in collect_statements(module):
+                if FULL_SCAN_MARKER in sql:
+                    continue
+
+                try:
+                    problems = check_plan(explain(db, sql), allow_scan)
+                except sqlite3.Error as e:
+                    problems = [str(e)]
+
+                if problems:
+                    failures.append((location, sql, problems))
+    finally:
+        db.close()
+
+    return failures
+
+
+@click.command('check-query-plans')
+@with_appcontext
+def check_query_plans_command():
+    """Fail if a query falls back to a table scan or temp B-tree."""
+    with current_app.open_resource('schema.sql') as f:
+        schema = f.read().decode('utf8')
+
+    failures = check_query_plans(
+        schema, allow_scan=current_app.config['QUERY_PLAN_ALLOW_SCAN']
+    )
+
+    for location, sql, problems in failures:
+        click.echo('{0}: {1}'.format(location, sql))
+
+        for problem in problems:
+            click.echo('    ' + problem)
+
+    if failures:
+        raise click.ClickException(
+            '{0} statement(s) failed the query plan check.'.format(
+                len(failures)
+            )
+        )
+
+    click.echo('All query plans use indexes.')
+
+
+def init_app(app):
+    """Register the query plan check with the Flask app."""
+    # currency and sqlite_sequence are a handful of rows, read in full
+    app.config.setdefault(
+        'QUERY_PLAN_ALLOW_SCAN', ('c', 'currency', 'sqlite_sequence')
+    )
+    app.cli.add_command(check_query_plans_command)
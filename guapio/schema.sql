@@ -16,6 +16,34 @@ CREATE TABLE post (
     created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (author_id) REFERENCES user (id)
 );
+CREATE INDEX post_created_idx ON post (created);
+
+-- full-text index of the posts, kept in sync by the triggers below
+DROP TABLE IF EXISTS post_fts;
+CREATE VIRTUAL TABLE post_fts USING fts5(
+    title, body, content='post', content_rowid='id',
+    tokenize='unicode61 remove_diacritics 2'
+);
+-- matches in the title rank higher than in the body
+INSERT INTO post_fts (post_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0)');
+
+CREATE TRIGGER post_fts_insert AFTER INSERT ON post
+BEGIN
+    INSERT INTO post_fts (rowid, title, body)
+    VALUES (new.id, new.title, new.body);
+END;
+CREATE TRIGGER post_fts_delete AFTER DELETE ON post
+BEGIN
+    INSERT INTO post_fts (post_fts, rowid, title, body)
+    VALUES ('delete', old.id, old.title, old.body);
+END;
+CREATE TRIGGER post_fts_update AFTER UPDATE OF title, body ON post
+BEGIN
+    INSERT INTO post_fts (post_fts, rowid, title, body)
+    VALUES ('delete', old.id, old.title, old.body);
+    INSERT INTO post_fts (rowid, title, body)
+    VALUES (new.id, new.title, new.body);
+END;
 
 DROP TABLE IF EXISTS currency;
 CREATE TABLE currency (
@@ -23,31 +51,234 @@ CREATE TABLE currency (
     created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     title TEXT NOT NULL,
     code TEXT NOT NULL,
-    purchase_rate FLOAT NOT NULL,
-    sale_rate FLOAT NOT NULL
+    -- decimals of the minor unit amounts are counted in
+    scale INTEGER NOT NULL DEFAULT 2,
+    -- rates are stored times 10^8
+    purchase_rate INTEGER NOT NULL,
+    sale_rate INTEGER NOT NULL
+);
+CREATE INDEX currency_created_idx ON currency (created);
+
+DROP TABLE IF EXISTS currency_rate;
+CREATE TABLE currency_rate (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    currency_id INTEGER NOT NULL,
+    purchase_rate INTEGER NOT NULL,
+    sale_rate INTEGER NOT NULL,
+    created TIMESTAMP NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+    FOREIGN KEY (currency_id) REFERENCES currency (id)
 );
+CREATE INDEX currency_rate_currency_idx ON currency_rate (currency_id, created);
+
+-- every rate a currency ever had is appended, whoever writes it
+CREATE TRIGGER currency_rate_insert AFTER INSERT ON currency
+BEGIN
+    INSERT INTO currency_rate (currency_id, purchase_rate, sale_rate)
+    VALUES (new.id, new.purchase_rate, new.sale_rate);
+END;
+CREATE TRIGGER currency_rate_update AFTER UPDATE OF purchase_rate, sale_rate ON currency
+WHEN new.purchase_rate IS NOT old.purchase_rate OR new.sale_rate IS NOT old.sale_rate
+BEGIN
+    INSERT INTO currency_rate (currency_id, purchase_rate, sale_rate)
+    VALUES (new.id, new.purchase_rate, new.sale_rate);
+END;
+CREATE TRIGGER currency_rate_append_only BEFORE UPDATE ON currency_rate
+BEGIN
+    SELECT RAISE(ABORT, 'currency_rate is append-only');
+END;
 
 DROP TABLE IF EXISTS balance;
 CREATE TABLE balance (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
-    balance FLOAT NOT NULL DEFAULT 0.0,
+    -- in minor units of the currency
+    balance INTEGER NOT NULL DEFAULT 0,
     currency_id INTEGER NOT NULL,
     user_id INTEGER NOT NULL,
     created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (currency_id) REFERENCES currency (id),
     FOREIGN KEY (user_id) REFERENCES user (id)
 );
+CREATE UNIQUE INDEX balance_user_currency_idx ON balance (user_id, currency_id);
+-- covers the balances listing, which reads in created order
+CREATE INDEX balance_created_idx ON balance (created, id, user_id, currency_id, balance);
+CREATE INDEX balance_currency_idx ON balance (currency_id, created);
 
 DROP TABLE IF EXISTS user_move;
 CREATE TABLE user_move (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
-    amount FLOAT NOT NULL,
+    -- in minor units of the currency
+    amount INTEGER NOT NULL,
     comment TEXT,
     currency_id INTEGER NOT NULL,
     sender_id INTEGER NOT NULL,
     receiver_id INTEGER NOT NULL,
     created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- set once the transfer is netted into a settlement
+    settlement_id INTEGER,
+    FOREIGN KEY (currency_id) REFERENCES currency (id),
+    FOREIGN KEY (sender_id) REFERENCES user (id),
+    FOREIGN KEY (receiver_id) REFERENCES user (id),
+    FOREIGN KEY (settlement_id) REFERENCES settlement (id)
+);
+-- covers the transfers listing, which reads in created order
+CREATE INDEX user_move_created_idx ON user_move (created, id, sender_id, receiver_id, currency_id, amount, comment);
+CREATE INDEX user_move_sender_idx ON user_move (sender_id, created);
+CREATE INDEX user_move_receiver_idx ON user_move (receiver_id, created);
+CREATE INDEX user_move_unsettled_idx ON user_move (created) WHERE settlement_id IS NULL;
+
+DROP TABLE IF EXISTS settlement;
+CREATE TABLE settlement (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- window of the settled transfers, NULL when open ended
+    window_start TIMESTAMP,
+    window_end TIMESTAMP,
+    moves INTEGER NOT NULL
+);
+
+DROP TABLE IF EXISTS settlement_entry;
+CREATE TABLE settlement_entry (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    settlement_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    currency_id INTEGER NOT NULL,
+    -- net received over the window, negative when the user paid out
+    -- more, in minor units of the currency
+    amount INTEGER NOT NULL,
+    FOREIGN KEY (settlement_id) REFERENCES settlement (id),
+    FOREIGN KEY (user_id) REFERENCES user (id),
+    FOREIGN KEY (currency_id) REFERENCES currency (id)
+);
+CREATE INDEX settlement_entry_settlement_idx ON settlement_entry (settlement_id);
+
+-- settled transfers older than the archive horizon, moved out of
+-- user_move with their ids by `flask archive-moves`
+DROP TABLE IF EXISTS user_move_archive;
+CREATE TABLE user_move_archive (
+    id INTEGER PRIMARY KEY,
+    amount INTEGER NOT NULL,
+    comment TEXT,
+    currency_id INTEGER NOT NULL,
+    sender_id INTEGER NOT NULL,
+    receiver_id INTEGER NOT NULL,
+    created TIMESTAMP NOT NULL,
+    settlement_id INTEGER NOT NULL,
     FOREIGN KEY (currency_id) REFERENCES currency (id),
     FOREIGN KEY (sender_id) REFERENCES user (id),
-    FOREIGN KEY (receiver_id) REFERENCES user (id)
-);
\ No newline at end of file
+    FOREIGN KEY (receiver_id) REFERENCES user (id),
+    FOREIGN KEY (settlement_id) REFERENCES settlement (id)
+);
+CREATE INDEX user_move_archive_created_idx ON user_move_archive (created);
+CREATE INDEX user_move_archive_sender_idx ON user_move_archive (sender_id, created);
+CREATE INDEX user_move_archive_receiver_idx ON user_move_archive (receiver_id, created);
+
+-- totals of the archived transfers per user, currency and month
+DROP TABLE IF EXISTS user_move_month;
+CREATE TABLE user_move_month (
+    user_id INTEGER NOT NULL,
+    -- YYYY-MM
+    month TEXT NOT NULL,
+    currency_id INTEGER NOT NULL,
+    -- in minor units of the currency
+    sent INTEGER NOT NULL DEFAULT 0,
+    received INTEGER NOT NULL DEFAULT 0,
+    moves INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, month, currency_id),
+    FOREIGN KEY (user_id) REFERENCES user (id),
+    FOREIGN KEY (currency_id) REFERENCES currency (id)
+);
+
+DROP TABLE IF EXISTS archive_run;
+CREATE TABLE archive_run (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    -- transfers created before this may be in user_move_archive
+    cutoff TIMESTAMP NOT NULL,
+    moves INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX archive_run_cutoff_idx ON archive_run (cutoff);
+
+DROP TABLE IF EXISTS exchange;
+CREATE TABLE exchange (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    from_currency_id INTEGER NOT NULL,
+    to_currency_id INTEGER NOT NULL,
+    -- sold, in minor units of from_currency_id
+    amount INTEGER NOT NULL,
+    -- bought, in minor units of to_currency_id
+    proceeds INTEGER NOT NULL,
+    -- the rates applied, times 10^8
+    purchase_rate INTEGER NOT NULL,
+    sale_rate INTEGER NOT NULL,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES user (id),
+    FOREIGN KEY (from_currency_id) REFERENCES currency (id),
+    FOREIGN KEY (to_currency_id) REFERENCES currency (id)
+);
+CREATE INDEX exchange_user_idx ON exchange (user_id, created);
+
+-- every change of a balance, appended by the ledger in the same
+-- transaction as the change
+DROP TABLE IF EXISTS balance_change;
+CREATE TABLE balance_change (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    currency_id INTEGER NOT NULL,
+    -- in minor units of the currency
+    change INTEGER NOT NULL,
+    -- transfer, deposit, adjustment, amend, reverse, exchange, or
+    -- opening for the balances of a migrated database
+    kind TEXT NOT NULL,
+    -- the user_move it comes from, if any
+    move_id INTEGER,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES user (id),
+    FOREIGN KEY (currency_id) REFERENCES currency (id)
+);
+CREATE INDEX balance_change_user_idx ON balance_change (user_id, currency_id, created);
+CREATE INDEX balance_change_created_idx ON balance_change (created);
+
+-- end of day balances, only for the days they changed
+DROP TABLE IF EXISTS balance_snapshot;
+CREATE TABLE balance_snapshot (
+    user_id INTEGER NOT NULL,
+    currency_id INTEGER NOT NULL,
+    -- YYYY-MM-DD
+    day TEXT NOT NULL,
+    balance INTEGER NOT NULL,
+    PRIMARY KEY (user_id, currency_id, day),
+    FOREIGN KEY (user_id) REFERENCES user (id),
+    FOREIGN KEY (currency_id) REFERENCES currency (id)
+);
+
+-- the days `flask snapshot-balances` went through
+DROP TABLE IF EXISTS snapshot_day;
+CREATE TABLE snapshot_day (
+    day TEXT PRIMARY KEY,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    balances INTEGER NOT NULL
+);
+
+-- what the writes made with an idempotency key returned, see
+-- guapio/idempotency.py
+DROP TABLE IF EXISTS idempotency_key;
+CREATE TABLE idempotency_key (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    key TEXT NOT NULL,
+    -- hash of the request the key came with
+    fingerprint TEXT NOT NULL,
+    -- JSON
+    result TEXT NOT NULL,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    FOREIGN KEY (user_id) REFERENCES user (id)
+);
+CREATE UNIQUE INDEX idempotency_key_user_idx ON idempotency_key (user_id, key);
+CREATE INDEX idempotency_key_created_idx ON idempotency_key (created);
+
+DROP TABLE IF EXISTS generation;
+CREATE TABLE generation (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
@@ -0,0 +1,100 @@
+"""Full-text search of the posts.
+
+``post_fts`` is an FTS5 index over the title and body of every post,
+kept in sync by triggers on ``post`` (see ``schema.sql``), so a search
+is a lookup in the index ranked by BM25 instead of a ``LIKE`` over
+every row. ``flask rebuild-search`` rebuilds the index from the posts.
+"""
+import click
+from flask.cli import with_appcontext
+from markupsafe import escape
+
+from guapio.db import get_db
+
+#: Results per page of the search endpoint.
+PAGE_SIZE = 20
+
+#: Tokens of the body shown around the matches.
+SNIPPET_TOKENS = 12
+
+#: Marks the snippets are built with, replaced once they're escaped.
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+
+def parse_query(text):
+    """Turn what the user typed into an FTS5 query matching posts with
+    every word, the last one as a prefix. Returns ``None`` if there's
+    nothing to search.
+
+    Words are quoted, so the FTS5 query syntax never reaches the index.
+    """
+    words = [
+        '"{0}"'.format(word.replace('"', '""')) for word in text.split()
+    ]
+
+    if not words:
+        return None
+
+    # the last word is likely still being typed
+    words[-1] += '*'
+    return ' '.join(words)
+
+
+def search_posts(db, query, limit=PAGE_SIZE, offset=0):
+    """Return one page of the posts matching ``query``, best first.
+
+    Each row has the post's ``id``, ``title``, ``created``, ``author_id``,
+    ``username`` and a ``snippet`` of its body with the matches wrapped
+    in :data:`MATCH_START` / :data:`MATCH_END`.
+
+    :param query: an FTS5 query, see :func:`parse_query`
+    """
+    return db.execute(
+        'SELECT p.id, p.title, p.created, p.author_id, u.username,'
+        ' snippet(post_fts, 1, ?, ?, ?, ?) AS snippet'
+        ' FROM post_fts JOIN post p ON p.id = post_fts.rowid'
+        ' JOIN user u ON p.author_id = u.id'
+        ' WHERE post_fts MATCH ?'
+        ' ORDER BY rank LIMIT ? OFFSET ?',
+        (
+            MATCH_START, MATCH_END, '…', SNIPPET_TOKENS, query,
+            limit, offset
+        )
+    ).fetchall()
+
+
+def count_posts(db, query):
+    """Return the number of posts matching ``query``."""
+    return db.execute(
+        'SELECT COUNT(*) FROM post_fts WHERE post_fts MATCH ?', (query,)
+    ).fetchone()[0]
+
+
+def highlight(snippet):
+    """Return a snippet as HTML, the matches in ``<mark>``."""
+    return str(escape(snippet)).replace(MATCH_START, '<mark>').replace(
+        MATCH_END, '</mark>'
+    )
+
+
+def plain(snippet):
+    """Return a snippet as text, without the match marks."""
+    return snippet.replace(MATCH_START, '').replace(MATCH_END, '')
+
+
+@click.command('rebuild-search')
+@with_appcontext
+def rebuild_search_command():
+    """Rebuild the full-text index of the posts."""
+    db = get_db()
+    db.execute("INSERT INTO post_fts (post_fts) VALUES ('rebuild')")
+    db.execute("INSERT INTO post_fts (post_fts) VALUES ('optimize')")
+    db.commit()
+    click.echo('Indexed {0} post(s).'.format(
+        db.execute('SELECT COUNT(*) FROM post').fetchone()[0]
+    ))
+
+
+def init_app(app):
+    """Register the search index command with the Flask app."""
+    app.cli.add_command(rebuild_search_command)
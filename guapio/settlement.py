@@ -0,0 +1,151 @@
+"""Multilateral netting of transfers.
+
+Balances move with every transfer, but paying out each ``user_move``
+on its own outside the app would be wasteful: over a day most of them
+cancel out across users. A settlement takes every unsettled transfer of
+a window, nets them into one position per user and currency against
+the house, writes those positions as ``settlement_entry`` rows and
+marks the transfers with the settlement's id, all in one transaction.
+
+Transfers are read in chunks and reduced with NumPy as they come, so
+memory is bounded by the number of (user, currency) pairs, not by the
+number of transfers.
+"""
+import click
+import numpy as np
+from flask.cli import with_appcontext
+
+from guapio.db import get_db
+from guapio.export import parse_date
+from guapio.ledger import immediate
+
+#: Transfers read from SQLite per chunk.
+FETCH_SIZE = 50000
+
+
+def _reduce(keys, amounts):
+    """Sum ``amounts`` per distinct key, exactly, and return the sorted
+    keys with their sums."""
+    if not len(keys):
+        return keys, amounts
+
+    order = np.argsort(keys, kind='stable')
+    keys, amounts = keys[order], amounts[order]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+
+    return keys[starts], np.add.reduceat(amounts, starts)
+
+
+def net_positions(cursor):
+    """Net the ``(sender_id, receiver_id, currency_id, amount)`` rows of
+    ``cursor``.
+
+    :return: ``(moves, user_ids, currency_ids, amounts)``, one entry per
+        user and currency whose net isn't zero; ``amounts`` are what the
+        user received minus what they sent
+    """
+    # (user, currency) pairs are packed in one integer, so they sort
+    # and group in one pass
+    keys = np.empty(0, dtype=np.int64)
+    totals = np.empty(0, dtype=np.int64)
+    moves = 0
+
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+
+        if not rows:
+            break
+
+        chunk = np.array(rows, dtype=np.int64)
+        moves += len(chunk)
+        # each transfer debits the sender and credits the receiver
+        keys, totals = _reduce(
+            np.concatenate((
+                keys, chunk[:, 0] << 32 | chunk[:, 2],
+                chunk[:, 1] << 32 | chunk[:, 2]
+            )),
+            np.concatenate((totals, -chunk[:, 3], chunk[:, 3]))
+        )
+
+    nonzero = totals != 0
+    keys = keys[nonzero]
+
+    return moves, keys >> 32, keys & 0xffffffff, totals[nonzero]
+
+
+def settle(db, start=None, end=None):
+    """Settle the unsettled transfers created in ``[start, end)``.
+
+    :param start: timestamp bound, see :func:`guapio.export.parse_date`
+    :param end: timestamp bound, exclusive
+    :return: ``(settlement_id, moves, entries)``; ``settlement_id`` is
+        ``None`` when there was nothing to settle
+    """
+    bounds = (start or '', end or '9999-12-31 23:59:59')
+
+    with immediate(db):
+        cursor = db.execute(
+            'SELECT sender_id, receiver_id, currency_id, amount'
+            ' FROM user_move'
+            ' WHERE settlement_id IS NULL AND created >= ? AND created < ?',
+            bounds
+        )
+        # plain tuples convert to an array much faster than rows
+        cursor.row_factory = None
+        moves, users, currencies, amounts = net_positions(cursor)
+
+        if not moves:
+            return None, 0, 0
+
+        settlement_id = db.execute(
+            'INSERT INTO settlement (window_start, window_end, moves)'
+            ' VALUES (?, ?, ?)',
+            (start, end, moves)
+        ).lastrowid
+        db.executemany(
+            'INSERT INTO settlement_entry'
+            ' (settlement_id, user_id, currency_id, amount)'
+            ' VALUES (?, ?, ?, ?)',
+            zip(
+                [settlement_id] * len(amounts), users.tolist(),
+                currencies.tolist(), amounts.tolist()
+            )
+        )
+        # the write lock is held since the read, so these are the same
+        # transfers that were netted
+        db.execute(
+            'UPDATE user_move SET settlement_id = ?'
+            ' WHERE settlement_id IS NULL AND created >= ? AND created < ?',
+            (settlement_id,) + bounds
+        )
+
+    return settlement_id, moves, len(amounts)
+
+
+@click.command('settle')
+@click.option('--start', help='First day to settle (YYYY-MM-DD).')
+@click.option('--end', help='Last day to settle (YYYY-MM-DD).')
+@with_appcontext
+def settle_command(start, end):
+    """Net the unsettled transfers into one settlement."""
+    try:
+        start = parse_date(start) if start else None
+        end = parse_date(end, end=True) if end else None
+    except ValueError:
+        raise click.BadParameter('Dates must be YYYY-MM-DD.')
+
+    settlement_id, moves, entries = settle(get_db(), start, end)
+
+    if settlement_id is None:
+        click.echo('Nothing to settle.')
+    else:
+        click.echo(
+            'Settlement {0}: {1} transfer(s) netted into {2} entries.'.format(
+                settlement_id, moves, entries
+            )
+        )
+
+
+def init_app(app):
+    """Register the settlement command with the Flask app."""
+    app.cli.add_command(settle_command)
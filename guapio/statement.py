@@ -0,0 +1,255 @@
+"""Balance history and account statements.
+
+``balance`` only holds the current balances, so the ledger also appends
+every change of a balance to ``balance_change`` (see
+:mod:`guapio.ledger`). ``flask snapshot-balances``, run once a day,
+folds that journal into end of day balances in ``balance_snapshot``: it
+goes through the days after the last one it did, adding each day's
+changes to the balances of the day before, and only writes a row for
+the balances that changed.
+
+The balance at any time is the last snapshot before it plus the changes
+since, so a statement reads one index seek and at most a day or so of
+the journal per currency instead of replaying the whole history.
+
+The first run takes the current balances, minus the changes made since
+the day it snapshots, as its starting point. Balances from before the
+journal existed can't be told apart from zero before that day.
+"""
+from datetime import date, datetime, timedelta
+
+import click
+from flask.cli import with_appcontext
+
+from guapio.db import get_db
+from guapio.export import parse_date
+from guapio.ledger import immediate
+
+#: Most journal entries of one currency in a statement.
+STATEMENT_LIMIT = 1000
+
+#: Upper bound of open ended ranges.
+END_OF_TIME = '9999-12-31 23:59:59'
+
+
+def parse_time(value):
+    """Turn a ``YYYY-MM-DD`` or ``YYYY-MM-DD HH:MM:SS`` string into a
+    timestamp, a day meaning its start.
+
+    :raise ValueError: if the value isn't valid
+    """
+    for fmt in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            pass
+
+    raise ValueError(value)
+
+
+def last_snapshot_day(db):
+    """Return the last day snapshotted, or ``None``."""
+    return db.execute('SELECT MAX(day) FROM snapshot_day').fetchone()[0]
+
+
+def _bootstrap(db, day):
+    """Snapshot every balance at the end of ``day``, working back from
+    the current balances."""
+    balances = dict(
+        ((row[0], row[1]), row[2]) for row in db.execute(
+            'SELECT user_id, currency_id, balance FROM balance /* full scan */'
+        )
+    )
+
+    for user_id, currency_id, change in db.execute(
+        'SELECT user_id, currency_id, change FROM balance_change'
+        ' WHERE created >= ?',
+        (parse_date(day, end=True),)
+    ):
+        key = (user_id, currency_id)
+        balances[key] = balances.get(key, 0) - change
+
+    db.executemany(
+        'INSERT INTO balance_snapshot (user_id, currency_id, day, balance)'
+        ' VALUES (?, ?, ?, ?)',
+        [key + (day, balance) for key, balance in balances.items()]
+    )
+    db.execute(
+        'INSERT INTO snapshot_day (day, balances) VALUES (?, ?)',
+        (day, len(balances))
+    )
+    return len(balances)
+
+
+def _previous_balance(db, key, day):
+    row = db.execute(
+        'SELECT balance FROM balance_snapshot'
+        ' WHERE user_id = ? AND currency_id = ? AND day < ?'
+        ' ORDER BY day DESC LIMIT 1',
+        key + (day,)
+    ).fetchone()
+
+    return row[0] if row is not None else 0
+
+
+def snapshot_balances(db, through=None):
+    """Snapshot the balances at the end of every day after the last
+    snapshot, through ``through`` (``YYYY-MM-DD``), yesterday by
+    default. Days are UTC, like the timestamps.
+
+    :return: ``(days, balances)``, the number of days and of balance
+        rows written
+    """
+    if through is None:
+        through = db.execute("SELECT date('now', '-1 day')").fetchone()[0]
+
+    with immediate(db):
+        last = last_snapshot_day(db)
+
+        if last is None:
+            return 1, _bootstrap(db, through)
+
+        if last >= through:
+            return 0, 0
+
+        # each day's changes, summed per balance
+        days = {}
+
+        for day, user_id, currency_id, change in db.execute(
+            'SELECT date(created), user_id, currency_id, change'
+            ' FROM balance_change WHERE created >= ? AND created < ?',
+            (parse_date(last, end=True), parse_date(through, end=True))
+        ):
+            changes = days.setdefault(day, {})
+            key = (user_id, currency_id)
+            changes[key] = changes.get(key, 0) + change
+
+        balances = {}
+        written = 0
+        day = date.fromisoformat(last)
+        end = date.fromisoformat(through)
+        count = 0
+
+        while day < end:
+            day += timedelta(days=1)
+            name = day.isoformat()
+            rows = []
+
+            for key, change in sorted(days.get(name, {}).items()):
+                if key not in balances:
+                    balances[key] = _previous_balance(db, key, name)
+
+                balances[key] += change
+                rows.append(key + (name, balances[key]))
+
+            db.executemany(
+                'INSERT INTO balance_snapshot'
+                ' (user_id, currency_id, day, balance) VALUES (?, ?, ?, ?)',
+                rows
+            )
+            db.execute(
+                'INSERT INTO snapshot_day (day, balances) VALUES (?, ?)',
+                (name, len(rows))
+            )
+            written += len(rows)
+            count += 1
+
+    return count, written
+
+
+def balance_at(db, user_id, currency_id, at):
+    """Return a user's balance of a currency at the timestamp ``at``,
+    changes made at ``at`` excluded, in minor units."""
+    row = db.execute(
+        'SELECT day, balance FROM balance_snapshot'
+        ' WHERE user_id = ? AND currency_id = ? AND day < ?'
+        ' ORDER BY day DESC LIMIT 1',
+        (user_id, currency_id, at[:10])
+    ).fetchone()
+
+    if row is None:
+        balance, since = 0, ''
+    else:
+        balance, since = row[1], parse_date(row[0], end=True)
+
+    # only what changed since the end of that day
+    return balance + db.execute(
+        'SELECT COALESCE(SUM(change), 0) FROM balance_change'
+        ' WHERE user_id = ? AND currency_id = ?'
+        ' AND created >= ? AND created < ?',
+        (user_id, currency_id, since, at)
+    ).fetchone()[0]
+
+
+def statement(db, user_id, currency_id, start, end=None,
+              limit=STATEMENT_LIMIT):
+    """Return a user's statement of a currency over ``[start, end)``.
+
+    :param start: timestamp the statement starts at
+    :param end: timestamp it ends before, now by default
+    :return: a dict with the ``opening`` and ``closing`` balances, the
+        ``entries`` in between (``id``, ``created``, ``kind``,
+        ``move_id``, ``change`` and the ``balance`` after it), and
+        ``more``, true when there were more than ``limit`` entries
+    """
+    end = end or END_OF_TIME
+    opening = balance_at(db, user_id, currency_id, start)
+    rows = db.execute(
+        'SELECT id, created, change, kind, move_id FROM balance_change'
+        ' WHERE user_id = ? AND currency_id = ?'
+        ' AND created >= ? AND created < ?'
+        ' ORDER BY created, id LIMIT ?',
+        (user_id, currency_id, start, end, limit + 1)
+    ).fetchall()
+    more = len(rows) > limit
+    balance = opening
+    entries = []
+
+    for row in rows[:limit]:
+        balance += row['change']
+        entries.append({
+            'id': row['id'],
+            'created': row['created'],
+            'kind': row['kind'],
+            'move_id': row['move_id'],
+            'change': row['change'],
+            'balance': balance,
+        })
+
+    if more:
+        # the entries were cut, so the closing balance is read on its own
+        balance = balance_at(db, user_id, currency_id, end)
+
+    return {
+        'opening': opening,
+        'closing': balance,
+        'entries': entries,
+        'more': more,
+    }
+
+
+@click.command('snapshot-balances')
+@click.option('--through', help='Last day to snapshot (YYYY-MM-DD),'
+              ' yesterday by default.')
+@with_appcontext
+def snapshot_balances_command(through):
+    """Snapshot the end of day balances since the last snapshot."""
+    if through is not None:
+        try:
+            through = date.fromisoformat(through).isoformat()
+        except ValueError:
+            raise click.BadParameter('The day must be YYYY-MM-DD.')
+
+    days, balances = snapshot_balances(get_db(), through)
+
+    if not days:
+        click.echo('The balances are snapshotted already.')
+    else:
+        click.echo('Snapshotted {0} day(s), {1} balance(s).'.format(
+            days, balances
+        ))
+
+
+def init_app(app):
+    """Register the snapshot command with the Flask app."""
+    app.cli.add_command(snapshot_balances_command)
@@ -0,0 +1,108 @@
+$(document).ready(function() {
+    // The dashboard cards follow the balance and rate events of the
+    // server while the page is open, and the portfolio is valued again
+    // from them. Amounts are kept as BigInt minor units, like the server.
+    var $root = $('[data-live-source]');
+
+    if (!$root.length || !window.EventSource || !window.BigInt) {
+        return;
+    }
+
+    var zero = BigInt(0);
+
+    function formatMinor(minor, scale) {
+        var sign = minor < zero ? '-' : '';
+        var digits = (minor < zero ? -minor : minor).toString();
+
+        if (!scale) {
+            return sign + digits;
+        }
+
+        while (digits.length <= scale) {
+            digits = '0' + digits;
+        }
+
+        return sign + digits.slice(0, -scale) + '.' + digits.slice(-scale);
+    }
+
+    function card(id) {
+        return $('[data-currency="' + id + '"]');
+    }
+
+    function setBalance($card, minor) {
+        $card.attr('data-minor', minor.toString());
+        $card.text(formatMinor(minor, Number($card.attr('data-scale'))));
+    }
+
+    function setRates($card, rates) {
+        $card.attr('data-purchase-rate', rates[0]);
+        $card.attr('data-sale-rate', rates[1]);
+    }
+
+    // Same conversion as guapio.valuation: sell at the purchase rate of
+    // the held currency, buy at the sale rate of the target one.
+    function revalue() {
+        var $cards = $('[data-currency]');
+
+        $('[data-portfolio-currency]').each(function() {
+            var $cell = $(this);
+            var target = $cell.attr('data-portfolio-currency');
+            var sale = Number(card(target).attr('data-sale-rate'));
+            var total = 0;
+
+            if (!sale) {
+                $cell.text('-');
+                return;
+            }
+
+            $cards.each(function() {
+                var $card = $(this);
+                var units = Number($card.attr('data-minor')) /
+                    Math.pow(10, Number($card.attr('data-scale')));
+
+                if ($card.attr('data-currency') === target) {
+                    total += units;
+                } else {
+                    total += units * Number($card.attr('data-purchase-rate')) / sale;
+                }
+            });
+
+            $cell.text(total.toFixed(Number($cell.attr('data-scale'))));
+        });
+    }
+
+    var source = new EventSource($root.attr('data-live-source'));
+
+    source.addEventListener('balance', function(event) {
+        var data = JSON.parse(event.data);
+        var $card = card(data.currency_id);
+
+        if ($card.length) {
+            setBalance($card, BigInt($card.attr('data-minor')) + BigInt(data.change));
+            revalue();
+        }
+    });
+
+    source.addEventListener('rate', function(event) {
+        var data = JSON.parse(event.data);
+        setRates(card(data.currency_id), [data.purchase_rate, data.sale_rate]);
+        revalue();
+    });
+
+    source.addEventListener('snapshot', function(event) {
+        var data = JSON.parse(event.data);
+
+        $('[data-currency]').each(function() {
+            var $card = $(this);
+            var id = $card.attr('data-currency');
+
+            setBalance($card, BigInt(data.balances[id] || 0));
+
+            if (data.rates[id]) {
+                setRates($card, data.rates[id]);
+            }
+        });
+
+        revalue();
+    });
+});
@@ -1,5 +1,71 @@
 $(document).ready(function() {
-    $('.responsive-data-table').DataTable({
-        responsive: true
+    $('.responsive-data-table').each(function() {
+        var $table = $(this);
+        var source = $table.data('source');
+
+        if (!source) {
+            $table.DataTable({
+                responsive: true
+            });
+            return;
+        }
+
+        // Tables with a data-source are paged by the server. The key of
+        // the last row of each page is kept so the next page can be
+        // asked for with a keyset seek instead of an offset.
+        var cursors = {};
+        var last = null;
+        var text = $.fn.dataTable.render.text().display;
+
+        function cursorKey(start, data) {
+            return [start, data.length, data.search.value, data.order[0].dir].join('|');
+        }
+
+        var columns = $table.find('thead th').map(function() {
+            var $th = $(this);
+            var column = {
+                data: $th.data('data'),
+                orderable: $th.data('data') === 'created',
+                render: text
+            };
+
+            if ($th.data('render') === 'edit') {
+                column.render = function(data, type, row) {
+                    var html = text(data);
+                    if (row.edit_url) {
+                        html += ' <a class="action" href="' + text(row.edit_url) + '">Edit</a>';
+                    }
+                    return html;
+                };
+            }
+
+            return column;
+        }).get();
+
+        var createdIndex = $table.find('thead th[data-data="created"]').index();
+
+        $table.DataTable({
+            responsive: true,
+            processing: true,
+            serverSide: true,
+            columns: columns,
+            order: [[createdIndex, 'desc']],
+            ajax: {
+                url: source,
+                data: function(data) {
+                    last = data;
+                    var cursor = cursors[cursorKey(data.start, data)];
+                    if (cursor) {
+                        data.after = cursor;
+                    }
+                },
+                dataSrc: function(json) {
+                    if (last && json.cursor) {
+                        cursors[cursorKey(last.start + last.length, last)] = json.cursor;
+                    }
+                    return json.data;
+                }
+            }
+        });
     });
-});
\ No newline at end of file
+});
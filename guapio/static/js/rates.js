@@ -0,0 +1,37 @@
+$(document).ready(function() {
+    // Rate charts ask the server for a downsampled series of about as
+    // many points as the chart is pixels wide.
+    $('.rate-chart').each(function() {
+        var $chart = $(this);
+        var source = $chart.data('source');
+
+        function day(date) {
+            return date.toISOString().slice(0, 10);
+        }
+
+        function load(days) {
+            var params = {points: Math.max(Math.min($chart.width(), 2000), 3)};
+
+            if (days) {
+                params.start = day(new Date(Date.now() - days * 86400000));
+            }
+
+            $.getJSON(source, params, function(data) {
+                $.plot($chart, [
+                    {label: 'Tasa de compra', data: data.series.purchase_rate},
+                    {label: 'Tasa de venta', data: data.series.sale_rate}
+                ], {
+                    xaxis: {mode: 'time'},
+                    legend: {position: 'nw'}
+                });
+            });
+        }
+
+        $('.rate-windows button').click(function() {
+            $(this).addClass('active').siblings().removeClass('active');
+            load($(this).data('days'));
+        });
+
+        load();
+    });
+});
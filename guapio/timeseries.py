@@ -0,0 +1,120 @@
+"""Reading and downsampling the rate history of currencies.
+
+Every rate a currency has had is kept in ``currency_rate``. Years of
+ticks are far more points than a chart can show, so series are reduced
+to a fixed number of points before they're sent:
+
+* ``lttb``, Largest-Triangle-Three-Buckets, keeps the points that
+  preserve the visual shape of the line.
+* ``minmax`` keeps the lowest and highest point of each bucket, so no
+  spike is ever lost.
+"""
+import numpy as np
+
+from guapio.money import RATE_SCALE
+
+#: Rows fetched from SQLite per batch.
+FETCH_SIZE = 10000
+
+#: Downsampling methods by name.
+METHODS = ('lttb', 'minmax')
+
+
+def load_rates(db, currency_id, start=None, end=None):
+    """Load the rate history of a currency, oldest first.
+
+    :param start: only rates set at or after this timestamp
+    :param end: only rates set before this timestamp
+    :return: ``(times, purchase, sale)`` arrays, ``times`` in whole
+        milliseconds since the epoch
+    """
+    cursor = db.execute(
+        'SELECT (julianday(created) - 2440587.5) * 86400000.0,'
+        ' purchase_rate, sale_rate'
+        ' FROM currency_rate'
+        ' WHERE currency_id = ? AND created >= ? AND created < ?'
+        ' ORDER BY created',
+        (currency_id, start or '', end or '9999-12-31 23:59:59')
+    )
+    # plain tuples convert to an array much faster than rows
+    cursor.row_factory = None
+    chunks = [np.empty((0, 3))]
+
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+
+        if not rows:
+            break
+
+        chunks.append(np.array(rows, dtype=np.float64))
+
+    data = np.concatenate(chunks)
+    # julianday() is a float, off by a fraction of a millisecond
+    times = np.rint(data[:, 0]).astype(np.int64)
+    # rates are stored as integers of RATE_SCALE decimals
+    data[:, 1:] /= 10 ** RATE_SCALE
+    return times, data[:, 1], data[:, 2]
+
+
+def lttb(x, y, threshold):
+    """Return the indices of the ``threshold`` points picked by
+    Largest-Triangle-Three-Buckets.
+
+    The first and last points are always kept. The others are split in
+    ``threshold - 2`` buckets, and each bucket keeps the point forming
+    the largest triangle with the point kept before it and the average
+    of the next bucket.
+    """
+    n = len(x)
+
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    every = (n - 2) / (threshold - 2)
+    edges = (np.arange(threshold - 1) * every).astype(np.int64) + 1
+    edges[-1] = n - 1
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[hi:next_hi].mean()
+        avg_y = y[hi:next_hi].mean()
+        # twice the triangle areas; only the largest matters
+        area = np.abs(
+            (x[a] - avg_x) * (y[lo:hi] - y[a])
+            - (x[a] - x[lo:hi]) * (avg_y - y[a])
+        )
+        a = lo + int(area.argmax())
+        selected[i + 1] = a
+
+    return selected
+
+
+def minmax(x, y, threshold):
+    """Return the indices of the lowest and highest point of each of
+    ``threshold // 2`` buckets, in order."""
+    n = len(y)
+    buckets = max(threshold // 2, 1)
+
+    if threshold >= n:
+        return np.arange(n)
+
+    bucket = np.arange(n) * buckets // n
+    # sorted by bucket, then value: each bucket starts with its minimum
+    # and ends with its maximum
+    order = np.lexsort((y, bucket))
+    ends = np.cumsum(np.bincount(bucket, minlength=buckets))
+    starts = ends - np.bincount(bucket, minlength=buckets)
+
+    return np.unique(np.concatenate((order[starts], order[ends - 1])))
+
+
+def downsample(x, y, threshold, method='lttb'):
+    """Return ``[[x, y], ...]`` reduced to about ``threshold`` points."""
+    pick = lttb if method == 'lttb' else minmax
+    index = pick(x, y, threshold)
+    # not stacked into one array, which would make integer times floats
+    return [list(point) for point in zip(x[index].tolist(), y[index].tolist())]
@@ -1,99 +1,268 @@
+from datetime import datetime
+
 from flask import (
-    Blueprint, flash, g, redirect, render_template, request, url_for
+    Blueprint, Response, current_app, flash, g, jsonify, redirect,
+    render_template, request, stream_with_context, url_for
 )
 from werkzeug.exceptions import abort
 
+from guapio import (
+    archive, batch, datatables, export, idempotency, ledger, writer
+)
 from guapio.auth import login_required
+from guapio.conditional import conditional
+from guapio.currency import get_currencies, get_currency_snapshot
 from guapio.db import get_db
+from guapio.money import DEFAULT_SCALE, Money, MoneyError
 
 bp = Blueprint('user_move', __name__, url_prefix='/user_move')
 
 
+_LISTING_COLUMNS = (
+    'm.id, amount, c.scale, comment, c.code, c.title AS currency,'
+    ' u.username AS sender, r.username AS receiver, m.created'
+)
+
+_LISTING_JOINS = (
+    ' JOIN user u ON m.sender_id = u.id'
+    ' JOIN user r ON m.receiver_id = r.id'
+    ' JOIN currency c ON m.currency_id = c.id'
+)
+
+_LISTING_SEARCH = (
+    'm.sender_id IN'
+    ' (SELECT id FROM user WHERE username >= ? AND username < ?)',
+    'm.receiver_id IN'
+    ' (SELECT id FROM user WHERE username >= ? AND username < ?)',
+)
+
+archived_moves_listing = datatables.Listing(
+    columns=_LISTING_COLUMNS,
+    tables='user_move_archive m' + _LISTING_JOINS,
+    key=('m.created', 'm.id'),
+    search=_LISTING_SEARCH,
+    count_from='user_move_archive',
+    generation='user_move'
+)
+
+# archived transfers are merged into the pages reaching back past the
+# cutoff of the archive
+user_moves_listing = datatables.Listing(
+    columns=_LISTING_COLUMNS,
+    tables='user_move m' + _LISTING_JOINS,
+    key=('m.created', 'm.id'),
+    search=_LISTING_SEARCH,
+    count_from='user_move',
+    generation='user_move',
+    archive=archived_moves_listing,
+    cutoff=archive.get_cutoff
+)
+
+
 @bp.route('/')
+@conditional()
 def index():
-    db = get_db()
-    user_moves = db.execute(
-        'SELECT'
-        ' m.id, amount, comment, currency_id, sender_id, receiver_id, created'
-        ' FROM user_move m JOIN user u ON m.sender_id = u.id JOIN user r ON m.receiver_id = r.id JOIN currency c ON m.currency_id = c.id'
-        ' ORDER BY created DESC'
-    ).fetchall()
-    return render_template('user_move/index.html', user_moves=user_moves)
+    """Show the transfers table. Its rows are filled page by page from
+    :func:`data`."""
+    return render_template('user_move/index.html')
+
+
+def _format_user_move(user_move):
+    return {
+        'id': user_move['id'],
+        'amount': str(Money(user_move['amount'], user_move['scale'])),
+        'currency': user_move['currency'],
+        'sender': user_move['sender'],
+        'receiver': user_move['receiver'],
+        'comment': user_move['comment'],
+        'created': user_move['created'].strftime('%B %d, %Y'),
+    }
+
+
+@bp.route('/data')
+@login_required
+def data():
+    """Serve one page of transfers, most recent first, to DataTables."""
+    return jsonify(
+        user_moves_listing.page(get_db(), request.args, _format_user_move)
+    )
+
+
+@bp.route('/export.<fmt>')
+@login_required
+def download(fmt):
+    """Stream the current user's transfer history, oldest first, as
+    CSV or JSON Lines. Takes optional ``start`` / ``end`` days
+    (YYYY-MM-DD). The whole history is exported by ``flask
+    export-moves``.
+    """
+    if fmt not in export.FORMATS:
+        abort(404)
+
+    user_id = request.args.get('user_id', g.user['id'], type=int)
+
+    if user_id != g.user['id']:
+        abort(403)
 
+    try:
+        start = request.args.get('start')
+        start = export.parse_date(start) if start else None
+        end = request.args.get('end')
+        end = export.parse_date(end, end=True) if end else None
+    except ValueError:
+        abort(400, 'Dates must be YYYY-MM-DD.')
 
-def get_user_move(id):
+    mimetype, extension = export.FORMATS[fmt]
+    chunks = export.generate(fmt, get_db(), start, end, user_id)
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition':
+                'attachment; filename=user_moves.{0}'.format(extension)
+        }
+    )
+
+
+def get_user_move(id, check_author=True):
+    """Get a transfer by id, checking that it exists and optionally
+    that the current user sent it.
+
+    :raise 404: if a transfer with the given id doesn't exist
+    :raise 403: if the current user isn't the sender
+    """
     user_move = get_db().execute(
         'SELECT'
-        ' m.id, amount, comment, currency_id, sender_id, receiver_id, created'
+        ' m.id, amount, c.scale, comment, currency_id, sender_id, receiver_id,'
+        ' m.created'
         ' FROM user_move m JOIN user u ON m.sender_id = u.id JOIN user r ON m.receiver_id = r.id JOIN currency c ON m.currency_id = c.id'
         ' WHERE m.id = ?',
         (id,)
     ).fetchone()
 
+    if user_move is None:
+        abort(404, "user_move id {0} doesn't exist.".format(id))
+
+    if check_author and user_move['sender_id'] != g.user['id']:
+        abort(403)
+
     return user_move
 
 
-def get_user_moves_from_user(user_id=None):
+def get_user_moves_from_user(user_id=None, start=None, end=None):
+    """Return the transfers sent or received by the current user,
+    oldest first, archived ones included when the range needs them."""
     if user_id is None:
         user_id = g.user['id']
 
     elif user_id != g.user['id']:
         abort(403)
 
-    user_moves = get_db().execute(
-        'SELECT'
-        ' m.id, amount, comment, currency_id, sender_id, receiver_id, created'
-        ' FROM user_move m JOIN user u ON m.sender_id = u.id JOIN user r ON m.receiver_id = r.id JOIN currency c ON m.currency_id = c.id'
-        ' WHERE m.sender_id = ? or m.receiver_id = ?',
-        (user_id, user_id,)
-    ).fetchall()
+    return archive.user_moves(get_db(), user_id, start, end)
+
+
+@bp.route('/monthly')
+@login_required
+def monthly():
+    """Return what the current user sent and received per month and
+    currency. Takes optional ``first`` / ``last`` months (YYYY-MM)."""
+    first = request.args.get('first') or None
+    last = request.args.get('last') or None
+
+    try:
+        for month in (first, last):
+            if month is not None:
+                datetime.strptime(month, '%Y-%m')
+    except ValueError:
+        return jsonify({'error': 'Months must be YYYY-MM.'}), 400
 
-    if user_moves is None:
-        abort(404, "user_move id {0} doesn't exism.".format(id))
+    currencies = get_currency_snapshot().by_id
+    totals = archive.monthly_totals(get_db(), g.user['id'], first, last)
 
+    for total in totals:
+        # a deleted currency keeps its totals, in the default scale
+        currency = currencies.get(total['currency_id'])
+        scale = currency['scale'] if currency else DEFAULT_SCALE
+        total['currency'] = currency['code'] if currency else None
+        total['sent'] = str(Money(total['sent'], scale))
+        total['received'] = str(Money(total['received'], scale))
 
-    return user_moves
+    return jsonify({'data': totals})
 
 
 @bp.route('/create', methods=('GET', 'POST'))
 @login_required
 def create():
+    """Send money from the current user to another user."""
     if request.method == 'POST':
         amount = request.form['amount']
-        comment = request.form['comment']
-        sender_id = request.form['sender_id']
+        comment = request.form.get('comment')
         receiver_id = request.form['receiver_id']
-        currency_id = request.form['currency_id']
+        currency_id = request.form.get('currency_id')
         error = None
 
         if not amount:
             error = 'Amount is required.'
-        if not sender_id:
-            error = 'Sender is required.'
-        if not receiver_id:
+        elif not receiver_id:
             error = 'Receiver is required.'
-        if not currency_id:
+        elif not currency_id:
             error = 'Currency is required.'
 
-        if error is not None:
-            flash(error)
-        else:
-            db = get_db()
-            db.execute(
-                'INSERT INTO user_move'
-                ' (amount, comment, sender_id, receiver_id, currency_id)'
-                ' VALUES (?, ?, ?, ?, ?)',
-                (amount, comment, sender_id, receiver_id, currency_id)
-            )
-            db.commit()
-            return redirect(url_for('user_move.index'))
+        if error is None:
+            try:
+                idempotency.write(
+                    ledger.transfer, g.user['id'], receiver_id, currency_id,
+                    amount, comment
+                )
+            except ledger.LedgerError as e:
+                error = str(e)
+            else:
+                return redirect(url_for('user_move.index'))
 
-    return render_template('user_move/create.html')
+        flash(error)
+
+    return render_template(
+        'user_move/create.html', currencies=get_currencies())
+
+
+@bp.route('/bulk', methods=('POST',))
+@login_required
+def bulk():
+    """Send a batch of transfers from the current user in one
+    transaction. Takes a JSON or CSV (``text/csv``) body and returns the
+    result of each transfer. ``?atomic=1`` applies nothing if any
+    transfer is rejected. A retry with the same ``Idempotency-Key``
+    header gets the same results back without applying anything.
+    """
+    fmt = 'csv' if request.mimetype == 'text/csv' else 'json'
+
+    try:
+        transfers, atomic = batch.parse_batch(
+            request.get_data(as_text=True), fmt
+        )
+    except batch.BatchError as e:
+        return jsonify({'error': str(e)}), 400
+
+    if len(transfers) > current_app.config['BULK_TRANSFER_LIMIT']:
+        return jsonify({'error': 'The batch is too large.'}), 413
+
+    for transfer in transfers:
+        transfer['sender_id'] = g.user['id']
+
+    if atomic is None:
+        atomic = request.args.get('atomic') in ('1', 'true')
+
+    results = idempotency.write(
+        ledger.transfer_many, transfers, bool(atomic)
+    )
+    return jsonify(batch.summarize(results))
 
 
 @bp.route('/<int:id>/update', methods=('GET', 'POST'))
 @login_required
 def update(id):
+    """Change the amount of a transfer, adjusting both balances."""
     user_move = get_user_move(id)
 
     if request.method == 'POST':
@@ -103,25 +272,30 @@ def update(id):
         if not amount:
             error = 'Amount is required.'
 
-        if error is not None:
-            flash(error)
-        else:
-            db = get_db()
-            db.execute(
-                'UPDATE user_move SET amount = ? WHERE id = ?',
-                (amount, id)
-            )
-            db.commit()
-            return redirect(url_for('user_move.index'))
+        if error is None:
+            try:
+                writer.write(
+                    ledger.amend, id, Money.parse(amount, user_move['scale'])
+                )
+            except (ledger.LedgerError, MoneyError) as e:
+                error = str(e)
+            else:
+                return redirect(url_for('user_move.index'))
+
+        flash(error)
 
     return render_template('user_move/update.html', user_move=user_move)
 
 
-@bp.route('/<int:id>/delete', methods=('user_move',))
+@bp.route('/<int:id>/delete', methods=('POST',))
 @login_required
 def delete(id):
+    """Reverse a transfer, giving the money back to the sender."""
     get_user_move(id)
-    db = get_db()
-    db.execute('DELETE FROM user_move WHERE id = ?', (id,))
-    db.commit()
+
+    try:
+        writer.write(ledger.reverse, id)
+    except ledger.LedgerError as e:
+        flash(str(e))
+
     return redirect(url_for('user_move.index'))
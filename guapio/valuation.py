@@ -0,0 +1,222 @@
+"""Value the holdings of users in any currency.
+
+Rates are read as the price of one unit of a currency in the common base
+currency. A holding in currency ``i`` is sold at its ``purchase_rate``
+and the proceeds buy currency ``j`` at its ``sale_rate``, so one unit of
+``i`` is worth ``purchase_rate[i] / sale_rate[j]`` units of ``j`` (and
+exactly one unit when ``i`` is ``j``). Rates share one fixed scale, so
+their stored integers give the same ratio.
+
+All users are valued at once: balances are loaded into a
+users x currencies matrix and multiplied by the conversion matrix, so a
+report over every user is one NumPy pass instead of a loop per row.
+"""
+import csv
+
+import click
+import numpy as np
+from flask import Blueprint, current_app, g, jsonify
+from flask.cli import with_appcontext
+from werkzeug.exceptions import abort
+
+from guapio.auth import login_required
+from guapio.currency import get_currency_snapshot
+from guapio.db import get_db
+
+bp = Blueprint('valuation', __name__, url_prefix='/valuation')
+
+#: Rows fetched from SQLite per batch while loading balances.
+FETCH_SIZE = 10000
+
+
+def conversion_matrix(snapshot):
+    """Return ``(currency_ids, matrix)`` where ``matrix[i, j]`` is the
+    value of one unit of ``currency_ids[i]`` in ``currency_ids[j]``.
+
+    The matrix is cached per currency generation.
+    """
+    cached = current_app.extensions.get('guapio.valuation')
+
+    if cached is not None and cached[0] == snapshot.generation:
+        return cached[1], cached[2]
+
+    currencies = list(snapshot.by_id.values())
+    ids = np.array([c['id'] for c in currencies], dtype=np.int64)
+    purchase = np.array(
+        [c['purchase_rate'] for c in currencies], dtype=np.float64
+    )
+    sale = np.array([c['sale_rate'] for c in currencies], dtype=np.float64)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        matrix = np.where(sale > 0, purchase[:, None] / sale[None, :], np.nan)
+
+    np.fill_diagonal(matrix, 1.0)
+    current_app.extensions['guapio.valuation'] = (
+        snapshot.generation, ids, matrix
+    )
+
+    return ids, matrix
+
+
+def load_holdings(db, currency_ids, user_id=None):
+    """Load balances into a dense matrix.
+
+    :param currency_ids: sorted currency ids, the matrix columns
+    :param user_id: only load the balances of this user
+    :return: ``(user_ids, holdings)`` where ``holdings[u, c]`` is the
+        balance of ``user_ids[u]`` in ``currency_ids[c]``, in minor units
+    """
+    if user_id is None:
+        cursor = db.execute(
+            'SELECT user_id, currency_id, balance FROM balance /* full scan */'
+        )
+    else:
+        cursor = db.execute(
+            'SELECT user_id, currency_id, balance FROM balance'
+            ' WHERE user_id = ?',
+            (user_id,)
+        )
+
+    chunks = []
+
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+
+        if not rows:
+            break
+
+        chunks.append(np.array(
+            [tuple(row) for row in rows], dtype=np.float64
+        ).reshape(-1, 3))
+
+    if not chunks or not len(currency_ids):
+        return np.empty(0, dtype=np.int64), np.zeros((0, len(currency_ids)))
+
+    data = np.concatenate(chunks)
+    users, user_index = np.unique(
+        data[:, 0].astype(np.int64), return_inverse=True
+    )
+    currency = data[:, 1].astype(np.int64)
+    currency_index = np.searchsorted(currency_ids, currency)
+    currency_index = np.minimum(currency_index, len(currency_ids) - 1)
+    # balances in a currency that no longer exists are left out
+    known = currency_ids[currency_index] == currency
+
+    holdings = np.zeros((len(users), len(currency_ids)))
+    np.add.at(
+        holdings,
+        (user_index[known], currency_index[known]),
+        data[known, 2]
+    )
+
+    return users, holdings
+
+
+def portfolio_values(db, code=None, user_id=None):
+    """Value the holdings of every user (or of one user).
+
+    :param code: the currency to value in; all currencies if ``None``
+    :return: ``(user_ids, currencies, values)`` where ``values[u, j]``
+        is what ``user_ids[u]`` holds, in whole units of ``currencies[j]``
+    :raise LookupError: if there is no currency with that code
+    """
+    snapshot = get_currency_snapshot()
+    ids, matrix = conversion_matrix(snapshot)
+    currencies = list(snapshot.by_id.values())
+    minor_units = 10.0 ** np.array(
+        [c['scale'] for c in currencies], dtype=np.float64
+    )
+
+    if code is not None:
+        if code not in snapshot.by_code:
+            raise LookupError(code)
+
+        column = int(np.searchsorted(ids, snapshot.by_code[code]['id']))
+        matrix = matrix[:, column:column + 1]
+        currencies = [currencies[column]]
+
+    users, holdings = load_holdings(db, ids, user_id)
+
+    return users, currencies, (holdings / minor_units) @ matrix
+
+
+def _value(value, scale):
+    # NaN isn't valid JSON, and is what a currency that can't be bought
+    # (a sale rate of zero) is worth
+    value = float(value)
+
+    if not np.isfinite(value):
+        return None
+
+    return round(value, scale)
+
+
+def get_user_portfolio(user_id=None):
+    """Return what the user's holdings are worth in each currency, as a
+    list of ``{'currency': row, 'value': float}`` for the dashboard,
+    ``None`` for a currency they can't be valued in.
+    """
+    if user_id is None:
+        user_id = g.user['id']
+
+    users, currencies, values = portfolio_values(get_db(), user_id=user_id)
+    row = values[0] if len(users) else np.zeros(len(currencies))
+
+    return [
+        {'currency': currency, 'value': _value(value, currency['scale'])}
+        for currency, value in zip(currencies, row)
+    ]
+
+
+@bp.route('/<code>')
+@login_required
+def index(code):
+    """Return the value of the current user's holdings in one currency,
+    ``null`` if it can't be valued in it. Every user's holdings are
+    valued by ``flask valuation-report``.
+    """
+    try:
+        users, currencies, values = portfolio_values(
+            get_db(), code, g.user['id']
+        )
+    except LookupError:
+        abort(404, "currency code {0} doesn't exist.".format(code))
+
+    scale = currencies[0]['scale']
+
+    return jsonify({
+        'currency': code,
+        'totals': [
+            {'user_id': int(user), 'value': _value(value, scale)}
+            for user, value in zip(users, values[:, 0])
+        ],
+    })
+
+
+@click.command('valuation-report')
+@click.argument('code')
+@click.option('--output', '-o', type=click.File('w'), default='-',
+              help='Write the CSV here instead of stdout.')
+@with_appcontext
+def valuation_report_command(code, output):
+    """Write the value of every user's holdings in CODE as CSV, an
+    empty value if CODE can't be bought."""
+    try:
+        users, currencies, values = portfolio_values(get_db(), code)
+    except LookupError:
+        raise click.ClickException(
+            "currency code {0} doesn't exist.".format(code)
+        )
+
+    scale = currencies[0]['scale']
+    writer = csv.writer(output)
+    writer.writerow(('user_id', 'value'))
+    writer.writerows(
+        (user, _value(value, scale))
+        for user, value in zip(users.tolist(), values[:, 0].tolist())
+    )
+
+
+def init_app(app):
+    """Register the valuation report command with the Flask app."""
+    app.cli.add_command(valuation_report_command)
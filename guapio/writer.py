@@ -0,0 +1,274 @@
+"""Group commit of the write requests.
+
+Instead of every request taking SQLite's write lock and paying for its
+own commit, write views hand their operation to :func:`write`. A single
+writer thread per process takes whatever operations are queued (up to
+``GROUP_COMMIT_SIZE``, waiting at most ``GROUP_COMMIT_DELAY`` seconds
+for more) and runs them in one transaction, each inside its own
+``SAVEPOINT``. An operation that raises is rolled back alone and its
+exception is raised in the request that submitted it, the others are
+committed together. A request waits at most ``GROUP_COMMIT_TIMEOUT``
+seconds for its batch; if the writer thread is gone, the next write
+starts a new one.
+
+An operation is a callable taking the connection as first argument,
+like the functions of :mod:`guapio.ledger`. It must only use that
+connection. Work that has to wait for the commit, like notifying other
+clients, is deferred with :func:`after_commit`.
+
+With ``GROUP_COMMIT`` set to ``False`` operations run right away on the
+request's connection, each in a transaction of its own, as if it were
+a batch of one.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from flask import current_app
+
+from guapio.db import bump_generation, get_db, get_pool
+
+_state = threading.local()
+
+# held while the writer of a process is started
+_start_lock = threading.Lock()
+
+
+def in_batch():
+    """Return whether the current thread is running a group commit
+    batch, whose transaction is already open."""
+    return getattr(_state, 'callbacks', None) is not None
+
+
+def after_commit(callback):
+    """Call ``callback`` once the current batch is committed, or right
+    away outside of a batch. It's dropped if the operation fails."""
+    if in_batch():
+        _state.callbacks.append(callback)
+    else:
+        callback()
+
+
+class _Operation(object):
+
+    __slots__ = ('function', 'args', 'kwargs', 'future')
+
+    def __init__(self, function, args, kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.future = Future()
+
+
+class GroupWriter(object):
+    """Run submitted operations in batches on one connection, from one
+    thread.
+
+    :param app: the app whose context the operations run in
+    :param connection: the connection the writer thread owns
+    :param size: most operations in one transaction
+    :param delay: longest wait, in seconds, for more operations before a
+        batch is committed
+    """
+
+    def __init__(self, app, connection, size=64, delay=0.002):
+        self.app = app
+        self.connection = connection
+        self.size = size
+        self.delay = delay
+        self.pid = os.getpid()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(
+            target=self._run, name='guapio-writer', daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, function, *args, **kwargs):
+        """Queue ``function(connection, *args, **kwargs)`` and return a
+        :class:`~concurrent.futures.Future` of its result."""
+        operation = _Operation(function, args, kwargs)
+        self._queue.put(operation)
+        return operation.future
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.delay
+
+        while len(batch) < self.size:
+            timeout = deadline - time.monotonic()
+
+            try:
+                if timeout > 0:
+                    batch.append(self._queue.get(timeout=timeout))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return batch
+
+    def is_alive(self):
+        """Return whether the writer thread is still running."""
+        return self._thread.is_alive()
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+
+            try:
+                with self.app.app_context():
+                    self._apply(batch)
+            except Exception as e:
+                # the thread has to outlive a failed batch, or every write
+                # after it would wait for nothing
+                self.app.logger.exception('group commit batch failed')
+
+                for operation in batch:
+                    if not operation.future.done():
+                        operation.future.set_exception(e)
+
+    def _apply(self, batch):
+        db = self.connection
+        outcomes = []
+        callbacks = []
+
+        try:
+            db.execute('BEGIN IMMEDIATE')
+
+            for operation in batch:
+                _state.callbacks = []
+                db.execute('SAVEPOINT operation')
+
+                try:
+                    result = operation.function(
+                        db, *operation.args, **operation.kwargs
+                    )
+                except Exception as e:
+                    db.execute('ROLLBACK TO operation')
+                    db.execute('RELEASE operation')
+                    outcomes.append((operation, None, e))
+                else:
+                    db.execute('RELEASE operation')
+                    outcomes.append((operation, result, None))
+                    callbacks.extend(_state.callbacks)
+
+            db.commit()
+        except BaseException as e:
+            # nothing of the batch was committed
+            if db.in_transaction:
+                db.rollback()
+
+            for operation in batch:
+                operation.future.set_exception(e)
+
+            return
+        finally:
+            _state.callbacks = None
+
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                self.app.logger.exception('after_commit callback failed')
+
+        for operation, result, error in outcomes:
+            if error is not None:
+                operation.future.set_exception(error)
+            else:
+                operation.future.set_result(result)
+
+
+def get_writer():
+    """Return the group writer of the current app and process, starting
+    its thread on first use."""
+    extensions = current_app.extensions
+    writer = extensions.get('guapio.writer')
+
+    # a thread doesn't survive a fork, the child needs its own
+    if writer is None or writer.pid != os.getpid() or not writer.is_alive():
+        with _start_lock:
+            writer = extensions.get('guapio.writer')
+
+            if (
+                writer is None or writer.pid != os.getpid()
+                or not writer.is_alive()
+            ):
+                config = current_app.config
+                writer = extensions['guapio.writer'] = GroupWriter(
+                    current_app._get_current_object(), get_pool().connect(),
+                    config['GROUP_COMMIT_SIZE'], config['GROUP_COMMIT_DELAY']
+                )
+
+    return writer
+
+
+def _run_alone(db, function, args, kwargs):
+    # like guapio.ledger.immediate, never commit the caller's work
+    if db.in_transaction:
+        raise RuntimeError('A transaction is already open.')
+
+    db.execute('BEGIN IMMEDIATE')
+    _state.callbacks = []
+
+    try:
+        result = function(db, *args, **kwargs)
+        db.commit()
+        callbacks = _state.callbacks
+    except BaseException:
+        if db.in_transaction:
+            db.rollback()
+
+        raise
+    finally:
+        _state.callbacks = None
+
+    for callback in callbacks:
+        callback()
+
+    return result
+
+
+def write(function, *args, **kwargs):
+    """Run the write operation ``function(connection, *args, **kwargs)``
+    and return its result once it's committed.
+
+    :raise: whatever the operation raised, nothing of it being committed
+    :raise concurrent.futures.TimeoutError: if the batch wasn't done
+        within ``GROUP_COMMIT_TIMEOUT`` seconds; the operation may still
+        be committed after
+    """
+    config = current_app.config
+
+    if not config['GROUP_COMMIT']:
+        return _run_alone(get_db(), function, args, kwargs)
+
+    return get_writer().submit(function, *args, **kwargs).result(
+        config['GROUP_COMMIT_TIMEOUT']
+    )
+
+
+def statement(db, sql, parameters, generations):
+    """The operation run by :func:`execute`."""
+    cursor = db.execute(sql, parameters)
+
+    if generations:
+        bump_generation(db, *generations)
+
+    return cursor.lastrowid
+
+
+def execute(sql, parameters=(), generations=()):
+    """Run one write statement through :func:`write`, bumping the change
+    counters ``generations`` in the same transaction, and return the
+    ``lastrowid``."""
+    return write(statement, sql, parameters, generations)
+
+
+def init_app(app):
+    """Set the defaults of the group commit."""
+    app.config.setdefault('GROUP_COMMIT', True)
+    app.config.setdefault('GROUP_COMMIT_SIZE', 64)
+    app.config.setdefault('GROUP_COMMIT_DELAY', 0.002)
+    app.config.setdefault('GROUP_COMMIT_TIMEOUT', 30)
@@ -0,0 +1,73 @@
+import os
+import tempfile
+
+import pytest
+
+from guapio import create_app
+from guapio.db import get_db, init_db
+from guapio.hashing import get_hasher
+
+# read in SQL for populating test data
+with open(os.path.join(os.path.dirname(__file__), 'data.sql'), 'rb') as f:
+    _data_sql = f.read().decode('utf8')
+
+
+@pytest.fixture
+def app():
+    """Create and configure a new app instance for each test."""
+    # create a temporary file to isolate the database for each test
+    db_fd, db_path = tempfile.mkstemp()
+    app = create_app({
+        'TESTING': True,
+        'DATABASE': db_path,
+        # fast hashes, the tests log in a lot
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+    })
+
+    with app.app_context():
+        init_db()
+        db = get_db()
+        db.executemany(
+            'INSERT INTO user (username, password) VALUES (?, ?)',
+            [
+                ('test', get_hasher().hash('test')),
+                ('other', get_hasher().hash('other')),
+            ]
+        )
+        db.executescript(_data_sql)
+
+    yield app
+
+    os.close(db_fd)
+    os.unlink(db_path)
+
+
+@pytest.fixture
+def client(app):
+    """A test client for the app."""
+    return app.test_client()
+
+
+@pytest.fixture
+def runner(app):
+    """A test runner for the app's Click commands."""
+    return app.test_cli_runner()
+
+
+class AuthActions(object):
+    def __init__(self, client):
+        self._client = client
+
+    def login(self, username='test', password='test'):
+        return self._client.post(
+            '/auth/login',
+            data={'username': username, 'password': password}
+        )
+
+    def logout(self):
+        return self._client.get('/auth/logout')
+
+
+@pytest.fixture
+def auth(client):
+    return AuthActions(client)
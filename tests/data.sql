@@ -0,0 +1,14 @@
+INSERT INTO currency (title, code, scale, purchase_rate, sale_rate)
+VALUES
+  ('Dollar', 'usd', 2, 100000000, 100000000),
+  ('Euro', 'eur', 2, 200000000, 200000000);
+
+INSERT INTO balance (user_id, currency_id, balance, created)
+VALUES
+  (1, 1, 10000, '2018-01-01 00:00:00'),
+  (2, 1, 5000, '2018-01-01 00:00:00');
+
+INSERT INTO balance_change (user_id, currency_id, change, kind, created)
+VALUES
+  (1, 1, 10000, 'deposit', '2018-01-01 00:00:00'),
+  (2, 1, 5000, 'deposit', '2018-01-01 00:00:00');
@@ -0,0 +1,45 @@
+import pytest
+
+from guapio.db import get_db
+
+
+def test_delete(client, auth, app):
+    auth.login()
+    response = client.post('/balance/1/delete')
+    assert response.headers['Location'] == '/balance/'
+
+    with app.app_context():
+        db = get_db()
+        assert db.execute(
+            'SELECT 1 FROM balance WHERE id = 1'
+        ).fetchone() is None
+        # the journal still adds up to the balance, now gone
+        assert tuple(db.execute(
+            'SELECT change, kind FROM balance_change'
+            ' WHERE user_id = 1 AND currency_id = 1 ORDER BY id DESC'
+        ).fetchone()) == (-10000, 'adjustment')
+        assert db.execute(
+            'SELECT SUM(change) FROM balance_change'
+            ' WHERE user_id = 1 AND currency_id = 1'
+        ).fetchone()[0] == 0
+
+
+@pytest.mark.parametrize('path', ('/balance/1/update', '/balance/1/delete'))
+def test_login_required(client, path):
+    response = client.post(path)
+    assert response.headers['Location'] == '/auth/login'
+
+
+def test_delete_other_user(client, auth, app):
+    auth.login()
+    assert client.post('/balance/2/delete').status_code == 403
+
+    with app.app_context():
+        assert get_db().execute(
+            'SELECT 1 FROM balance WHERE id = 2'
+        ).fetchone() is not None
+
+
+def test_delete_get_not_allowed(client, auth):
+    auth.login()
+    assert client.get('/balance/1/delete').status_code == 405
@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from guapio.db import get_db
+
+START = datetime(2024, 2, 29, 12, 39, 7, 640000, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+def history(app):
+    with app.app_context():
+        db = get_db()
+        db.executemany(
+            'INSERT INTO currency_rate'
+            ' (currency_id, purchase_rate, sale_rate, created)'
+            ' VALUES (1, ?, ?, ?)',
+            [
+                (
+                    100000000 + i, 100000000 - i,
+                    (START + timedelta(milliseconds=1001 * i))
+                    .strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+                )
+                for i in range(100)
+            ]
+        )
+        db.commit()
+
+
+@pytest.mark.parametrize('method', ('lttb', 'minmax'))
+def test_rates_whole_milliseconds(client, history, method):
+    response = client.get('/currency/1/rates', query_string={
+        'points': 10, 'method': method,
+        'start': '2024-02-29', 'end': '2024-02-29',
+    })
+    series = response.get_json()['series']
+
+    for points in series.values():
+        assert all(isinstance(time, int) for time, value in points)
+
+    first = int(START.timestamp() * 1000)
+    assert series['purchase_rate'][0] == [first, 1.0]
+    assert (series['sale_rate'][-1][0] - first) % 1001 == 0
@@ -0,0 +1,56 @@
+import json
+
+from guapio import ledger
+from guapio.db import get_db, get_pool
+from guapio.events import get_broker, stream
+
+
+def _events(chunks):
+    events = []
+
+    for chunk in chunks:
+        for block in chunk.split('\n\n'):
+            lines = dict(
+                line.split(': ', 1) for line in block.split('\n')
+                if line.startswith(('event', 'data'))
+            )
+
+            if 'event' in lines:
+                events.append((lines['event'], json.loads(lines['data'])))
+
+    return events
+
+
+def _stream(timeout=0.05):
+    broker = get_broker()
+    subscription = broker.subscribe(
+        ('currency', ledger.balance_generation(1))
+    )
+    return subscription, stream(get_pool(), subscription, 1, 0.01, timeout)
+
+
+def test_change_before_snapshot_counted_once(app):
+    with app.app_context():
+        subscription, chunks = _stream()
+        # committed once subscribed, but before the snapshot is read
+        ledger.deposit(get_db(), 1, 1, '1.00')
+        assert subscription.queue.qsize() == 1
+
+        events = _events(chunks)
+        assert events[0][0] == 'snapshot'
+        assert events[0][1]['balances'] == {'1': '10100'}
+        assert [name for name, data in events] == ['snapshot']
+
+
+def test_change_after_snapshot(app):
+    with app.app_context():
+        subscription, chunks = _stream(timeout=1)
+        name, snapshot = _events([next(chunks)])[0]
+        ledger.deposit(get_db(), 1, 1, '1.00')
+        name, data = _events([next(chunks)])[0]
+        assert name == 'balance'
+        assert data == {
+            'currency_id': 1,
+            'change': '100',
+            'generation': snapshot['generation'] + 1,
+        }
@@ -0,0 +1,53 @@
+from guapio.db import get_db
+
+
+def _balances(app, user_id=1):
+    with app.app_context():
+        return dict(get_db().execute(
+            'SELECT currency_id, balance FROM balance WHERE user_id = ?',
+            (user_id,)
+        ).fetchall())
+
+
+def test_quote_then_confirm(client, auth, app):
+    auth.login()
+    form = {'amount': '10.00', 'from_currency_id': 1, 'to_currency_id': 2}
+    response = client.post('/exchange/create', data=form)
+    assert b'Vende 10.00 Dollar y recibe 5.00 Euro.' in response.data
+    # quoting changes nothing
+    assert _balances(app) == {1: 10000}
+
+    response = client.post(
+        '/exchange/create', data=dict(form, min_proceeds='5.00')
+    )
+    assert response.headers['Location'] == '/'
+    assert _balances(app) == {1: 9000, 2: 500}
+
+
+def test_confirm_refused_if_rates_moved(client, auth, app):
+    auth.login()
+
+    with app.app_context():
+        db = get_db()
+        db.execute('UPDATE currency SET sale_rate = 400000000 WHERE id = 2')
+        db.commit()
+
+    response = client.post('/exchange/create', data={
+        'amount': '10.00', 'from_currency_id': 1, 'to_currency_id': 2,
+        'min_proceeds': '5.00',
+    })
+    assert b'The rates changed' in response.data
+    assert _balances(app) == {1: 10000}
+
+
+def test_quote_many(client, auth):
+    auth.login()
+    response = client.post('/exchange/quote', json=[
+        {'from_currency_id': 1, 'to_currency_id': 2, 'amount': '3'},
+        {'from_currency_id': 1, 'to_currency_id': 2, 'amount': '0.001'},
+    ])
+    ok, error = response.get_json()['quotes']
+    assert (ok['amount'], ok['proceeds']) == ('3.00', '1.50')
+    assert error == {
+        'status': 'error', 'error': 'Amount can have at most 2 decimals.'
+    }
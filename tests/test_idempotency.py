@@ -0,0 +1,127 @@
+import pytest
+
+from guapio import idempotency
+from guapio.db import get_db
+
+
+def _count(app, table):
+    with app.app_context():
+        return get_db().execute(
+            'SELECT COUNT(*) FROM {0}'.format(table)
+        ).fetchone()[0]
+
+
+def _transfer(client, key, amount='10'):
+    return client.post('/user_move/create', data={
+        'amount': amount, 'receiver_id': 2, 'currency_id': 1,
+        'idempotency_key': key,
+    })
+
+
+def test_replayed_form(client, auth, app):
+    auth.login()
+    first = _transfer(client, 'a')
+    again = _transfer(client, 'a')
+    assert first.status_code == again.status_code == 302
+    assert first.headers['Location'] == again.headers['Location']
+    assert _count(app, 'user_move') == 1
+
+    with app.app_context():
+        assert get_db().execute(
+            'SELECT balance FROM balance WHERE id = 1'
+        ).fetchone()[0] == 9000
+
+
+def test_replayed_batch(client, auth, app):
+    auth.login()
+    body = [{'receiver_id': 2, 'currency_id': 1, 'amount': '1'}] * 2
+    first = client.post('/user_move/bulk', json=body, headers={
+        'Idempotency-Key': 'a'
+    })
+    again = client.post('/user_move/bulk', json=body, headers={
+        'Idempotency-Key': 'a'
+    })
+    assert first.get_json() == again.get_json()
+    assert _count(app, 'user_move') == 2
+
+
+def test_key_reused(client, auth, app):
+    auth.login()
+    _transfer(client, 'a')
+    response = _transfer(client, 'a', amount='11')
+    assert response.status_code == 422
+    assert _count(app, 'user_move') == 1
+
+
+def test_key_per_user(client, auth, app):
+    auth.login()
+    _transfer(client, 'a')
+    auth.logout()
+    auth.login('other', 'other')
+    client.post('/user_move/create', data={
+        'amount': '1', 'receiver_id': 1, 'currency_id': 1,
+        'idempotency_key': 'a',
+    })
+    assert _count(app, 'user_move') == 2
+
+
+def test_once(app):
+    calls = []
+
+    def write(db, value):
+        calls.append(value)
+        return {'id': value}
+
+    args = (1, 'a', 'hash', 60, 100, write)
+
+    with app.app_context():
+        db = get_db()
+        # a repeat queued behind the first finds its record
+        assert idempotency._once(db, *args + ((1,), {})) == {'id': 1}
+        assert idempotency._once(db, *args + ((1,), {})) == {'id': 1}
+        assert calls == [1]
+
+        with pytest.raises(idempotency.KeyReused):
+            idempotency._once(
+                db, 1, 'a', 'other', 60, 100, write, (2,), {}
+            )
+
+        assert calls == [1]
+
+
+def test_expired_keys_pruned(client, auth, app):
+    with app.app_context():
+        db = get_db()
+        db.execute(
+            'INSERT INTO idempotency_key'
+            ' (user_id, key, fingerprint, result, created)'
+            " VALUES (1, 'a', 'old', 'null', datetime('now', '-2 days'))"
+        )
+        db.commit()
+
+    auth.login()
+    # past its time, the key is free again
+    assert _transfer(client, 'a').status_code == 302
+    assert _count(app, 'user_move') == 1
+
+    with app.app_context():
+        assert [row[0] != 'old' for row in get_db().execute(
+            'SELECT fingerprint FROM idempotency_key'
+        )] == [True]
+
+
+def test_max_keys(client, auth, app):
+    app.config['IDEMPOTENCY_MAX_KEYS'] = 2
+    auth.login()
+
+    for key in 'abc':
+        _transfer(client, key, amount='1')
+
+    with app.app_context():
+        assert [row[0] for row in get_db().execute(
+            'SELECT key FROM idempotency_key ORDER BY id'
+        )] == ['b', 'c']
+
+    # a dropped key runs again
+    _transfer(client, 'a', amount='1')
+    assert _count(app, 'user_move') == 4
@@ -0,0 +1,223 @@
+import pytest
+
+from guapio import ledger
+from guapio.db import get_db
+
+
+def _balances(db):
+    return dict(
+        ((row[0], row[1]), row[2]) for row in db.execute(
+            'SELECT user_id, currency_id, balance FROM balance'
+        )
+    )
+
+
+def _journal(db):
+    return dict(
+        ((row[0], row[1]), row[2]) for row in db.execute(
+            'SELECT user_id, currency_id, SUM(change) FROM balance_change'
+            ' GROUP BY user_id, currency_id'
+        )
+    )
+
+
+def _move(db, move_id):
+    return db.execute(
+        'SELECT amount FROM user_move WHERE id = ?', (move_id,)
+    ).fetchone()
+
+
+def test_transfer(app):
+    with app.app_context():
+        db = get_db()
+        move_id = ledger.transfer(db, 1, 2, 1, '12.50', 'rent')
+        assert _move(db, move_id)['amount'] == 1250
+        assert _balances(db) == {(1, 1): 8750, (2, 1): 6250}
+
+
+def test_transfer_insufficient_funds(app):
+    with app.app_context():
+        db = get_db()
+
+        with pytest.raises(ledger.InsufficientFunds):
+            ledger.transfer(db, 1, 2, 1, '100.01')
+
+        # the receiver holds nothing of the currency
+        with pytest.raises(ledger.InsufficientFunds):
+            ledger.transfer(db, 1, 2, 2, '1')
+
+        assert _balances(db) == {(1, 1): 10000, (2, 1): 5000}
+        assert db.execute('SELECT COUNT(*) FROM user_move').fetchone()[0] == 0
+
+
+@pytest.mark.parametrize(('args', 'message'), (
+    ((1, 1, 1, '1'), "Sender and receiver can't be the same user."),
+    ((1, 3, 1, '1'), "User 3 doesn't exist."),
+    ((1, 2, 3, '1'), "Currency 3 doesn't exist."),
+    ((1, 2, 1, '0'), 'Amount must be greater than zero.'),
+    ((1, 2, 1, '1.001'), 'Amount can have at most 2 decimals.'),
+))
+def test_transfer_validate(app, args, message):
+    with app.app_context():
+        with pytest.raises(ledger.LedgerError) as e:
+            ledger.transfer(get_db(), *args)
+
+        assert str(e.value) == message
+
+
+def test_transfer_many(app):
+    with app.app_context():
+        db = get_db()
+        results = ledger.transfer_many(db, [
+            {'sender_id': 1, 'receiver_id': 2, 'currency_id': 1,
+             'amount': '60'},
+            # only 40.00 left once the first one is applied
+            {'sender_id': 1, 'receiver_id': 2, 'currency_id': 1,
+             'amount': '50'},
+            {'sender_id': 2, 'receiver_id': 1, 'currency_id': 1,
+             'amount': '10'},
+        ])
+        assert [r['status'] for r in results] == ['ok', 'error', 'ok']
+        assert results[1]['error'] == 'Insufficient funds.'
+        assert _balances(db) == {(1, 1): 5000, (2, 1): 10000}
+        assert _move(db, results[2]['id'])['amount'] == 1000
+
+
+def test_transfer_many_atomic(app):
+    with app.app_context():
+        db = get_db()
+        results = ledger.transfer_many(db, [
+            {'sender_id': 1, 'receiver_id': 2, 'currency_id': 1,
+             'amount': '60'},
+            {'sender_id': 1, 'receiver_id': 2, 'currency_id': 1,
+             'amount': '50'},
+        ], atomic=True)
+        assert [r['status'] for r in results] == ['error', 'error']
+        assert _balances(db) == {(1, 1): 10000, (2, 1): 5000}
+
+
+def test_amend_and_reverse(app):
+    with app.app_context():
+        db = get_db()
+        move_id = ledger.transfer(db, 1, 2, 1, '10')
+        ledger.amend(db, move_id, '25')
+        assert _balances(db) == {(1, 1): 7500, (2, 1): 7500}
+        ledger.amend(db, move_id, '5')
+        assert _balances(db) == {(1, 1): 9500, (2, 1): 5500}
+        ledger.reverse(db, move_id)
+        assert _balances(db) == {(1, 1): 10000, (2, 1): 5000}
+        assert _move(db, move_id) is None
+
+
+def test_amend_insufficient_funds(app):
+    with app.app_context():
+        db = get_db()
+        move_id = ledger.transfer(db, 1, 2, 1, '10')
+
+        with pytest.raises(ledger.InsufficientFunds):
+            ledger.amend(db, move_id, '110.01')
+
+        # the receiver spent it already
+        ledger.transfer(db, 2, 1, 1, '60')
+
+        with pytest.raises(ledger.InsufficientFunds):
+            ledger.reverse(db, move_id)
+
+        assert _move(db, move_id)['amount'] == 1000
+        assert _balances(db) == {(1, 1): 15000, (2, 1): 0}
+
+
+def test_exchange(app):
+    with app.app_context():
+        db = get_db()
+        exchange_id, proceeds = ledger.exchange(db, 1, 1, 2, '10')
+        assert proceeds == 500
+        assert _balances(db)[1, 2] == 500
+
+        with pytest.raises(ledger.RateChanged):
+            ledger.exchange(db, 1, 1, 2, '10', min_proceeds='5.01')
+
+        with pytest.raises(ledger.InsufficientFunds):
+            ledger.exchange(db, 1, 2, 1, '5.01')
+
+        assert _balances(db) == {(1, 1): 9000, (1, 2): 500, (2, 1): 5000}
+
+
+def test_journal_adds_up(app):
+    with app.app_context():
+        db = get_db()
+        move_id = ledger.transfer(db, 1, 2, 1, '10')
+        ledger.transfer_many(db, [
+            {'sender_id': 2, 'receiver_id': 1, 'currency_id': 1,
+             'amount': '1.25'},
+        ])
+        ledger.amend(db, move_id, '7')
+        ledger.deposit(db, 2, 2, '3')
+        ledger.exchange(db, 1, 1, 2, '20')
+        balance_id = db.execute(
+            'SELECT id FROM balance WHERE user_id = 2 AND currency_id = 1'
+        ).fetchone()[0]
+        ledger.set_balance(db, balance_id, '42')
+        ledger.reverse(db, ledger.transfer(db, 1, 2, 1, '1'))
+        balance_id = db.execute(
+            'SELECT id FROM balance WHERE user_id = 2 AND currency_id = 2'
+        ).fetchone()[0]
+        ledger.remove_balance(db, balance_id)
+
+        balances = _balances(db)
+        assert balances == {(1, 1): 7425, (1, 2): 1000, (2, 1): 4200}
+        # a removed balance adds up to zero
+        balances[2, 2] = 0
+        assert _journal(db) == balances
+
+
+def test_immediate(app):
+    with app.app_context():
+        db = get_db()
+
+        with ledger.immediate(db):
+            db.execute("INSERT INTO generation (name) VALUES ('a')")
+
+        with pytest.raises(ValueError):
+            with ledger.immediate(db):
+                db.execute("INSERT INTO generation (name) VALUES ('b')")
+                raise ValueError
+
+        assert not db.in_transaction
+        assert [row[0] for row in db.execute(
+            "SELECT name FROM generation WHERE name IN ('a', 'b')"
+        )] == ['a']
+
+
+def test_immediate_in_transaction(app):
+    with app.app_context():
+        db = get_db()
+        db.execute('BEGIN')
+        db.execute("INSERT INTO generation (name) VALUES ('a')")
+
+        with pytest.raises(RuntimeError):
+            with ledger.immediate(db):
+                pass
+
+        # the caller's work is neither committed nor lost
+        assert db.in_transaction
+        db.rollback()
+        assert db.execute(
+            "SELECT 1 FROM generation WHERE name = 'a'"
+        ).fetchone() is None
+
+
+@pytest.mark.parametrize(
+    'path', ('/user_move/1/update', '/user_move/1/delete')
+)
+def test_amend_reverse_sender_only(client, auth, app, path):
+    with app.app_context():
+        ledger.transfer(get_db(), 1, 2, 1, '10')
+
+    auth.login('other', 'other')
+    assert client.post(path, data={'amount': '1'}).status_code == 403
+
+    with app.app_context():
+        db = get_db()
+        assert _move(db, 1)['amount'] == 1000
+        assert _balances(db) == {(1, 1): 9000, (2, 1): 6000}
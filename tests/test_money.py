@@ -0,0 +1,109 @@
+import sqlite3
+
+import pytest
+
+from guapio.money import Money, MoneyError, migrate, to_minor
+
+#: The tables of a database from before amounts were integers.
+FLOAT_SCHEMA = """
+CREATE TABLE user (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL,
+    password TEXT NOT NULL
+);
+CREATE TABLE currency (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    title TEXT NOT NULL,
+    code TEXT NOT NULL,
+    purchase_rate FLOAT NOT NULL,
+    sale_rate FLOAT NOT NULL
+);
+CREATE TABLE balance (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    balance FLOAT NOT NULL DEFAULT 0.0,
+    currency_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+@pytest.fixture
+def schema(app):
+    with app.open_resource('schema.sql') as f:
+        return f.read().decode('utf8')
+
+
+@pytest.fixture
+def float_db(tmp_path):
+    path = str(tmp_path / 'float.db')
+    db = sqlite3.connect(path)
+    db.executescript(FLOAT_SCHEMA)
+    db.executemany(
+        'INSERT INTO user (username, password) VALUES (?, ?)',
+        [('a', 'x'), ('b', 'x')]
+    )
+    db.execute(
+        "INSERT INTO currency (title, code, purchase_rate, sale_rate)"
+        " VALUES ('Dollar', 'usd', 1.0, 1.0)"
+    )
+    # the old balance.create added a row each time
+    db.executemany(
+        'INSERT INTO balance (balance, currency_id, user_id) VALUES (?, ?, ?)',
+        [(0.1, 1, 1), (0.2, 1, 1), (5.0, 1, 1), (2.5, 1, 2), (0.0, 1, 2)]
+    )
+    db.commit()
+    db.close()
+    return path
+
+
+def test_migrate_merges_balances(float_db, schema):
+    assert migrate(float_db, schema)
+    db = sqlite3.connect(float_db)
+    assert db.execute(
+        'SELECT user_id, currency_id, balance FROM balance ORDER BY user_id'
+    ).fetchall() == [(1, 1, 530), (2, 1, 250)]
+    # the journal starts from the migrated balances
+    assert db.execute(
+        'SELECT user_id, currency_id, SUM(change), kind FROM balance_change'
+        ' GROUP BY user_id, currency_id ORDER BY user_id'
+    ).fetchall() == [(1, 1, 530, 'opening'), (2, 1, 250, 'opening')]
+    db.close()
+
+
+def test_migrate_twice(float_db, schema):
+    assert migrate(float_db, schema)
+    assert not migrate(float_db, schema)
+
+
+def test_money_arithmetic():
+    amount = Money.parse('12.50')
+    assert amount.minor == 1250
+    assert str(amount + 1) == '13.50'
+    assert str(amount - Money(50)) == '12.00'
+    assert str(-amount) == '-12.50'
+    assert amount > 12 and amount < 13
+    assert Money(1200) == 12
+    assert hash(Money(1200)) == hash(12)
+    assert not Money()
+
+    with pytest.raises(AttributeError):
+        amount.currency = 'usd'
+
+
+def test_money_scales():
+    with pytest.raises(ValueError):
+        Money(1, 2) + Money(1, 3)
+
+    assert Money(100, 2) != Money(1000, 3)
+    assert to_minor(Money(1250, 2), 2) == 1250
+
+    with pytest.raises(MoneyError):
+        to_minor(Money(1250, 2), 3)
+
+
+@pytest.mark.parametrize('value', ('abc', '1.001', 'nan', True))
+def test_money_parse_invalid(value):
+    with pytest.raises(MoneyError):
+        Money.parse(value)
@@ -0,0 +1,64 @@
+import importlib
+import sqlite3
+
+import pytest
+
+from guapio import queryplan
+
+
+@pytest.fixture
+def schema(app):
+    with app.open_resource('schema.sql') as f:
+        return f.read().decode('utf8')
+
+
+@pytest.fixture
+def plan_db(schema):
+    db = sqlite3.connect(':memory:')
+    db.executescript(schema)
+    yield db
+    db.close()
+
+
+@pytest.mark.parametrize('name', queryplan.MODULES)
+def test_module_plans(app, plan_db, name):
+    allow_scan = app.config['QUERY_PLAN_ALLOW_SCAN']
+    module = importlib.import_module(name)
+    statements = queryplan.collect_statements(module)
+    failures = []
+
+    for location, sql in statements:
+        if queryplan.FULL_SCAN_MARKER in sql:
+            continue
+
+        problems = queryplan.check_plan(
+            queryplan.explain(plan_db, sql), allow_scan
+        )
+
+        if problems:
+            failures.append((location, sql, problems))
+
+    assert failures == []
+
+
+@pytest.mark.parametrize(('sql', 'problem'), (
+    ('SELECT * FROM user_move WHERE comment = ?', 'SCAN user_move'),
+    (
+        'SELECT * FROM post WHERE created > ? ORDER BY title',
+        'USE TEMP B-TREE FOR ORDER BY'
+    ),
+))
+def test_check_plan_problems(plan_db, sql, problem):
+    assert queryplan.check_plan(queryplan.explain(plan_db, sql)) == [problem]
+
+
+def test_check_plan_allow_scan(plan_db):
+    plan = queryplan.explain(plan_db, 'SELECT * FROM currency')
+    assert queryplan.check_plan(plan) == ['SCAN currency']
+    assert queryplan.check_plan(plan, allow_scan=('currency',)) == []
+
+
+def test_check_query_plans_command(runner):
+    result = runner.invoke(args=['check-query-plans'])
+    assert result.exit_code == 0
+    assert 'All query plans use indexes.' in result.output
@@ -0,0 +1,41 @@
+import pytest
+
+from guapio.db import get_db
+
+
+@pytest.fixture
+def unbuyable(app):
+    # a rate of zero, as databases migrated from floats can hold
+    with app.app_context():
+        db = get_db()
+        db.execute('UPDATE currency SET sale_rate = 0 WHERE id = 2')
+        db.commit()
+
+
+def test_dashboard(client, auth):
+    auth.login()
+    response = client.get('/')
+    assert b'data-scale="2">100.00</td>' in response.data
+    assert b'data-scale="2">50.00</td>' in response.data
+
+
+def test_dashboard_unbuyable(client, auth, unbuyable):
+    auth.login()
+    response = client.get('/')
+    assert b'nan' not in response.data
+    assert b'data-scale="2">-</td>' in response.data
+
+
+def test_index(client, auth, unbuyable):
+    auth.login()
+    assert client.get('/valuation/usd').get_json() == {
+        'currency': 'usd', 'totals': [{'user_id': 1, 'value': 100.0}]
+    }
+    assert client.get('/valuation/eur').get_json() == {
+        'currency': 'eur', 'totals': [{'user_id': 1, 'value': None}]
+    }
+
+
+def test_report(runner, unbuyable):
+    result = runner.invoke(args=['valuation-report', 'eur'])
+    assert result.output.splitlines() == ['user_id,value', '1,', '2,']
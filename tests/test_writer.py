@@ -0,0 +1,157 @@
+import threading
+from concurrent.futures import TimeoutError
+
+import pytest
+
+from guapio import writer
+from guapio.db import get_db, get_pool
+
+
+def _insert(db, name, fail=False, called=None):
+    db.execute('INSERT INTO generation (name) VALUES (?)', (name,))
+
+    if called is not None:
+        writer.after_commit(lambda: called.append(name))
+
+    if fail:
+        raise ValueError(name)
+
+    return name
+
+
+def _names(app):
+    with app.app_context():
+        return sorted(row[0] for row in get_db().execute(
+            "SELECT name FROM generation WHERE name LIKE 'op%'"
+        ))
+
+
+def test_failed_operation_rolled_back_alone(app):
+    with app.app_context():
+        group = writer.GroupWriter(
+            app, get_pool().connect(), size=3, delay=1
+        )
+        called = []
+        futures = [
+            group.submit(_insert, 'op1', called=called),
+            group.submit(_insert, 'op2', fail=True, called=called),
+            group.submit(_insert, 'op3', called=called),
+        ]
+
+        assert futures[0].result(5) == 'op1'
+        assert futures[2].result(5) == 'op3'
+
+        with pytest.raises(ValueError):
+            futures[1].result(5)
+
+    assert _names(app) == ['op1', 'op3']
+    # only the callbacks of the committed operations ran
+    assert called == ['op1', 'op3']
+
+
+def test_write(app):
+    with app.app_context():
+        assert writer.write(_insert, 'op1') == 'op1'
+
+        with pytest.raises(ValueError):
+            writer.write(_insert, 'op2', fail=True)
+
+    assert _names(app) == ['op1']
+
+
+def test_write_timeout(app):
+    app.config['GROUP_COMMIT_TIMEOUT'] = 0.05
+    release = threading.Event()
+
+    def slow(db):
+        release.wait(5)
+        return _insert(db, 'op1')
+
+    with app.app_context():
+        with pytest.raises(TimeoutError):
+            writer.write(slow)
+
+        # the operation still runs, once the batch gets to it
+        release.set()
+        future = writer.get_writer().submit(_insert, 'op2')
+        assert future.result(5) == 'op2'
+
+    assert _names(app) == ['op1', 'op2']
+
+
+def test_batch_failure_keeps_writer(app, monkeypatch):
+    with app.app_context():
+        group = writer.get_writer()
+        apply = group._apply
+        failures = []
+
+        def apply_once(batch):
+            if not failures:
+                failures.append(batch)
+                raise RuntimeError('batch failed')
+
+            return apply(batch)
+
+        monkeypatch.setattr(group, '_apply', apply_once)
+
+        with pytest.raises(RuntimeError):
+            writer.write(_insert, 'op1')
+
+        assert group.is_alive()
+        assert writer.write(_insert, 'op2') == 'op2'
+
+    assert _names(app) == ['op2']
+
+
+@pytest.mark.filterwarnings(
+    'ignore::pytest.PytestUnhandledThreadExceptionWarning'
+)
+def test_dead_writer_restarted(app, monkeypatch):
+    with app.app_context():
+        group = writer.get_writer()
+
+        def stop():
+            raise SystemExit
+
+        # the thread dies once it's done with the batch it's waiting for
+        monkeypatch.setattr(group, '_next_batch', stop)
+        assert writer.write(_insert, 'op1') == 'op1'
+        group._thread.join(5)
+        assert not group.is_alive()
+
+        assert writer.get_writer() is not group
+        assert writer.write(_insert, 'op2') == 'op2'
+
+    assert _names(app) == ['op1', 'op2']
+
+
+def test_run_alone(app):
+    app.config['GROUP_COMMIT'] = False
+    called = []
+
+    with app.app_context():
+        assert writer.write(_insert, 'op1', called=called) == 'op1'
+
+        with pytest.raises(ValueError):
+            writer.write(_insert, 'op2', fail=True, called=called)
+
+    assert _names(app) == ['op1']
+    assert called == ['op1']
+
+
+def test_run_alone_in_transaction(app):
+    app.config['GROUP_COMMIT'] = False
+
+    with app.app_context():
+        db = get_db()
+        db.execute('BEGIN')
+        db.execute("INSERT INTO generation (name) VALUES ('op1')")
+
+        with pytest.raises(RuntimeError):
+            writer.write(_insert, 'op2')
+
+        # the caller's work is left to the caller
+        assert db.in_transaction
+        db.rollback()
+
+    assert _names(app) == []